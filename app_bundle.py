@@ -1,15 +1,32 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import os
-import aiohttp
-import asyncio
-import pandas as pd
+import glob
 import shutil
 import uuid
 import time
+import hashlib
+import pandas as pd
 from io import BytesIO
-from PIL import Image, ImageChops
-from cryptography.fernet import Fernet
+from concurrent.futures import as_completed
+from PIL import Image
+from image_cache import ImageCache, ResultCache
+from compositing import DEFAULT_ENCODING_PROFILE, ENCODING_PROFILES, THUMBNAIL_SIZE, create_process_pool
+from job_manifest import JobManifest
+from availability_index import AvailabilityIndex
+from image_sources import DEFAULT_IMAGE_SOURCE, open_image_source
+from artifact_store import ArtifactStore
+from bundle_pipeline import (
+    BundlePipeline, JobOptions, LANGUAGES, fallback_ext_for_language, missing_images_table, plan_bundle_csv,
+)
+from job_runner import JobRunner, PARTIAL_ZIP_NAME, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+
+# Intervallo di aggiornamento della pagina mentre un job è in coda o in esecuzione
+POLL_SECONDS = 1.0
+# Anteprima nella sidebar: estensioni selezionabili, immagini massime per galleria e colonne della griglia
+PREVIEW_EXTENSIONS = [str(i) for i in range(1, 19)]
+PREVIEW_MAX_IMAGES = 90
+PREVIEW_COLUMNS = 3
 
 # ---------------------- Custom CSS ----------------------
 st.markdown(
@@ -79,358 +96,286 @@ if not st.session_state["authenticated"]:
     st.stop()
 
 # ---------------------- Begin Main App Code ----------------------
-# Creazione di una cartella unica per ogni sessione
 session_id = st.session_state["session_id"]
-# La cartella di output per la sessione corrente (isolata)
-base_folder = f"Bundle&Set_{session_id}"
-
-# ----- Pulizia automatica dei file della sessione corrente -----
-def clear_old_data():
-    if os.path.exists(base_folder):
-        shutil.rmtree(base_folder)
-    # Elimina eventuali ZIP della sessione corrente
-    zip_path = f"Bundle&Set_{session_id}.zip"
-    if os.path.exists(zip_path):
-        os.remove(zip_path)
-    # Elimina il file CSV degli errori se esistente
-    if os.path.exists("missing_images.csv"):
-        os.remove("missing_images.csv")
-    if os.path.exists("bundle_list.csv"):
-        os.remove("bundle_list.csv")
-
-clear_old_data()  # Pulizia dei file della sessione al primo avvio
-
-# ---------------------- Helper Functions ----------------------
-async def async_download_image(product_code, extension, session):
-    # Se il product_code inizia per '1' o '0', aggiunge il prefisso "D"
-    if product_code.startswith(('1', '0')):
-        product_code = f"D{product_code}"
-    url = f"https://cdn.shop-apotheke.com/images/{product_code}-p{extension}.jpg"
-    try:
-        async with session.get(url) as response:
-            if response.status == 200:
-                content = await response.read()
-                return content, url
+
+def browser_owner():
+    """Proprietario dei job di questa pagina: solo lui può seguirli, scaricarne i file e annullarli.
+
+    Dopo un refresh la sessione Streamlit è nuova, quindi si usa il cookie XSRF che Streamlit
+    imposta nel browser (non compare nell'URL); se non è disponibile vale la sessione, e un
+    refresh non ritrova più il job.
+    """
+    cookies = getattr(getattr(st, "context", None), "cookies", None) or {}
+    token = cookies.get("_streamlit_xsrf")
+    if isinstance(token, str) and token:
+        return hashlib.sha256(token.encode()).hexdigest()
+    return session_id
+
+job_owner = browser_owner()
+
+def clear_legacy_outputs(ttl):
+    """Rimuove le cartelle e gli ZIP per sessione lasciati nella cartella di lavoro dalle versioni precedenti."""
+    deadline = time.time() - ttl
+    for path in glob.glob("Bundle&Set_*") + ["missing_images.csv", "bundle_list.csv"]:
+        try:
+            if os.path.getmtime(path) >= deadline:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
             else:
-                return None, None
-    except Exception:
-        return None, None
-
-def trim(im):
-    """Rimuove i bordi bianchi dall'immagine."""
-    bg = Image.new(im.mode, im.size, (255, 255, 255))
-    diff = ImageChops.difference(im, bg)
-    bbox = diff.getbbox()
-    if bbox:
-        return im.crop(bbox)
-    return im
-
-def process_double_bundle_image(image, layout="horizontal"):
-    """Processa bundle a due immagini: rimuove i bordi bianchi, unisce due copie e ridimensiona su una tela 1000x1000."""
-    image = trim(image)
-    width, height = image.size
-    chosen_layout = "vertical" if (layout.lower() == "automatic" and height < width) else layout.lower()
-    if chosen_layout == "horizontal":
-        merged_width = width * 2
-        merged_height = height
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (width, 0))
-    elif chosen_layout == "vertical":
-        merged_width = width
-        merged_height = height * 2
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (0, height))
-    else:
-        merged_width = width * 2
-        merged_height = height
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (width, 0))
-    
-    scale_factor = min(1000 / merged_width, 1000 / merged_height)
-    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
-    resized_image = merged_image.resize(new_size, Image.LANCZOS)
-    final_image = Image.new("RGB", (1000, 1000), (255, 255, 255))
-    x_offset = (1000 - new_size[0]) // 2
-    y_offset = (1000 - new_size[1]) // 2
-    final_image.paste(resized_image, (x_offset, y_offset))
-    return final_image
-
-def process_triple_bundle_image(image, layout="horizontal"):
-    """Processa bundle a tre immagini: rimuove i bordi bianchi, unisce tre copie e ridimensiona su una tela 1000x1000."""
-    image = trim(image)
-    width, height = image.size
-    chosen_layout = "vertical" if (layout.lower() == "automatic" and height < width) else layout.lower()
-    if chosen_layout == "horizontal":
-        merged_width = width * 3
-        merged_height = height
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (width, 0))
-        merged_image.paste(image, (width * 2, 0))
-    elif chosen_layout == "vertical":
-        merged_width = width
-        merged_height = height * 3
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (0, height))
-        merged_image.paste(image, (0, height * 2))
-    else:
-        merged_width = width * 3
-        merged_height = height
-        merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
-        merged_image.paste(image, (0, 0))
-        merged_image.paste(image, (width, 0))
-        merged_image.paste(image, (width * 2, 0))
-    
-    scale_factor = min(1000 / merged_width, 1000 / merged_height)
-    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
-    resized_image = merged_image.resize(new_size, Image.LANCZOS)
-    final_image = Image.new("RGB", (1000, 1000), (255, 255, 255))
-    x_offset = (1000 - new_size[0]) // 2
-    y_offset = (1000 - new_size[1]) // 2
-    final_image.paste(resized_image, (x_offset, y_offset))
-    return final_image
-
-def save_binary_file(path, data):
-    """Salva in maniera sincrona dei dati binari su file."""
-    with open(path, 'wb') as f:
-        f.write(data)
-
-# Funzione per la modalità NL FR: scarica in parallelo le immagini con estensione 1-fr e 1-nl.
-async def async_get_nl_fr_images(product_code, session):
-    tasks = [
-        async_download_image(product_code, "1-fr", session),
-        async_download_image(product_code, "1-nl", session)
-    ]
-    results = await asyncio.gather(*tasks)
-    images = {}
-    if results[0][0]:
-        images["1-fr"] = results[0][0]
-    if results[1][0]:
-        images["1-nl"] = results[1][0]
-    return images
-
-# Funzione generica per il download, gestisce anche il caso speciale "NL FR"
-async def async_get_image_with_fallback(product_code, session):
-    fallback_ext = st.session_state.get("fallback_ext", None)
-    if fallback_ext == "NL FR":
-        images_dict = await async_get_nl_fr_images(product_code, session)
-        if images_dict:
-            return images_dict, "NL FR"
-    # Prova le estensioni standard "1" e "10"
-    tasks = [async_download_image(product_code, ext, session) for ext in ["1", "10"]]
-    results = await asyncio.gather(*tasks)
-    for ext, result in zip(["1", "10"], results):
-        content, url = result
-        if content:
-            return content, ext
-    if fallback_ext and fallback_ext != "NL FR":
-        content, _ = await async_download_image(product_code, fallback_ext, session)
-        if content:
-            return content, fallback_ext
-    return None, None
+                os.remove(path)
+        except OSError:
+            pass
+
+# File dei job (ZIP e report) su disco, con quota e scadenza: la pulizia avviene in un thread
+# di background e non a ogni rerun, quindi i file di un job restano scaricabili finché servono
+@st.cache_resource
+def get_artifact_store():
+    store = ArtifactStore()
+    clear_legacy_outputs(store.ttl)
+    store.start_sweeper()
+    return store
+
+artifact_store = get_artifact_store()
+
+# Cache su disco delle immagini del CDN, condivisa tra tutte le sessioni e non svuotata dal reset
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
+
+image_cache = get_image_cache()
+
+# Pool di processi condiviso per la composizione delle immagini
+@st.cache_resource
+def get_compose_executor():
+    return create_process_pool()
+
+compose_executor = get_compose_executor()
+
+# Cache su disco delle immagini composte, condivisa tra tutte le sessioni
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
+
+result_cache = get_result_cache()
+
+# Manifest dei bundle elaborati: un job interrotto o un export aggiornato riprendono da qui
+@st.cache_resource
+def get_job_manifest():
+    return JobManifest()
+
+job_manifest = get_job_manifest()
+
+# Indice delle varianti presenti/assenti sul CDN: le assenti note non vengono richieste di nuovo
+@st.cache_resource
+def get_availability_index():
+    return AvailabilityIndex()
+
+availability_index = get_availability_index()
+
+# Un solo esecutore di job per processo: coda condivisa tra le sessioni, un event loop e
+# un pool di connessioni; i job non girano nel thread dello script e sopravvivono ai rerun.
+# Con BUNDLE_IMAGE_SOURCE (cartella mirror o archivio) le immagini vengono lette in locale
+@st.cache_resource
+def get_job_runner():
+    source = open_image_source(DEFAULT_IMAGE_SOURCE)
+    return JobRunner(lambda: BundlePipeline(image_cache, result_cache, compose_executor, manifest=job_manifest,
+                                            availability_index=availability_index, source=source),
+                     artifact_store=artifact_store)
+
+job_runner = get_job_runner()
+
+def show_job_metrics(metrics):
+    """Riepilogo delle metriche del job: tempo per fase e contatori principali."""
+    with st.expander("Job metrics"):
+        st.dataframe(pd.DataFrame(metrics.summary()))
+        requests = {}
+        for (name, labels), value in metrics.counters.items():
+            if name == "requests":
+                labels = dict(labels)
+                requests.setdefault(labels["ext"], {})[labels["outcome"]] = value
+        if requests:
+            st.write("Requests per extension:")
+            st.dataframe(pd.DataFrame.from_dict(requests, orient="index").fillna(0).astype(int))
+        st.write(f"Downloaded: {metrics.counter('bytes_downloaded') / 1e6:.1f} MB, "
+                 f"written: {metrics.counter('bytes_written') / 1e6:.1f} MB, "
+                 f"errors: {metrics.counter('errors')}, missing images: {metrics.counter('missing_images')}")
 
 # ---------------------- Main Processing Function ----------------------
-async def process_file_async(uploaded_file, progress_bar=None, layout="horizontal"):
-    # Protezione tramite crittografia
-    if "encryption_key" not in st.session_state:
-        st.session_state["encryption_key"] = Fernet.generate_key()
-    key = st.session_state["encryption_key"]
-    f = Fernet(key)
-    
-    file_bytes = uploaded_file.read()
-    encrypted_bytes = f.encrypt(file_bytes)
-    decrypted_bytes = f.decrypt(encrypted_bytes)
-    
-    csv_file = BytesIO(decrypted_bytes)
-    data = pd.read_csv(csv_file, delimiter=';', dtype=str)
-    
-    required_columns = {'sku', 'pzns_in_set'}
-    missing_columns = required_columns - set(data.columns)
-    if missing_columns:
-        st.error(f"Missing required columns: {', '.join(missing_columns)}")
-        return None, None, None, None
-    
-    if data.empty:
-        st.error("The CSV file is empty!")
-        return None, None, None, None
-    
-    data = data[list(required_columns)]
-    data.dropna(inplace=True)
-    
-    st.write(f"File loaded: {len(data)} bundles found.")
-    os.makedirs(base_folder, exist_ok=True)
-    
-    mixed_sets_needed = False
-    mixed_folder = os.path.join(base_folder, "mixed_sets")
-    error_list = []      # Lista di tuple: (bundle_code, product_code)
-    bundle_list = []     # Dettagli: bundle code, lista di product codes, tipo di bundle, flag cross-country
-    
-    total = len(data)
-    
-    connector = aiohttp.TCPConnector(limit=100)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        for i, (_, row) in enumerate(data.iterrows()):
-            bundle_code = row['sku'].strip()
-            product_codes = [code.strip() for code in row['pzns_in_set'].strip().split(',')]
-            num_products = len(product_codes)
-            is_uniform = (len(set(product_codes)) == 1)
-            bundle_type = f"bundle of {num_products}" if is_uniform else "mixed"
-            bundle_cross_country = False
-    
-            if is_uniform:
-                product_code = product_codes[0]
-                # Imposta la cartella di destinazione per il bundle
-                folder_name = os.path.join(base_folder, f"bundle_{num_products}")
-                if st.session_state.get("fallback_ext") in ["NL FR", "1-fr", "1-de", "1-nl"]:
-                    bundle_cross_country = True
-                    folder_name = os.path.join(base_folder, "cross-country")
-                os.makedirs(folder_name, exist_ok=True)
-    
-                if st.session_state.get("fallback_ext") == "NL FR":
-                    result, used_ext = await async_get_image_with_fallback(product_code, session)
-                    if used_ext == "NL FR" and isinstance(result, dict):
-                        # Elaborazione delle immagini NL FR
-                        for lang, image_data in result.items():
-                            suffix = "-p1-fr" if lang == "1-fr" else "-p1-nl"
-                            try:
-                                img = await asyncio.to_thread(Image.open, BytesIO(image_data))
-                                if num_products == 2:
-                                    final_img = await asyncio.to_thread(process_double_bundle_image, img, layout)
-                                elif num_products == 3:
-                                    final_img = await asyncio.to_thread(process_triple_bundle_image, img, layout)
-                                else:
-                                    final_img = img
-                                save_path = os.path.join(folder_name, f"{bundle_code}{suffix}.jpg")
-                                await asyncio.to_thread(final_img.save, save_path, "JPEG", quality=100)
-                            except Exception as e:
-                                st.error(f"Error processing image for bundle {bundle_code}: {e}")
-                                error_list.append((bundle_code, product_code))
-                    elif result:
-                        # Fallback standard: una sola immagine, rinomina come -h1
-                        try:
-                            img = await asyncio.to_thread(Image.open, BytesIO(result))
-                            if num_products == 2:
-                                final_img = await asyncio.to_thread(process_double_bundle_image, img, layout)
-                            elif num_products == 3:
-                                final_img = await asyncio.to_thread(process_triple_bundle_image, img, layout)
-                            else:
-                                final_img = img
-                            save_path = os.path.join(folder_name, f"{bundle_code}-h1.jpg")
-                            await asyncio.to_thread(final_img.save, save_path, "JPEG", quality=100)
-                        except Exception as e:
-                            st.error(f"Error processing image for bundle {bundle_code}: {e}")
-                            error_list.append((bundle_code, product_code))
-                    else:
-                        error_list.append((bundle_code, product_code))
-                else:
-                    # Branch standard per fallback_ext diverso da NL FR
-                    image_data, used_ext = await async_get_image_with_fallback(product_code, session)
-                    if used_ext in ["1-fr", "1-de", "1-nl"]:
-                        bundle_cross_country = True
-                        folder_name = os.path.join(base_folder, "cross-country")
-                        os.makedirs(folder_name, exist_ok=True)
-                    if image_data:
-                        try:
-                            img = await asyncio.to_thread(Image.open, BytesIO(image_data))
-                            if num_products == 2:
-                                final_img = await asyncio.to_thread(process_double_bundle_image, img, layout)
-                            elif num_products == 3:
-                                final_img = await asyncio.to_thread(process_triple_bundle_image, img, layout)
-                            else:
-                                final_img = img
-                            suffix = "-h1"
-                            save_path = os.path.join(folder_name, f"{bundle_code}{suffix}.jpg")
-                            await asyncio.to_thread(final_img.save, save_path, "JPEG", quality=100)
-                        except Exception as e:
-                            st.error(f"Error processing image for bundle {bundle_code}: {e}")
-                            error_list.append((bundle_code, product_code))
-                    else:
-                        error_list.append((bundle_code, product_code))
-    
-            else:
-                mixed_sets_needed = True
-                bundle_folder = os.path.join(mixed_folder, bundle_code)
-                os.makedirs(bundle_folder, exist_ok=True)
-                for product_code in product_codes:
-                    if st.session_state.get("fallback_ext") == "NL FR":
-                        result, used_ext = await async_get_image_with_fallback(product_code, session)
-                        if used_ext == "NL FR" and isinstance(result, dict):
-                            for lang, image_data in result.items():
-                                suffix = "-p1-fr" if lang == "1-fr" else "-p1-nl"
-                                prod_folder = os.path.join(bundle_folder, "cross-country") if lang in ["1-fr", "1-de", "1-nl"] else bundle_folder
-                                os.makedirs(prod_folder, exist_ok=True)
-                                file_path = os.path.join(prod_folder, f"{product_code}{suffix}.jpg")
-                                await asyncio.to_thread(save_binary_file, file_path, image_data)
-                        elif result:
-                            suffix = "-h1"
-                            prod_folder = os.path.join(bundle_folder, "cross-country") if used_ext in ["1-fr", "1-de", "1-nl"] else bundle_folder
-                            os.makedirs(prod_folder, exist_ok=True)
-                            file_path = os.path.join(prod_folder, f"{product_code}{suffix}.jpg")
-                            await asyncio.to_thread(save_binary_file, file_path, result)
-                        else:
-                            error_list.append((bundle_code, product_code))
-                    else:
-                        image_data, used_ext = await async_get_image_with_fallback(product_code, session)
-                        if used_ext in ["1-fr", "1-de", "1-nl"]:
-                            bundle_cross_country = True
-                        if image_data:
-                            prod_folder = os.path.join(bundle_folder, "cross-country") if used_ext in ["1-fr", "1-de", "1-nl"] else bundle_folder
-                            os.makedirs(prod_folder, exist_ok=True)
-                            file_path = os.path.join(prod_folder, f"{product_code}.jpg")
-                            await asyncio.to_thread(save_binary_file, file_path, image_data)
-                        else:
-                            error_list.append((bundle_code, product_code))
-    
-            if progress_bar is not None:
-                progress_bar.progress((i + 1) / total)
-    
-            bundle_list.append([bundle_code, ', '.join(product_codes), bundle_type, "Yes" if bundle_cross_country else "No"])
+def submit_job(uploaded_file, layout="horizontal", encoding_profile=DEFAULT_ENCODING_PROFILE):
+    # Il CSV viene letto a blocchi direttamente dall'upload, senza copie intermedie
+    uploaded_file.seek(0)
+    try:
+        plan = plan_bundle_csv(uploaded_file)
+    except ValueError as e:
+        st.error(str(e))
+        return None
     
-    if not mixed_sets_needed and os.path.exists(mixed_folder):
-        shutil.rmtree(mixed_folder)
+    st.session_state["plan_message"] = (
+        f"File loaded: {plan.rows} bundles found "
+        f"({plan.uniform_rows} uniform, {plan.mixed_rows} mixed, {plan.distinct_products} distinct products)."
+    )
     
-    if error_list:
-        missing_images_df = pd.DataFrame(error_list, columns=["PZN Bundle", "PZN with image missing"])
-        missing_images_df = missing_images_df.groupby("PZN Bundle", as_index=False).agg({
-            "PZN with image missing": lambda x: ', '.join(x)
-        })
+    fallback_ext = st.session_state.get("fallback_ext")
+    # Lo stesso file con le stesse opzioni, inviato di nuovo mentre è in lavorazione, non viene duplicato
+    with uploaded_file.getbuffer() as buffer:
+        key = f"{hashlib.sha256(buffer).hexdigest()}|{fallback_ext}|{layout}|{encoding_profile}"
+    return job_runner.submit(
+        job_owner, plan,
+        lambda output_dir: JobOptions(layout=layout, fallback_ext=fallback_ext, output_dir=output_dir,
+                                      encoding_profile=encoding_profile),
+        key,
+    )
+
+def download_on_request(label, path, file_name, mime):
+    """Pulsante di download che legge il file solo quando l'utente lo chiede.
+
+    st.download_button copia i dati nel media store in memoria di Streamlit a ogni rerun:
+    finché il file non è richiesto si mostra solo "Prepare", e ogni sessione tiene pronto
+    al più un file alla volta.
+    """
+    if st.session_state.get("prepared_download") != path:
+        if st.button(f"Prepare {label}", key=f"prepare_{path}"):
+            st.session_state["prepared_download"] = path
+            st.rerun()
+        return
+    with open(path, "rb") as f:
+        st.download_button(label=f"Download {label}", data=f, file_name=file_name, mime=mime)
+
+def show_job_downloads(job_id):
+    """Pulsanti di download serviti dai file del job su disco; in session_state resta solo job_id."""
+    if not artifact_store.exists(job_id, owner=job_owner):
+        st.warning("The files of this job have expired. Please process the CSV again.")
+        return
+    artifact_store.touch(job_id)
+    # Stessi nomi di file usati dalla pipeline nella cartella del job
+    files = JobOptions(output_dir=artifact_store.job_dir(job_id))
+    st.success("Processing complete! Download your files below.")
+    download_on_request("Bundle Image", files.zip_path, f"Bundle&Set_{session_id}.zip", "application/zip")
+    download_on_request("Bundle List", files.bundle_list_path, "bundle_list.csv", "text/csv")
+    missing_images_df = pd.read_csv(files.missing_images_path, sep=';', dtype=str)
+    if not missing_images_df.empty:
+        st.warning("Some images were not found:")
+        st.dataframe(missing_images_df)
+        download_on_request("Missing Images CSV", files.missing_images_path, "missing_images.csv", "text/csv")
+
+def show_job_errors(events):
+    """Errori non bloccanti del job: un solo avviso con il totale, i primi messaggi in un expander."""
+    if not events.errors:
+        return
+    st.error(f"{events.errors} errors while processing images.")
+    with st.expander("Error details"):
+        st.text("\n".join(events.error_samples))
+        if events.errors > len(events.error_samples):
+            st.caption(f"... and {events.errors - len(events.error_samples)} more.")
+
+def show_partial_download(handle):
+    """ZIP dei bundle completati finora. Restituisce True mentre il download è pronto:
+    in quel caso la pagina non si aggiorna da sola, altrimenti il pulsante sparirebbe al poll."""
+    if st.session_state.get("partial_zip") == handle.job_id:
+        path = os.path.join(artifact_store.job_dir(handle.job_id), PARTIAL_ZIP_NAME)
+        if os.path.exists(path):
+            with open(path, "rb") as zip_file:
+                st.download_button(
+                    label="Download bundles finished so far",
+                    data=zip_file,
+                    file_name=f"Bundle&Set_{session_id}_partial.zip",
+                    mime="application/zip"
+                )
+        if st.button("Resume live progress"):
+            del st.session_state["partial_zip"]
+            st.rerun()
+        return True
+    if handle.events.writer is not None and st.button("Prepare download of bundles finished so far"):
+        with st.spinner("Packing finished bundles..."):
+            path = job_runner.snapshot(handle.job_id).result()
+        if path:
+            st.session_state["partial_zip"] = handle.job_id
+            st.rerun()
+    return False
+
+def show_job(handle):
+    """Stato del job della sessione; finché è attivo la pagina si aggiorna ogni POLL_SECONDS.
+
+    Ogni aggiornamento legge lo stato già aggregato del job (handle.events): avanzamento con
+    ETA, riepilogo degli errori e tabella delle immagini mancanti trovate finora.
+    """
+    if "plan_message" in st.session_state:
+        st.write(st.session_state["plan_message"])
+    events = handle.events
+    paused = False
+    if handle.state == QUEUED:
+        position = job_runner.position(handle.job_id) or 1
+        st.info(f"Job queued: position {position} of {job_runner.queue_length()} "
+                f"({job_runner.running_count()} jobs running).")
+    elif handle.state == RUNNING:
+        fraction = events.completed / events.total if events.total else 0.0
+        st.progress(fraction, text=events.describe())
+        paused = show_partial_download(handle)
+        if events.missing:
+            st.warning(f"Images not found so far: {len(events.missing)}")
+            st.dataframe(missing_images_table(list(events.missing)))
     else:
-        missing_images_df = pd.DataFrame(columns=["PZN Bundle", "PZN with image missing"])
-    
-    missing_images_csv = "missing_images.csv"
-    missing_images_df.to_csv(missing_images_csv, index=False, sep=';')
-    with open(missing_images_csv, "rb") as f_csv:
-        missing_images_data = f_csv.read()
-    
-    bundle_list_df = pd.DataFrame(bundle_list, columns=["sku", "pzns_in_set", "bundle type", "cross-country"])
-    bundle_list_csv = "bundle_list.csv"
-    bundle_list_df.to_csv(bundle_list_csv, index=False, sep=';')
-    with open(bundle_list_csv, "rb") as f_csv:
-        bundle_list_data = f_csv.read()
-    
-    # Creazione del file ZIP:
-    # Creiamo una struttura temporanea: una cartella "Bundle&Set" che contiene i file della sessione
-    temp_parent = "Bundle&Set_temp"
-    if os.path.exists(temp_parent):
-        shutil.rmtree(temp_parent)
-    os.makedirs(temp_parent, exist_ok=True)
-    # All'interno della cartella temporanea creiamo una cartella "Bundle&Set" e copiamo i file della sessione
-    zip_folder = os.path.join(temp_parent, "Bundle&Set")
-    shutil.copytree(base_folder, zip_folder)
-    # Creiamo l'archivio ZIP (il nome include lo session ID per evitare conflitti)
-    zip_path = f"Bundle&Set_{session_id}.zip"
-    shutil.make_archive("Bundle&Set_temp", 'zip', temp_parent)
-    os.rename("Bundle&Set_temp.zip", zip_path)
-    # Puliamo la cartella temporanea
-    shutil.rmtree(temp_parent)
-    with open(zip_path, "rb") as zip_file:
-        zip_bytes = zip_file.read()
-    
-    return zip_bytes, missing_images_data, missing_images_df, bundle_list_data
+        st.session_state.pop("partial_zip", None)
+    show_job_errors(events)
+    if handle.active:
+        if st.button("Cancel job"):
+            job_runner.cancel(handle.job_id)
+        elif paused:
+            return
+        time.sleep(POLL_SECONDS)
+        st.rerun()
+        return
+    if handle.state == FAILED:
+        st.error(f"Processing failed: {handle.error}")
+        return
+    if handle.state == CANCELLED:
+        st.warning("Processing cancelled.")
+        return
+
+    result = handle.result
+    minutes = int(handle.elapsed_seconds // 60)
+    seconds = int(handle.elapsed_seconds % 60)
+    st.write(f"Time to download and process images: {minutes} minutes and {seconds} seconds")
+    if result.stats["saved_fetches"]:
+        st.write(f"Duplicate image downloads avoided: {result.stats['saved_fetches']} "
+                 f"({result.stats['saved_requests']} requests saved).")
+    if result.stats["results_reused"]:
+        st.write(f"Composed images reused from cache: {result.stats['results_reused']}.")
+    if result.stats["bundles_restored"]:
+        st.write(f"Bundles unchanged since a previous run and reused: {result.stats['bundles_restored']}.")
+    if result.stats["cdn_retries"] or result.stats["download_failures"]:
+        st.write(f"CDN: {result.stats['cdn_retries']} requests retried, "
+                 f"{result.stats['download_failures']} downloads failed after all attempts "
+                 f"(settled concurrency: {result.stats['cdn_concurrency']}).")
+    show_job_metrics(result.metrics)
+
+def show_preview_gallery(previews):
+    """Galleria di miniature nella sidebar: tutte le varianti vengono scaricate insieme con il
+    runner (dal CDN con cache e limite adattivo condivisi, o dalla sorgente locale configurata) e
+    mostrate man mano che arrivano."""
+    status = st.sidebar.empty()
+    columns = st.sidebar.columns(PREVIEW_COLUMNS)
+    futures = {}
+    for i, (product_code, extension) in enumerate(previews):
+        slot = columns[i % PREVIEW_COLUMNS].empty()
+        slot.caption(f"{product_code} p{extension} …")
+        future = job_runner.call(BundlePipeline.fetch_preview, product_code, extension, THUMBNAIL_SIZE)
+        futures[future] = (slot, product_code, extension)
+    found = 0
+    for done, future in enumerate(as_completed(futures), start=1):
+        slot, product_code, extension = futures[future]
+        try:
+            thumbnail = future.result()
+        except Exception:
+            slot.caption(f"⚠️ {product_code} p{extension}: CDN error")
+        else:
+            if thumbnail:
+                found += 1
+                slot.image(thumbnail, caption=f"{product_code} p{extension}", use_container_width=True)
+            else:
+                slot.caption(f"❌ {product_code} p{extension}")
+        status.write(f"{found} of {done} images found ({len(previews) - done} pending)")
 
 # ---------------------- End of Function Definitions ----------------------
 
@@ -445,7 +390,7 @@ st.markdown(
     2. Select the following options:
        - File Type: CSV - All Attributes or Grid Context (for Grid Context, select ID and PZN included in the set) - With Codes - Without Media
     3. **Choose the language for language specific photos:** (if needed)
-    4. **Choose bundle layout:** (Horizontal, Vertical, or Automatic)
+    4. **Choose bundle layout:** (Horizontal, Vertical, Automatic or Grid)
     5. Click **Process CSV** to start the process.
     6. Download the files.
     7. Before starting a new process, click on **Reset Data**.
@@ -453,12 +398,14 @@ st.markdown(
 )
 
 if st.button("🧹 Clear Cache and Reset Data"):
+    if "job_id" in st.session_state:
+        job_runner.cancel(st.session_state["job_id"])
+        artifact_store.delete(st.session_state["job_id"])
     keys_to_keep = {"authenticated", "session_id", "fallback_ext"}
     for key in list(st.session_state.keys()):
         if key not in keys_to_keep:
             del st.session_state[key]
     st.cache_data.clear()
-    clear_old_data()
     components.html("<script>window.location.href=window.location.origin+window.location.pathname;</script>", height=0)
 
 st.sidebar.header("What This App Does")
@@ -467,99 +414,94 @@ st.sidebar.markdown(
     - ❓ **Automated Bundle Creation:** Automatically create product bundles by downloading and organizing images.
     - 📂 **CSV Upload:** Use a Quick Report in Akeneo.
     - 🔎 **Language Selection:** Choose the language for language specific photos.
-    - ✏️ **Dynamic Processing:** Combine images (double/triple) with proper resizing.
-    - 🔎 **Layout:** Choose the layout for double/triple bundles.
+    - ✏️ **Dynamic Processing:** Combine images (bundles of 2 to 6) with proper resizing.
+    - 🔎 **Layout:** Choose the layout for bundles (Horizontal, Vertical, Automatic or Grid).
     - 📁 **Efficient Organization:** Each session crea una cartella unica per evitare conflitti, poi nel file ZIP viene inclusa una cartella generale chiamata "Bundle&Set".
     - ✏️ **Renames images** using the bundle code and specific suffixes:
          - NL FR: "-p1-fr" / "-p1-nl"
          - Standard fallback: "-h1"
     - ❌ **Error Logging:** Missing images are logged in a CSV.
     - 📥 **Download:** Get a ZIP with all processed images and reports.
-    - 🌐 **Interactive Preview:** Preview and download individual product images from the sidebar.
+    - 🌐 **Interactive Preview:** Preview and download individual product images from the sidebar, or check several codes and extensions at once in a thumbnail gallery.
     """, unsafe_allow_html=True
 )
 
 st.sidebar.header("Product Image Preview")
-product_code = st.sidebar.text_input("Enter Product Code:")
-selected_extension = st.sidebar.selectbox("Select Image Extension:", [str(i) for i in range(1, 19)], key="sidebar_ext")
+product_input = st.sidebar.text_input("Enter Product Code(s):", help="Several codes can be separated by commas or spaces.")
+selected_extensions = st.sidebar.multiselect("Select Image Extensions:", PREVIEW_EXTENSIONS, default=["1"],
+                                             key="sidebar_ext")
 with st.sidebar:
     col_button, col_spinner = st.columns([2, 1])
-    show_image = col_button.button("Show Image")
+    show_image = col_button.button("Show Images")
     spinner_placeholder = col_spinner.empty()
 
-if show_image and product_code:
-    with spinner_placeholder:
-        with st.spinner("Processing..."):
-            preview_url = f"https://cdn.shop-apotheke.com/images/{product_code}-p{selected_extension}.jpg"
-            try:
-                import requests  # per il download sincrono in anteprima
-                response = requests.get(preview_url, stream=True)
-                image_data = response.content if response.status_code == 200 else None
-            except Exception:
-                image_data = None
-    if image_data:
-        image = Image.open(BytesIO(image_data))
-        st.sidebar.image(image, caption=f"Product: {product_code} (p{selected_extension})", use_container_width=True)
-        st.sidebar.download_button(
-            label="Download Image",
-            data=image_data,
-            file_name=f"{product_code}-p{selected_extension}.jpg",
-            mime="image/jpeg"
-        )
+preview_codes = list(dict.fromkeys(product_input.replace(",", " ").split()))
+if show_image and preview_codes and selected_extensions:
+    previews = [(code, ext) for code in preview_codes for ext in selected_extensions]
+    if len(previews) > PREVIEW_MAX_IMAGES:
+        st.sidebar.info(f"Showing the first {PREVIEW_MAX_IMAGES} of {len(previews)} images. "
+                        "Select fewer codes or extensions to see the others.")
+        previews = previews[:PREVIEW_MAX_IMAGES]
+    if len(previews) == 1:
+        product_code, selected_extension = previews[0]
+        with spinner_placeholder:
+            with st.spinner("Processing..."):
+                try:
+                    image_data = job_runner.call(BundlePipeline.fetch_preview, product_code,
+                                                 selected_extension).result()
+                except Exception:
+                    image_data = None
+        if image_data:
+            image = Image.open(BytesIO(image_data))
+            st.sidebar.image(image, caption=f"Product: {product_code} (p{selected_extension})", use_container_width=True)
+            st.sidebar.download_button(
+                label="Download Image",
+                data=image_data,
+                file_name=f"{product_code}-p{selected_extension}.jpg",
+                mime="image/jpeg"
+            )
+        else:
+            st.sidebar.error(f"No image found for {product_code} with -p{selected_extension}.jpg")
     else:
-        st.sidebar.error(f"No image found for {product_code} with -p{selected_extension}.jpg")
+        show_preview_gallery(previews)
 
 uploaded_file = st.file_uploader("**Upload CSV File**", type=["csv"], key="file_uploader")
 if uploaded_file:
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
         # Aggiornate le opzioni: rimuove "BE" e aggiunge "NL FR"
-        fallback_language = st.selectbox("**Choose the language for language specific photos:**", options=["None", "FR", "DE", "NL FR"], index=0)
+        fallback_language = st.selectbox("**Choose the language for language specific photos:**", options=LANGUAGES, index=0)
     with col2:
-        layout_choice = st.selectbox("**Choose bundle layout:**", options=["Horizontal", "Vertical", "Automatic"], index=2)
+        layout_choice = st.selectbox("**Choose bundle layout:**", options=["Horizontal", "Vertical", "Automatic", "Grid"], index=2)
+    with col3:
+        profiles = list(ENCODING_PROFILES)
+        encoding_choice = st.selectbox("**Choose output quality:**", options=profiles,
+                                       index=profiles.index(DEFAULT_ENCODING_PROFILE),
+                                       help="high: JPEG q92 · web: smaller progressive JPEG · max: JPEG q100 · "
+                                            "webp: WebP. Images that are not composed are kept as downloaded.")
 
-    if fallback_language == "NL FR":
-        st.session_state["fallback_ext"] = "NL FR"
-    elif fallback_language != "None":
-        st.session_state["fallback_ext"] = f"1-{fallback_language.lower()}"
-    else:
-        st.session_state["fallback_ext"] = None
+    st.session_state["fallback_ext"] = fallback_ext_for_language(fallback_language)
 
     if st.button("Process CSV"):
-        start_time = time.time()
-        progress_bar = st.progress(0)
-        zip_data, missing_images_data, missing_images_df, bundle_list_data = asyncio.run(process_file_async(uploaded_file, progress_bar, layout=layout_choice))
-        progress_bar.empty()
-        elapsed_time = time.time() - start_time
-        minutes = int(elapsed_time // 60)
-        seconds = int(elapsed_time % 60)
-        st.write(f"Time to download and process images: {minutes} minutes and {seconds} seconds")
-        if zip_data:
-            st.session_state["zip_data"] = zip_data
-            st.session_state["bundle_list_data"] = bundle_list_data
-            st.session_state["missing_images_data"] = missing_images_data
-            st.session_state["missing_images_df"] = missing_images_df
-
-if "zip_data" in st.session_state:
-    st.success("Processing complete! Download your files below.")
-    st.download_button(
-        label="Download Bundle Image",
-        data=st.session_state["zip_data"],
-        file_name=f"Bundle&Set_{session_id}.zip",
-        mime="application/zip"
-    )
-    st.download_button(
-        label="Download Bundle List",
-        data=st.session_state["bundle_list_data"],
-        file_name="bundle_list.csv",
-        mime="text/csv"
-    )
-    if st.session_state["missing_images_df"] is not None and not st.session_state["missing_images_df"].empty:
-        st.warning("Some images were not found:")
-        st.dataframe(st.session_state["missing_images_df"].reset_index(drop=True))
-        st.download_button(
-            label="Download Missing Images CSV",
-            data=st.session_state["missing_images_data"],
-            file_name="missing_images.csv",
-            mime="text/csv"
-        )
+        handle = submit_job(uploaded_file, layout=layout_choice, encoding_profile=encoding_choice)
+        if handle is not None:
+            st.session_state["job_id"] = handle.job_id
+            # Nell'URL, così un refresh della pagina ritrova il job
+            st.query_params["job"] = handle.job_id
+
+# Il job della sessione (o quello indicato nell'URL dopo un refresh) viene seguito a ogni rerun,
+# solo se appartiene a questo browser: conoscere l'id non basta per vederlo o annullarlo
+job_id = st.session_state.get("job_id") or st.query_params.get("job")
+job_handle = job_runner.get(job_id) if isinstance(job_id, str) else None
+if job_handle is not None and job_handle.owner != job_owner:
+    job_handle = None
+if job_handle is not None:
+    st.session_state["job_id"] = job_handle.job_id
+    show_job(job_handle)
+    if job_handle.state == DONE:
+        show_job_downloads(job_handle.job_id)
+elif isinstance(job_id, str) and job_id:
+    # Job non più in memoria (es. processo riavviato): i file possono essere ancora nell'archivio
+    if artifact_store.exists(job_id, owner=job_owner):
+        st.session_state["job_id"] = job_id
+    show_job_downloads(job_id)
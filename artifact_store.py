@@ -0,0 +1,159 @@
+"""Archivio su disco dei file prodotti dai job (ZIP e report), con quota globale e scadenza.
+
+Ogni job scrive in una propria cartella; un indice SQLite tiene proprietario, dimensione
+e ultimo accesso. Quando l'archivio supera max_bytes vengono eliminati i job conclusi
+usati meno di recente; un thread di pulizia elimina quelli non consultati da più di ttl
+secondi (sessioni abbandonate) e le cartelle non più indicizzate. I job in corso non
+vengono mai eliminati.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import threading
+
+# ---------------------- Configurazione ----------------------
+DEFAULT_ARTIFACT_DIR = os.environ.get("BUNDLE_ARTIFACT_DIR", ".jobs")
+# Spazio massimo occupato dai file dei job conclusi (default 10 GB)
+DEFAULT_ARTIFACT_MAX_BYTES = int(os.environ.get("BUNDLE_ARTIFACT_MAX_BYTES", 10 * 1024 ** 3))
+# Dopo quanti secondi senza accessi i file di un job vengono eliminati (default 24 ore)
+DEFAULT_ARTIFACT_TTL = int(os.environ.get("BUNDLE_ARTIFACT_TTL", 24 * 3600))
+# Intervallo tra due passaggi del thread di pulizia
+DEFAULT_SWEEP_INTERVAL = int(os.environ.get("BUNDLE_ARTIFACT_SWEEP_INTERVAL", 600))
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class ArtifactStore:
+    """Cartelle di output dei job con quota LRU e scadenza; thread-safe e condiviso tra sessioni."""
+
+    def __init__(self, root=DEFAULT_ARTIFACT_DIR, max_bytes=DEFAULT_ARTIFACT_MAX_BYTES, ttl=DEFAULT_ARTIFACT_TTL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop = threading.Event()
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts (job_id TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+            "size INTEGER NOT NULL, active INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.commit()
+        self.stats = {"evicted": 0, "expired": 0, "orphans": 0}
+        # Job rimasti "in corso" da un processo precedente: non verranno mai completati
+        with self._lock:
+            stale = [job_id for (job_id,) in self._db.execute("SELECT job_id FROM artifacts WHERE active = 1")]
+            self._delete_locked(stale)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def create(self, job_id, owner):
+        """Registra un nuovo job in corso e restituisce la sua cartella."""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifacts (job_id, owner, size, active, created_at, last_access) "
+                "VALUES (?, ?, 0, 1, ?, ?)", (job_id, owner, now, now)
+            )
+            self._db.commit()
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        return self.job_dir(job_id)
+
+    def finish(self, job_id):
+        """Segna il job come concluso, ne registra la dimensione e applica la quota."""
+        size = directory_size(self.job_dir(job_id))
+        with self._lock:
+            self._db.execute(
+                "UPDATE artifacts SET size = ?, active = 0, last_access = ? WHERE job_id = ?",
+                (size, time.time(), job_id),
+            )
+            self._db.commit()
+            self._enforce_quota_locked(keep=job_id)
+
+    def exists(self, job_id, owner=None):
+        """True se i file del job concluso sono disponibili (e, se indicato, appartengono a owner)."""
+        with self._lock:
+            row = self._db.execute("SELECT active, owner FROM artifacts WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None or row[0] != 0 or (owner is not None and row[1] != owner):
+            return False
+        return os.path.isdir(self.job_dir(job_id))
+
+    def touch(self, job_id):
+        """Aggiorna l'ultimo accesso (LRU e scadenza) quando una sessione mostra o scarica i file."""
+        with self._lock:
+            self._db.execute("UPDATE artifacts SET last_access = ? WHERE job_id = ?", (time.time(), job_id))
+            self._db.commit()
+
+    def delete(self, job_id):
+        with self._lock:
+            self._delete_locked([job_id])
+
+    def total_bytes(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    def _delete_locked(self, job_ids):
+        for job_id in job_ids:
+            self._db.execute("DELETE FROM artifacts WHERE job_id = ?", (job_id,))
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        self._db.commit()
+
+    def _enforce_quota_locked(self, keep=None):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for job_id, size in self._db.execute(
+            "SELECT job_id, size FROM artifacts WHERE active = 0 AND job_id != ? ORDER BY last_access", (keep or "",)
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(job_id)
+            total -= size
+        self._delete_locked(evicted)
+        self.stats["evicted"] += len(evicted)
+
+    def sweep(self):
+        """Elimina i job conclusi scaduti e le cartelle senza voce nell'indice."""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [job_id for (job_id,) in self._db.execute(
+                "SELECT job_id FROM artifacts WHERE active = 0 AND last_access < ?", (deadline,)
+            )]
+            self._delete_locked(expired)
+            self.stats["expired"] += len(expired)
+            known = {job_id for (job_id,) in self._db.execute("SELECT job_id FROM artifacts")}
+            self._enforce_quota_locked()
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name not in known and entry.stat().st_mtime < deadline:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self.stats["orphans"] += 1
+
+    def start_sweeper(self, interval=DEFAULT_SWEEP_INTERVAL):
+        """Avvia (una sola volta) il thread di pulizia periodica."""
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    pass  # la pulizia riprova al prossimo giro
+
+        self._sweeper = threading.Thread(target=run, name="artifact-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
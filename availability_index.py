@@ -0,0 +1,121 @@
+"""Indice persistente della disponibilità delle immagini sul CDN per (product_code, estensione).
+
+Ogni verifica (GET o sonda) registra se la variante esiste e quando è stata controllata.
+Nei job successivi le varianti note come assenti vengono saltate senza richieste, così
+la catena di fallback va direttamente all'URL giusto; le voci negative scadono dopo
+negative_ttl (più breve) per accorgersi dei nuovi caricamenti, quelle positive dopo ttl.
+L'indice permette anche di ricostruire missing_images.csv senza rete
+(vedi bundle_pipeline.derive_missing_images).
+"""
+import os
+import time
+import sqlite3
+import threading
+
+# ---------------------- Configurazione ----------------------
+# Cartella dell'indice, condivisa tra sessioni e non svuotata dal reset della sessione
+DEFAULT_INDEX_DIR = os.environ.get("BUNDLE_AVAILABILITY_INDEX_DIR", ".availability_index")
+# Validità in secondi delle voci "esiste" (default 7 giorni) e "assente" (default 6 ore)
+DEFAULT_TTL = int(os.environ.get("BUNDLE_AVAILABILITY_TTL", 7 * 24 * 3600))
+DEFAULT_NEGATIVE_TTL = int(os.environ.get("BUNDLE_AVAILABILITY_NEGATIVE_TTL", 6 * 3600))
+# Voci in attesa oltre le quali record() chiede di scrivere su disco
+FLUSH_EVERY = 1000
+# Parametri per query con IN (...): sotto il limite di SQLite
+QUERY_BATCH = 500
+
+class AvailabilityIndex:
+    """Catalogo SQLite (product_code, estensione) -> esiste/assente/ultima verifica.
+
+    record() accumula le verifiche in memoria (visibili subito a lookup) e non tocca mai
+    il disco, quindi si può chiamare dall'event loop; quando segnala che le voci in attesa
+    sono FLUSH_EVERY il chiamante esegue flush() in un thread (vedi
+    bundle_pipeline.record_availability), e flush() va chiamata anche a fine job.
+    L'istanza è thread-safe e può essere condivisa tra sessioni Streamlit.
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.index_dir = index_dir
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        os.makedirs(index_dir, exist_ok=True)
+        self._lock = threading.Lock()     # solo per le voci in memoria: mai tenuto durante l'I/O
+        self._db_lock = threading.Lock()  # serializza l'accesso al database
+        self._pending = {}
+        self._flushing = {}  # voci in scrittura, visibili a lookup finché non sono sul disco
+        self._db = sqlite3.connect(os.path.join(index_dir, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS availability (product_code TEXT NOT NULL, extension TEXT NOT NULL, "
+            "present INTEGER NOT NULL, checked_at REAL NOT NULL, PRIMARY KEY (product_code, extension))"
+        )
+        self._db.commit()
+        self.stats = {"known_present": 0, "known_missing": 0, "recorded": 0}
+
+    def _is_valid(self, present, checked_at, now):
+        return now - checked_at < (self.ttl if present else self.negative_ttl)
+
+    def lookup_many(self, product_codes):
+        """{product_code: {estensione: True/False}} con le sole voci ancora valide."""
+        now = time.time()
+        known = {}
+        product_codes = list(dict.fromkeys(product_codes))
+        with self._db_lock:
+            for i in range(0, len(product_codes), QUERY_BATCH):
+                batch = product_codes[i:i + QUERY_BATCH]
+                rows = self._db.execute(
+                    "SELECT product_code, extension, present, checked_at FROM availability "
+                    f"WHERE product_code IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for product_code, extension, present, checked_at in rows:
+                    if self._is_valid(present, checked_at, now):
+                        known.setdefault(product_code, {})[extension] = bool(present)
+            wanted = set(product_codes)
+            with self._lock:
+                # Le voci in attesa sono più recenti di quelle in scrittura
+                for entries in (self._flushing, self._pending):
+                    for (product_code, extension), (present, checked_at) in entries.items():
+                        if product_code in wanted and self._is_valid(present, checked_at, now):
+                            known.setdefault(product_code, {})[extension] = present
+        return known
+
+    def lookup(self, product_code):
+        """{estensione: True/False} delle varianti note di un prodotto."""
+        known = self.lookup_many([product_code]).get(product_code, {})
+        with self._lock:
+            for present in known.values():
+                self.stats["known_present" if present else "known_missing"] += 1
+        return known
+
+    def record(self, product_code, extension, present):
+        """Registra in memoria l'esito di una verifica.
+
+        Restituisce True una volta ogni FLUSH_EVERY voci in attesa: il chiamante deve
+        allora chiamare flush(), fuori dall'event loop.
+        """
+        with self._lock:
+            self._pending[(product_code, extension)] = (bool(present), time.time())
+            self.stats["recorded"] += 1
+            return len(self._pending) == FLUSH_EVERY
+
+    def flush(self):
+        """Scrive su disco le voci in attesa; record() può continuare durante la scrittura."""
+        with self._db_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+            if not self._flushing:
+                return
+            self._db.executemany(
+                "INSERT OR REPLACE INTO availability (product_code, extension, present, checked_at) VALUES (?, ?, ?, ?)",
+                [(code, ext, int(present), checked_at) for (code, ext), (present, checked_at) in self._flushing.items()],
+            )
+            self._db.commit()
+            with self._lock:
+                self._flushing = {}
+
+    def clear(self):
+        with self._db_lock:
+            with self._lock:
+                self._pending.clear()
+                self._flushing = {}
+            self._db.execute("DELETE FROM availability")
+            self._db.commit()
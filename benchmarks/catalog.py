@@ -0,0 +1,109 @@
+"""Catalogo sintetico per il benchmark: disponibilità delle immagini e CSV in stile Akeneo."""
+import csv
+import random
+import hashlib
+
+class CatalogSettings:
+    """Parametri del catalogo simulato e del comportamento del CDN locale.
+
+    Le frazioni sono probabilità indipendenti per prodotto (disponibilità) o per
+    richiesta (429, corpi lenti); tutto è deterministico a parità di seed.
+    """
+
+    def __init__(self, image_width=1500, image_height=1500, latency_ms=20.0, jitter_ms=10.0,
+                 missing_ratio=0.05, p10_only_ratio=0.1, nl_fr_ratio=0.2, rate_limit_ratio=0.0,
+                 slow_body_ratio=0.0, slow_body_ms=500.0, seed=0):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.missing_ratio = missing_ratio
+        self.p10_only_ratio = p10_only_ratio
+        self.nl_fr_ratio = nl_fr_ratio
+        self.rate_limit_ratio = rate_limit_ratio
+        self.slow_body_ratio = slow_body_ratio
+        self.slow_body_ms = slow_body_ms
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+def _unit(*parts):
+    """Numero pseudo-casuale stabile in [0, 1) ricavato dalle parti indicate."""
+    digest = hashlib.blake2b(":".join(str(p) for p in parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+def available_extensions(product_code, settings):
+    """Estensioni presenti sul CDN simulato per un prodotto."""
+    h = _unit(settings.seed, "availability", product_code)
+    extensions = set()
+    if h < settings.missing_ratio:
+        return extensions
+    if h < settings.missing_ratio + settings.p10_only_ratio:
+        extensions.add("10")
+    else:
+        extensions.add("1")
+        if _unit(settings.seed, "p10", product_code) < 0.5:
+            extensions.add("10")
+    if _unit(settings.seed, "language", product_code) < settings.nl_fr_ratio:
+        variant = _unit(settings.seed, "variant", product_code)
+        if variant < 0.7:
+            extensions.update({"1-fr", "1-nl"})
+        elif variant < 0.85:
+            extensions.add("1-fr")
+        else:
+            extensions.add("1-nl")
+        if variant < 0.3:
+            extensions.add("1-de")
+    return extensions
+
+def is_missing(product_code, fallback_ext, settings):
+    """True se con le regole di fallback della pipeline il prodotto non ha alcuna immagine."""
+    extensions = available_extensions(product_code, settings)
+    candidates = {"1", "10"}
+    if fallback_ext == "NL FR":
+        candidates.update({"1-fr", "1-nl"})
+    elif fallback_ext:
+        candidates.add(fallback_ext)
+    return not (extensions & candidates)
+
+def product_codes(count, settings):
+    """Genera PZN a 8 cifre; circa metà inizia per 0 o 1 e riceve il prefisso "D" sul CDN."""
+    rng = random.Random(settings.seed)
+    codes = set()
+    while len(codes) < count:
+        codes.add(f"{rng.randrange(0, 20000000):08d}")
+    return sorted(codes)
+
+def generate_csv(path, rows, settings, products=None, bundle_2=0.45, bundle_3=0.25, bundle_n=0.05,
+                 mixed=0.15, nl_fr=0.10):
+    """Scrive un export in stile Akeneo (separatore ';') con il mix di righe indicato.
+
+    Le righe "nl_fr" sono bundle uniformi da 2 o 3 di prodotti con varianti 1-fr/1-nl;
+    bundle_n sono bundle uniformi da 4 a 6. Restituisce la lista delle righe generate.
+    """
+    rng = random.Random(settings.seed + 1)
+    codes = product_codes(products or max(10, rows // 3), settings)
+    language_codes = [c for c in codes if available_extensions(c, settings) & {"1-fr", "1-nl"}] or codes
+    kinds = ["bundle_2", "bundle_3", "bundle_n", "mixed", "nl_fr"]
+    weights = [bundle_2, bundle_3, bundle_n, mixed, nl_fr]
+    generated = []
+    for i in range(rows):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "bundle_2":
+            pzns = [rng.choice(codes)] * 2
+        elif kind == "bundle_3":
+            pzns = [rng.choice(codes)] * 3
+        elif kind == "bundle_n":
+            pzns = [rng.choice(codes)] * rng.randint(4, 6)
+        elif kind == "nl_fr":
+            pzns = [rng.choice(language_codes)] * rng.choice([2, 3])
+        else:
+            pzns = rng.sample(codes, rng.randint(2, 4))
+        generated.append((f"{30000000 + i:08d}", ",".join(pzns), kind))
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(["sku", "pzns_in_set", "enabled", "family", "categories"])
+        for sku, pzns, kind in generated:
+            writer.writerow([sku, pzns, "1", "bundle" if kind != "mixed" else "set", "bundles"])
+    return generated
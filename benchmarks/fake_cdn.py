@@ -0,0 +1,187 @@
+"""CDN locale che imita https://cdn.shop-apotheke.com/images/{code}-p{ext}.jpg per il benchmark.
+
+Serve packshot sintetici (JPEG) per i prodotti del catalogo simulato, anche in HEAD e
+con Range di byte semplici (per le strategie di fallback con sonda), con latenza,
+jitter, risposte 429 e corpi lenti iniettabili. I contatori sono esposti su /_stats.
+
+Avvio manuale:
+    python -m benchmarks.fake_cdn --port 8765 --latency-ms 30 --rate-limit-ratio 0.02
+"""
+import io
+import json
+import zlib
+import random
+import asyncio
+import argparse
+import multiprocessing
+from collections import Counter
+from aiohttp import web
+from PIL import Image, ImageDraw
+from benchmarks.catalog import CatalogSettings, available_extensions
+
+IMAGE_ROUTE = "/images/{name}"
+PACKSHOT_VARIANTS = 16
+
+def make_packshot(width, height, variant):
+    """Packshot sintetico: sfondo bianco con una confezione colorata al centro."""
+    rng = random.Random(variant)
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    box_w = int(width * rng.uniform(0.35, 0.75))
+    box_h = int(height * rng.uniform(0.35, 0.85))
+    left, top = (width - box_w) // 2, (height - box_h) // 2
+    color = tuple(rng.randrange(40, 220) for _ in range(3))
+    draw.rectangle([left, top, left + box_w, top + box_h], fill=color)
+    for i in range(6):
+        y = top + box_h * (i + 1) // 8
+        draw.line([left + box_w // 8, y, left + box_w * 7 // 8, y], fill="white", width=max(1, height // 150))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def _with_comment(jpeg, text):
+    """Inserisce un segmento COM dopo SOI: l'immagine resta identica ma i byte cambiano per URL."""
+    payload = text.encode()
+    segment = b"\xff\xfe" + (len(payload) + 2).to_bytes(2, "big") + payload
+    return jpeg[:2] + segment + jpeg[2:]
+
+def parse_image_name(name):
+    """'D01234567-p1-fr.jpg' -> ('01234567', '1-fr'); None se il nome non è valido."""
+    if not name.endswith(".jpg") or "-p" not in name:
+        return None
+    code, ext = name[:-4].split("-p", 1)
+    if code.startswith("D"):
+        code = code[1:]
+    return code, ext
+
+def parse_range(header, size):
+    """'bytes=0-0' -> (0, 1); None per intestazioni assenti o non gestite (si invia tutto)."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].partition("-")
+    if not first.isdigit() or int(first) >= size:
+        return None
+    return int(first), min(size, int(last) + 1) if last.isdigit() else size
+
+class FakeCdn:
+    """Applicazione aiohttp del CDN simulato."""
+
+    def __init__(self, settings=None):
+        self.settings = settings or CatalogSettings()
+        self.packshots = [make_packshot(self.settings.image_width, self.settings.image_height, i)
+                          for i in range(PACKSHOT_VARIANTS)]
+        self._rng = random.Random(self.settings.seed + 2)
+        self.stats = Counter()
+
+    def packshot_for(self, code, ext):
+        base = self.packshots[zlib.crc32(f"{code}-p{ext}".encode()) % PACKSHOT_VARIANTS]
+        return _with_comment(base, f"{code}-p{ext}")
+
+    async def _delay(self):
+        latency = self.settings.latency_ms + self._rng.uniform(-1, 1) * self.settings.jitter_ms
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    async def handle_image(self, request):
+        self.stats["requests"] += 1
+        await self._delay()
+        parsed = parse_image_name(request.match_info["name"])
+        if parsed is None or parsed[1] not in available_extensions(parsed[0], self.settings):
+            self.stats["status_404"] += 1
+            return web.Response(status=404)
+        if self._rng.random() < self.settings.rate_limit_ratio:
+            self.stats["status_429"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        body = self.packshot_for(*parsed)
+        if request.method == "HEAD":
+            self.stats["head_200"] += 1
+            return web.Response(headers={"Content-Type": "image/jpeg", "Content-Length": str(len(body))})
+        byte_range = parse_range(request.headers.get("Range"), len(body))
+        if byte_range is not None:
+            start, end = byte_range
+            self.stats["status_206"] += 1
+            self.stats["bytes_sent"] += end - start
+            return web.Response(status=206, body=body[start:end], content_type="image/jpeg",
+                                headers={"Content-Range": f"bytes {start}-{end - 1}/{len(body)}"})
+        self.stats["status_200"] += 1
+        self.stats["bytes_sent"] += len(body)
+        if self._rng.random() >= self.settings.slow_body_ratio:
+            return web.Response(body=body, content_type="image/jpeg")
+        # Corpo lento: inviato a pezzi distribuiti su slow_body_ms
+        self.stats["slow_bodies"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "image/jpeg"})
+        response.content_length = len(body)
+        await response.prepare(request)
+        chunks = 8
+        step = -(-len(body) // chunks)
+        for i in range(0, len(body), step):
+            await response.write(body[i:i + step])
+            await asyncio.sleep(self.settings.slow_body_ms / 1000 / chunks)
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+    async def handle_reset(self, request):
+        self.stats.clear()
+        return web.json_response({})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get(IMAGE_ROUTE, self.handle_image)
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_post("/_reset", self.handle_reset)
+        return app
+
+def serve(settings, host="127.0.0.1", port=8765):
+    web.run_app(FakeCdn(settings).create_app(), host=host, port=port, print=None,
+                access_log=None, handle_signals=True)
+
+def start_in_subprocess(settings, host="127.0.0.1", port=8765):
+    """Avvia il CDN simulato in un processo separato (così non pesa sul loop misurato)."""
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(settings, host, port), daemon=True)
+    process.start()
+    return process
+
+def base_url(host="127.0.0.1", port=8765):
+    return f"http://{host}:{port}"
+
+def image_url_template(host="127.0.0.1", port=8765):
+    """Valore di BUNDLE_CDN_URL per puntare la pipeline al CDN simulato."""
+    return base_url(host, port) + "/images/{product_code}-p{extension}.jpg"
+
+def settings_arguments(parser):
+    """Aggiunge al parser le opzioni di CatalogSettings (condivise con run_benchmark)."""
+    defaults = CatalogSettings()
+    parser.add_argument("--image-size", type=int, default=defaults.image_width, help="packshot side in pixels")
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=defaults.jitter_ms)
+    parser.add_argument("--missing-ratio", type=float, default=defaults.missing_ratio,
+                        help="share of products without any image (404)")
+    parser.add_argument("--rate-limit-ratio", type=float, default=defaults.rate_limit_ratio,
+                        help="share of requests answered with 429")
+    parser.add_argument("--slow-body-ratio", type=float, default=defaults.slow_body_ratio,
+                        help="share of responses streamed slowly")
+    parser.add_argument("--slow-body-ms", type=float, default=defaults.slow_body_ms)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    return parser
+
+def settings_from_args(args):
+    return CatalogSettings(image_width=args.image_size, image_height=args.image_size, latency_ms=args.latency_ms,
+                           jitter_ms=args.jitter_ms, missing_ratio=args.missing_ratio,
+                           rate_limit_ratio=args.rate_limit_ratio, slow_body_ratio=args.slow_body_ratio,
+                           slow_body_ms=args.slow_body_ms, seed=args.seed)
+
+def main(argv=None):
+    parser = settings_arguments(argparse.ArgumentParser(description="Local stand-in for the product image CDN."))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+    settings = settings_from_args(args)
+    print(f"Serving {image_url_template(args.host, args.port)}")
+    print(json.dumps(settings.to_dict()))
+    serve(settings, args.host, args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Benchmark riproducibile della pipeline dei bundle contro il CDN simulato.
+
+Esempio:
+    python -m benchmarks.run_benchmark --rows 2000 --language "NL FR" --runs 2 --latency-ms 40
+
+Genera un CSV in stile Akeneo, avvia il CDN locale in un processo separato e lancia
+la pipeline (BundlePipeline.run, la stessa dell'app e della CLI) per --runs volte. Con le cache
+attive la prima esecuzione è "fredda" e le successive riusano le cache su disco
+(in una cartella temporanea, mai quelle dell'app). Per ogni esecuzione riporta
+bundle/s, byte e richieste servite dal CDN, tempo cumulativo per fase, RSS di picco
+e il numero di immagini segnalate mancanti pur essendo disponibili sul CDN.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import resource
+import urllib.request
+from benchmarks.catalog import generate_csv, is_missing
+from benchmarks.fake_cdn import (
+    base_url, image_url_template, settings_arguments, settings_from_args, start_in_subprocess,
+)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_server(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url + "/_stats", timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"fake CDN did not start at {url}")
+            time.sleep(0.1)
+
+def server_stats(url, reset=False):
+    if reset:
+        urllib.request.urlopen(urllib.request.Request(url + "/_reset", method="POST"), timeout=5).close()
+        return {}
+    with urllib.request.urlopen(url + "/_stats", timeout=5) as response:
+        return json.load(response)
+
+def peak_rss_mb():
+    """RSS di picco in MB del processo e dei figli terminati (i processi di composizione)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # macOS riporta byte, Linux KB
+    return own / scale, children / scale
+
+def false_missing(result, fallback_ext, settings):
+    """Prodotti segnalati mancanti che il CDN simulato in realtà serve."""
+    count = 0
+    for products in result.missing_images_df["PZN with image missing"]:
+        count += sum(1 for code in products.split(", ") if not is_missing(code, fallback_ext, settings))
+    return count
+
+async def run_once(csv_path, output_dir, args, cache_dir):
+    # Import differito: bundle_pipeline legge BUNDLE_CDN_URL all'import
+    from bundle_pipeline import BundlePipeline, JobOptions, fallback_ext_for_language
+    from image_cache import ImageCache, ResultCache
+    from availability_index import AvailabilityIndex
+    from sharded_pipeline import ShardResources, run_sharded
+
+    image_cache = result_cache = availability_index = None
+    if cache_dir:
+        image_cache = ImageCache(os.path.join(cache_dir, "images"))
+        result_cache = ResultCache(os.path.join(cache_dir, "results"))
+        availability_index = AvailabilityIndex(os.path.join(cache_dir, "availability"))
+    options = JobOptions(layout=args.layout, fallback_ext=fallback_ext_for_language(args.language),
+                         output_dir=output_dir, max_bundles=args.max_bundles, download_limit=args.download_limit,
+                         compose_limit=args.compose_limit, write_limit=args.write_limit,
+                         fallback_strategy=args.fallback_strategy, encoding_profile=args.encoding_profile)
+    errors = []
+    if args.shards > 1:
+        resources = ShardResources(connector_limit=args.connections)
+        if cache_dir:
+            resources = ShardResources(os.path.join(cache_dir, "images"), os.path.join(cache_dir, "results"),
+                                       availability_index_dir=os.path.join(cache_dir, "availability"),
+                                       connector_limit=args.connections)
+        start_time = time.perf_counter()
+        result = await run_sharded(csv_path, options, args.shards, resources, on_error=errors.append)
+        # Le statistiche delle cache restano nei processi degli shard
+        return result, time.perf_counter() - start_time, errors, None, None
+    async with BundlePipeline(image_cache, result_cache, connector_limit=args.connections,
+                              availability_index=availability_index) as pipeline:
+        start_time = time.perf_counter()
+        result = await pipeline.run(csv_path, options, on_error=errors.append)
+        elapsed_time = time.perf_counter() - start_time
+    return result, elapsed_time, errors, image_cache, result_cache
+
+def print_report(report):
+    shards = report["stats"].get("shards", 1)
+    print(f"run {report['run']} ({report['cache']}, {shards} shard{'s' if shards > 1 else ''}): "
+          f"{report['bundles']} bundles in {report['wall_seconds']:.2f}s = {report['bundles_per_second']:.1f} bundles/s")
+    cdn = report["cdn"]
+    print(f"  CDN: {cdn.get('requests', 0)} requests (200: {cdn.get('status_200', 0)}, "
+          f"206: {cdn.get('status_206', 0)}, HEAD: {cdn.get('head_200', 0)}, "
+          f"404: {cdn.get('status_404', 0)}, 429: {cdn.get('status_429', 0)}, slow: {cdn.get('slow_bodies', 0)}), "
+          f"{cdn.get('bytes_sent', 0) / 1e6:.1f} MB sent")
+    stats = report["stats"]
+    print(f"  stage time (cumulative): download {stats['download_seconds']:.2f}s, "
+          f"compose {stats['compose_seconds']:.2f}s, write {stats['write_seconds']:.2f}s")
+    print(f"  CDN client: concurrency {stats['cdn_concurrency']}, {stats['cdn_retries']} retries, "
+          f"{stats['download_failures']} failed downloads, {stats['requests_skipped']} skipped (known missing)")
+    print(f"  ZIP: {report['zip_bytes'] / 1e6:.1f} MB; missing: {report['missing_bundles']} bundles, "
+          f"{report['false_missing']} false negatives; errors: {report['errors']}")
+    if report.get("image_cache"):
+        print(f"  image cache: {report['image_cache']}; result cache: {report['result_cache']}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the bundle pipeline against a local fake CDN.")
+    parser.add_argument("--rows", type=int, default=1000, help="bundle rows in the generated CSV")
+    parser.add_argument("--products", type=int, default=None, help="distinct products (default: rows / 3)")
+    parser.add_argument("--csv", default=None, help="use an existing CSV instead of generating one")
+    parser.add_argument("--language", choices=["None", "FR", "DE", "NL FR"], default="None")
+    parser.add_argument("--layout", default="automatic")
+    parser.add_argument("--fallback-strategy", default=os.environ.get("BUNDLE_FALLBACK_STRATEGY", "sequential"),
+                        choices=["sequential", "race", "probe", "range-probe"])
+    parser.add_argument("--encoding-profile", default=os.environ.get("BUNDLE_ENCODING_PROFILE", "high"),
+                        choices=["high", "web", "max", "webp"])
+    parser.add_argument("--runs", type=int, default=2, help="runs; with caches the first one is cold")
+    parser.add_argument("--no-cache", action="store_true", help="run without on-disk caches")
+    parser.add_argument("--max-bundles", type=int, default=32)
+    parser.add_argument("--download-limit", type=int, default=64)
+    parser.add_argument("--compose-limit", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--write-limit", type=int, default=16)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--shards", type=int, default=1, help="worker processes per run (see sharded_pipeline)")
+    parser.add_argument("--json", default=None, help="also write the reports to this JSON file")
+    return settings_arguments(parser)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    settings = settings_from_args(args)
+    port = free_port()
+    url = base_url(port=port)
+    os.environ["BUNDLE_CDN_URL"] = image_url_template(port=port)
+
+    from bundle_pipeline import fallback_ext_for_language
+    fallback_ext = fallback_ext_for_language(args.language)
+
+    server = start_in_subprocess(settings, port=port)
+    reports = []
+    try:
+        wait_for_server(url)
+        with tempfile.TemporaryDirectory(prefix="bundle_bench_") as work_dir:
+            csv_path = args.csv
+            if not csv_path:
+                csv_path = os.path.join(work_dir, "export.csv")
+                generate_csv(csv_path, args.rows, settings, products=args.products)
+            cache_dir = None if args.no_cache else os.path.join(work_dir, "cache")
+            for run in range(1, args.runs + 1):
+                server_stats(url, reset=True)
+                output_dir = os.path.join(work_dir, f"run_{run}")
+                result, elapsed_time, errors, image_cache, result_cache = asyncio.run(
+                    run_once(csv_path, output_dir, args, cache_dir))
+                own_rss, children_rss = peak_rss_mb()
+                report = {
+                    "run": run,
+                    "cache": "disabled" if args.no_cache else ("cold" if run == 1 else "warm"),
+                    "bundles": result.stats["bundles"],
+                    "wall_seconds": elapsed_time,
+                    "bundles_per_second": result.stats["bundles"] / elapsed_time if elapsed_time else 0.0,
+                    "zip_bytes": os.path.getsize(result.zip_path),
+                    "missing_bundles": len(result.missing_images_df),
+                    "false_missing": false_missing(result, fallback_ext, settings),
+                    "errors": len(errors),
+                    "peak_rss_mb": own_rss,
+                    "peak_rss_children_mb": children_rss,
+                    "stats": result.stats,
+                    "cdn": server_stats(url),
+                }
+                if image_cache is not None:
+                    report["image_cache"] = dict(image_cache.stats)
+                    report["result_cache"] = dict(result_cache.stats)
+                reports.append(report)
+                print_report(report)
+        print(f"peak RSS: {max(r['peak_rss_mb'] for r in reports):.0f} MB (pipeline), "
+              f"{max(r['peak_rss_children_mb'] for r in reports):.0f} MB (largest compose worker)")
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings.to_dict(), "args": vars(args), "runs": reports}, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
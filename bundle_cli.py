@@ -0,0 +1,238 @@
+"""Esecuzione della pipeline dei bundle da riga di comando, senza Streamlit.
+
+Esempio:
+    python bundle_cli.py export_1.csv export_2.csv --language "NL FR" --layout automatic --output-dir out
+
+Per ogni CSV viene creata la cartella <output-dir>/<nome del CSV> con Bundle&Set.zip,
+bundle_list.csv, missing_images.csv e job_metrics.csv/.json. Tutti i CSV della stessa
+invocazione condividono il pool di connessioni, le cache su disco e i processi di
+composizione. Grazie al manifest, un'esecuzione interrotta riprende dai bundle già
+completati e un export aggiornato rielabora solo gli SKU cambiati (--no-resume per
+rielaborare tutto).
+
+L'indice di disponibilità delle immagini si aggiorna in blocco con --refresh-index
+(accetta anche elenchi di PZN .txt, uno per riga) senza creare bundle; --missing-report
+ricostruisce solo missing_images.csv dall'indice, senza richieste di rete:
+    python bundle_cli.py export.csv --language "NL FR" --refresh-index
+
+Per export molto grandi --shards N divide ogni job tra N processi (vedi sharded_pipeline).
+Con --image-source le immagini vengono lette da una cartella mirror o da un archivio
+.tar/.zip con i nomi file del CDN invece che dalla rete (vedi image_sources).
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from contextlib import nullcontext
+from bundle_pipeline import (
+    LANGUAGES, DEFAULT_MAX_BUNDLES, DEFAULT_DOWNLOAD_LIMIT, DEFAULT_COMPOSE_LIMIT, DEFAULT_WRITE_LIMIT,
+    DEFAULT_CONNECTOR_LIMIT, DEFAULT_FALLBACK_STRATEGY, FALLBACK_STRATEGIES, BundlePipeline, JobOptions,
+    derive_missing_images, fallback_ext_for_language, plan_bundle_csv,
+)
+from availability_index import AvailabilityIndex, DEFAULT_INDEX_DIR
+from compositing import DEFAULT_ENCODING_PROFILE, ENCODING_PROFILES, LAYOUTS
+from image_cache import ImageCache, ResultCache, DEFAULT_CACHE_DIR, DEFAULT_RESULT_CACHE_DIR
+from job_events import JobEvents
+from job_manifest import JobManifest, DEFAULT_MANIFEST_DIR
+from sharded_pipeline import ShardResources, run_sharded
+from image_sources import open_image_source
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Create bundle images from Akeneo CSV exports.")
+    parser.add_argument("csv_files", nargs="+", help="Akeneo export(s) with 'sku' and 'pzns_in_set' columns")
+    parser.add_argument("--language", choices=LANGUAGES, default="None",
+                        help="language for language specific photos (default: None)")
+    parser.add_argument("--fallback-strategy", choices=FALLBACK_STRATEGIES, default=DEFAULT_FALLBACK_STRATEGY,
+                        help="how to pick among fallback image variants: sequential (fewest bytes), race (lowest "
+                             "latency), probe/range-probe (check with HEAD or a 1-byte range first)")
+    parser.add_argument("--layout", choices=LAYOUTS, default="automatic", help="bundle layout (default: automatic)")
+    parser.add_argument("--encoding-profile", choices=list(ENCODING_PROFILES), default=DEFAULT_ENCODING_PROFILE,
+                        help="encoding of composed images: high (JPEG q92, 4:4:4), web (JPEG q85, progressive), "
+                             "max (JPEG q100) or webp; unmodified images are always copied as downloaded")
+    parser.add_argument("--output-dir", default="bundle_output", help="output folder (default: bundle_output)")
+    parser.add_argument("--max-bundles", type=int, default=DEFAULT_MAX_BUNDLES, help="bundles processed concurrently")
+    parser.add_argument("--download-limit", type=int, default=DEFAULT_DOWNLOAD_LIMIT, help="concurrent product downloads")
+    parser.add_argument("--compose-limit", type=int, default=DEFAULT_COMPOSE_LIMIT, help="concurrent compositions")
+    parser.add_argument("--write-limit", type=int, default=DEFAULT_WRITE_LIMIT, help="concurrent ZIP writes")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTOR_LIMIT, help="HTTP connection pool size")
+    parser.add_argument("--image-source", default="cdn",
+                        help="where images are read from: cdn (default), a local mirror directory or a .tar/.zip "
+                             "archive with the CDN file names (e.g. D01234567-p1.jpg)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="worker processes per job, each with its own event loop and connection pool; the "
+                             "connections and compose processes are split between them (default: 1)")
+    parser.add_argument("--image-cache-dir", default=DEFAULT_CACHE_DIR, help="on-disk cache of CDN images")
+    parser.add_argument("--result-cache-dir", default=DEFAULT_RESULT_CACHE_DIR, help="on-disk cache of composed images")
+    parser.add_argument("--no-cache", action="store_true", help="disable both on-disk caches")
+    parser.add_argument("--manifest-dir", default=DEFAULT_MANIFEST_DIR,
+                        help="manifest of processed bundles, used to resume and to update only changed SKUs")
+    parser.add_argument("--no-resume", action="store_true", help="reprocess every bundle and do not use the manifest")
+    parser.add_argument("--availability-index", default=DEFAULT_INDEX_DIR,
+                        help="index of which image variants exist on the CDN, used to skip known-missing ones")
+    parser.add_argument("--no-index", action="store_true", help="do not use the availability index")
+    parser.add_argument("--refresh-index", action="store_true",
+                        help="recheck every PZN of the inputs (.csv exports or .txt lists) on the CDN, update the "
+                             "index and rebuild missing_images.csv; no bundles are created")
+    parser.add_argument("--missing-report", action="store_true",
+                        help="rebuild missing_images.csv from the index only, without network requests")
+    parser.add_argument("--prometheus-textfile", default=None,
+                        help="write the metrics of the last job in Prometheus text format (textfile collector)")
+    return parser
+
+def write_prometheus_textfile(path):
+    """Hook delle metriche che scrive il file in modo atomico, come richiesto dal textfile collector."""
+    def hook(metrics):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(metrics.to_prometheus())
+        os.replace(tmp_path, path)
+    return hook
+
+def job_options_for(csv_path, args):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return JobOptions(
+        layout=args.layout,
+        fallback_ext=fallback_ext_for_language(args.language),
+        output_dir=os.path.join(args.output_dir, name),
+        max_bundles=args.max_bundles,
+        download_limit=args.download_limit,
+        compose_limit=args.compose_limit,
+        write_limit=args.write_limit,
+        fallback_strategy=args.fallback_strategy,
+        encoding_profile=args.encoding_profile,
+    )
+
+def read_product_codes(path):
+    """Product code di un elenco .txt (uno per riga) o di un export; per gli export anche il piano."""
+    if path.lower().endswith(".txt"):
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()], None
+    plan = plan_bundle_csv(path)
+    return list(plan.product_uses), plan
+
+async def run_index_batch(args, index):
+    """--refresh-index / --missing-report: aggiorna l'indice e ricostruisce missing_images.csv."""
+    fallback_ext = fallback_ext_for_language(args.language)
+    failures = 0
+    async with BundlePipeline(connector_limit=args.connections, availability_index=index) as pipeline:
+        for path in args.csv_files:
+            print(f"{path}:")
+            try:
+                product_codes, plan = await asyncio.to_thread(read_product_codes, path)
+            except (OSError, ValueError) as e:
+                print(f"  failed: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            if args.refresh_index:
+                start_time = time.time()
+                stats = await pipeline.refresh_availability(product_codes, fallback_ext, args.download_limit)
+                print(f"  {len(product_codes)} products rechecked in {time.time() - start_time:.1f}s: "
+                      f"{stats['present']} variants present, {stats['missing']} missing, {stats['failed']} failed")
+            if plan is None:
+                continue
+            missing_images_df, unknown = derive_missing_images(plan, fallback_ext, index)
+            missing_images_path = job_options_for(path, args).missing_images_path
+            os.makedirs(os.path.dirname(missing_images_path), exist_ok=True)
+            missing_images_df.to_csv(missing_images_path, index=False, sep=';')
+            print(f"  {len(missing_images_df)} bundles with missing images -> {missing_images_path}")
+            if unknown:
+                print(f"  {len(unknown)} products not yet in the index (run with --refresh-index)")
+    return failures
+
+def progress_events():
+    """Canale degli eventi di un job: da terminale una riga di avanzamento con ETA su stderr,
+    aggiornata al più ogni DEFAULT_UPDATE_INTERVAL secondi."""
+    def on_update(events):
+        print(f"\r  {events.describe()}, {events.errors} errors\033[K", end="", file=sys.stderr, flush=True)
+
+    return JobEvents(on_update=on_update if sys.stderr.isatty() else None)
+
+def print_job_errors(events):
+    """Chiude la riga di avanzamento e stampa i primi errori non bloccanti del job con il totale."""
+    if sys.stderr.isatty() and events.completed:
+        print(file=sys.stderr)
+    for message in events.error_samples:
+        print(f"  {message}", file=sys.stderr)
+    if events.errors > len(events.error_samples):
+        print(f"  ... and {events.errors - len(events.error_samples)} more errors", file=sys.stderr)
+
+async def run_batch(args):
+    """Elabora i CSV in sequenza con un'unica pipeline; restituisce il numero di CSV falliti."""
+    index = None if args.no_index else AvailabilityIndex(args.availability_index)
+    if args.refresh_index or args.missing_report:
+        if index is None:
+            print("--refresh-index and --missing-report need the availability index", file=sys.stderr)
+            return 1
+        return await run_index_batch(args, index)
+    try:
+        source = open_image_source(args.image_source)
+    except (OSError, ValueError) as e:
+        print(f"--image-source: {e}", file=sys.stderr)
+        return 1
+    image_cache = result_cache = None
+    if not args.no_cache:
+        image_cache = ImageCache(args.image_cache_dir)
+        result_cache = ResultCache(args.result_cache_dir)
+    manifest = None if args.no_resume else JobManifest(args.manifest_dir)
+    metrics_hook = write_prometheus_textfile(args.prometheus_textfile) if args.prometheus_textfile else None
+    failures = 0
+    if args.shards > 1:
+        # Ogni shard apre le proprie risorse sulle stesse cartelle
+        pipeline_context = nullcontext()
+        resources = ShardResources(
+            image_cache_dir=None if args.no_cache else args.image_cache_dir,
+            result_cache_dir=None if args.no_cache else args.result_cache_dir,
+            manifest_dir=None if args.no_resume else args.manifest_dir,
+            availability_index_dir=None if args.no_index else args.availability_index,
+            connector_limit=args.connections,
+            image_source=source,
+        )
+    else:
+        pipeline_context = BundlePipeline(image_cache, result_cache, connector_limit=args.connections,
+                                          metrics_hook=metrics_hook, manifest=manifest, availability_index=index,
+                                          source=source)
+    async with pipeline_context as pipeline:
+        for csv_path in args.csv_files:
+            print(f"{csv_path}:")
+            start_time = time.time()
+            options = job_options_for(csv_path, args)
+            events = progress_events()
+            try:
+                if pipeline is None:
+                    result = await run_sharded(csv_path, options, args.shards, resources, metrics_hook=metrics_hook,
+                                               events=events)
+                else:
+                    result = await pipeline.run(csv_path, options, events=events)
+            except (OSError, ValueError) as e:
+                print_job_errors(events)
+                print(f"  failed: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            print_job_errors(events)
+            elapsed_time = time.time() - start_time
+            missing = len(result.missing_images_df)
+            sharding = f" ({result.stats['shards']} shards)" if "shards" in result.stats else ""
+            print(f"  {result.stats['bundles']} bundles in {elapsed_time:.1f}s{sharding}, "
+                  f"{missing} with missing images -> {result.zip_path}")
+            if result.stats["saved_fetches"]:
+                print(f"  duplicate image downloads avoided: {result.stats['saved_fetches']} "
+                      f"({result.stats['saved_requests']} requests saved)")
+            if result.stats["results_reused"]:
+                print(f"  composed images reused from cache: {result.stats['results_reused']}")
+            if result.stats["bundles_restored"]:
+                print(f"  unchanged bundles reused from the manifest: {result.stats['bundles_restored']}")
+            print(f"  CDN concurrency {result.stats['cdn_concurrency']}, {result.stats['cdn_retries']} retries, "
+                  f"{result.stats['download_failures']} failed downloads, "
+                  f"{result.stats['requests_skipped']} requests skipped via the availability index")
+            stages = ", ".join(f"{row['stage']} {row['total_s']}s" for row in result.metrics.summary())
+            print(f"  time per stage (cumulative): {stages} -> {result.metrics_path}")
+    return failures
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    failures = asyncio.run(run_batch(args))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
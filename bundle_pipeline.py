@@ -0,0 +1,1023 @@
+"""Pipeline di creazione dei bundle: download, composizione e pacchetto ZIP.
+
+Il modulo non dipende da Streamlit e può essere usato dall'app, dalla riga di comando
+(bundle_cli.py) o da altri script:
+
+    async with BundlePipeline(image_cache=ImageCache()) as pipeline:
+        result = await pipeline.run("export.csv", JobOptions(layout="automatic", output_dir="out"))
+"""
+import os
+import time
+import asyncio
+import contextvars
+import pandas as pd
+from collections import Counter
+from contextlib import nullcontext
+from compositing import (
+    DEFAULT_ENCODING_PROFILE, ENCODING_PROFILES, bundle_extension, compose_bundle_timed, create_process_pool,
+    is_passthrough, make_thumbnail, result_key,
+)
+from zip_writer import StreamingZipWriter
+from job_events import fan_out
+from job_metrics import JobMetrics
+from job_manifest import bundle_inputs, source_hashes
+from cdn_client import AdaptiveLimiter, CdnClient, CdnError, create_session
+from image_sources import CdnSource
+
+# ---------------------- Configurazione ----------------------
+# Sovrascrivibile (es. dal benchmark) per puntare a un CDN locale
+CDN_URL = os.environ.get("BUNDLE_CDN_URL", "https://cdn.shop-apotheke.com/images/{product_code}-p{extension}.jpg")
+CROSS_COUNTRY_EXTS = ["1-fr", "1-de", "1-nl"]
+REQUIRED_COLUMNS = {'sku', 'pzns_in_set'}
+LANGUAGES = ["None", "FR", "DE", "NL FR"]
+
+# Limiti di concorrenza predefiniti della pipeline
+DEFAULT_MAX_BUNDLES = 32      # bundle in lavorazione contemporaneamente
+DEFAULT_DOWNLOAD_LIMIT = 64   # prodotti in download contemporaneamente
+DEFAULT_COMPOSE_LIMIT = os.cpu_count() or 4  # composizioni contemporanee
+DEFAULT_WRITE_LIMIT = 16      # scritture su disco contemporanee
+DEFAULT_CONNECTOR_LIMIT = 100 # connessioni HTTP aperte contemporaneamente
+DEFAULT_CSV_CHUNKSIZE = 50000 # righe del CSV lette per blocco
+# Riga del CSV elaborata dal task corrente: le voci dello ZIP scritte per la riga formano un gruppo
+_current_row = contextvars.ContextVar("current_row", default=None)
+
+def fallback_ext_for_language(language):
+    """Traduce la lingua scelta ("None", "FR", "DE", "NL FR") nell'estensione di fallback."""
+    if not language or language == "None":
+        return None
+    if language == "NL FR":
+        return "NL FR"
+    return f"1-{language.lower()}"
+
+# ---------------------- Download ----------------------
+# Estensione "usata" per un prodotto il cui download non è riuscito (non è un'immagine mancante)
+DOWNLOAD_FAILED = "download failed"
+
+# Strategie per scegliere l'immagine tra le estensioni di fallback (vedi async_get_image_with_fallback)
+FALLBACK_STRATEGIES = ["sequential", "race", "probe", "range-probe"]
+DEFAULT_FALLBACK_STRATEGY = os.environ.get("BUNDLE_FALLBACK_STRATEGY", "sequential")
+async def async_download_image(product_code, extension, source, counter=None, metrics=None):
+    """Legge un'immagine dalla sorgente (vedi image_sources), di norma il CDN.
+
+    Restituisce (byte, posizione) oppure (None, None) se l'immagine non esiste; solleva
+    CdnError se non è stato possibile ottenere una risposta definitiva.
+    """
+    url = source.location(product_code, extension)
+    if counter is not None:
+        counter["requests"] += 1
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        content = await source.fetch(product_code, extension)
+        outcome = "found" if content else "not_found"
+        if content:
+            if metrics is not None:
+                metrics.inc("bytes_downloaded", len(content), ext=extension)
+            return content, url
+        return None, None
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except CdnError:
+        raise
+    except Exception as e:
+        raise CdnError(f"{url}: {e}") from e
+    finally:
+        if metrics is not None:
+            metrics.observe("request", time.perf_counter() - start, ext=extension)
+            metrics.inc("requests", ext=extension, outcome=outcome)
+
+async def async_probe_image(product_code, extension, source, counter=None, metrics=None, use_range=False):
+    """Verifica se un'immagine esiste senza scaricarla (sul CDN con HEAD o "Range: bytes=0-0").
+
+    Restituisce False se la sorgente la dà per assente, True se esiste, None se la sonda non
+    è supportata (serve un GET) oppure direttamente i byte se il server ha ignorato il Range
+    e inviato l'immagine intera (vedi CdnSource.probe).
+    """
+    url = source.location(product_code, extension)
+    if counter is not None:
+        counter["requests"] += 1
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        found = await source.probe(product_code, extension, use_range)
+        if isinstance(found, bytes):
+            outcome = "found"
+            if metrics is not None:
+                metrics.inc("bytes_downloaded", len(found), ext=extension)
+        else:
+            outcome = "unsupported" if found is None else ("found" if found else "not_found")
+        return found
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except CdnError:
+        raise
+    except Exception as e:
+        raise CdnError(f"{url}: {e}") from e
+    finally:
+        if metrics is not None:
+            metrics.observe("probe", time.perf_counter() - start, ext=extension)
+            metrics.inc("probes", ext=extension, outcome=outcome)
+
+async def record_availability(index, product_code, extension, present):
+    """Registra un esito nell'AvailabilityIndex; la scrittura su disco, quando serve, avviene in un thread."""
+    if index.record(product_code, extension, present):
+        await asyncio.to_thread(index.flush)
+
+def fallback_tiers(fallback_ext):
+    """Livelli di estensioni in ordine di priorità, come coppie (etichetta, estensioni).
+
+    Vince il primo livello con almeno un'immagine. Nel livello "NL FR" valgono tutte le
+    immagini trovate (1-fr e 1-nl); gli altri livelli hanno una sola estensione.
+    """
+    tiers = []
+    if fallback_ext == "NL FR":
+        tiers.append(("NL FR", ("1-fr", "1-nl")))
+    tiers += [("1", ("1",)), ("10", ("10",))]
+    if fallback_ext and fallback_ext != "NL FR":
+        tiers.append((fallback_ext, (fallback_ext,)))
+    return tiers
+
+async def _download_tier(tier, download):
+    """Scarica in parallelo le estensioni di un livello: {estensione: byte} delle immagini trovate."""
+    extensions = tier[1]
+    results = await asyncio.gather(*(download(ext) for ext in extensions), return_exceptions=True)
+    for result in results:
+        # Un errore impedisce di sapere se il livello ha immagini, quindi di passare ai successivi
+        if isinstance(result, BaseException):
+            raise result
+    return {ext: content for ext, (content, _) in zip(extensions, results) if content}
+
+async def _cancel_all(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _fallback_sequential(tiers, download, probe):
+    """Un livello alla volta: scarica solo ciò che serve, al prezzo di un giro di rete per livello."""
+    for tier in tiers:
+        images = await _download_tier(tier, download)
+        if images:
+            return tier, images
+    return None, None
+
+async def _fallback_race(tiers, download, probe):
+    """Tutti i livelli in parallelo; appena un livello vince, quelli a priorità più bassa vengono annullati."""
+    tasks = [asyncio.ensure_future(_download_tier(tier, download)) for tier in tiers]
+    try:
+        for tier, task in zip(tiers, tasks):
+            images = await task
+            if images:
+                return tier, images
+        return None, None
+    finally:
+        await _cancel_all(tasks)
+
+async def _fallback_probe(tiers, download, probe):
+    """Sonde in parallelo su tutte le estensioni, poi GET solo per il livello vincente.
+
+    Se un'immagine data per esistente risulta poi assente si passa al livello successivo,
+    così il risultato resta quello del download sequenziale.
+    """
+    probes = {ext: asyncio.ensure_future(probe(ext)) for _, extensions in tiers for ext in extensions}
+    try:
+        for tier in tiers:
+            images = {}
+            to_download = []
+            for ext in tier[1]:
+                found = await probes[ext]
+                if isinstance(found, bytes):
+                    images[ext] = found
+                elif found is not False:
+                    to_download.append(ext)
+            if to_download:
+                images.update(await _download_tier((tier[0], to_download), download))
+            if images:
+                return tier, images
+        return None, None
+    finally:
+        await _cancel_all(list(probes.values()))
+
+FALLBACK_STRATEGY_FUNCTIONS = {
+    "sequential": _fallback_sequential,
+    "race": _fallback_race,
+    "probe": _fallback_probe,
+    "range-probe": _fallback_probe,
+}
+
+async def async_get_image_with_fallback(product_code, source, fallback_ext=None, counter=None, metrics=None,
+                                        strategy=DEFAULT_FALLBACK_STRATEGY, index=None):
+    """Scarica l'immagine di un prodotto secondo le priorità di fallback_tiers.
+
+    Restituisce (byte, estensione), ({estensione: byte}, "NL FR") per il livello NL FR oppure
+    (None, None). Le strategie (FALLBACK_STRATEGIES) cambiano solo quante richieste e quanti
+    byte servono per arrivarci: "sequential" prova un livello alla volta, "race" li prova
+    tutti insieme annullando i perdenti, "probe" e "range-probe" verificano prima con HEAD
+    o con un Range di un byte quali immagini esistono.
+    Con index (AvailabilityIndex) le varianti note come assenti vengono saltate senza
+    richieste e l'esito di ogni verifica viene registrato.
+    """
+    try:
+        resolve = FALLBACK_STRATEGY_FUNCTIONS[strategy]
+    except KeyError:
+        raise ValueError(f"Unknown fallback strategy: {strategy}") from None
+
+    known = await asyncio.to_thread(index.lookup, product_code) if index is not None else {}
+
+    def skip_known_missing(ext):
+        if known.get(ext) is not False:
+            return False
+        if metrics is not None:
+            metrics.inc("requests", ext=ext, outcome="known_missing")
+        return True
+
+    async def download(ext):
+        if skip_known_missing(ext):
+            return None, None
+        content, url = await async_download_image(product_code, ext, source, counter, metrics)
+        if index is not None:
+            await record_availability(index, product_code, ext, bool(content))
+        return content, url
+
+    async def probe(ext):
+        if skip_known_missing(ext):
+            return False
+        if ext in known:
+            return known[ext]
+        found = await async_probe_image(product_code, ext, source, counter, metrics,
+                                        use_range=strategy == "range-probe")
+        if index is not None and found is not None:
+            await record_availability(index, product_code, ext, found is not False)
+        return found
+
+    tier, images = await resolve(fallback_tiers(fallback_ext), download, probe)
+    if not images:
+        return None, None
+    label, extensions = tier
+    if len(extensions) > 1:
+        return images, label
+    return images[extensions[0]], label
+
+# ---------------------- Opzioni e stato del job ----------------------
+class StageLimits:
+    """Limiti di concorrenza per i bundle in volo e per ciascuna fase (download, composizione, scrittura)."""
+
+    def __init__(self, max_bundles=DEFAULT_MAX_BUNDLES, download=DEFAULT_DOWNLOAD_LIMIT,
+                 compose=DEFAULT_COMPOSE_LIMIT, write=DEFAULT_WRITE_LIMIT):
+        self.max_bundles = max(1, int(max_bundles))
+        self.download = asyncio.Semaphore(max(1, int(download)))
+        self.compose = asyncio.Semaphore(max(1, int(compose)))
+        self.write = asyncio.Semaphore(max(1, int(write)))
+
+class JobOptions:
+    """Opzioni di un job.
+
+    fallback_ext è l'estensione di fallback già tradotta (vedi fallback_ext_for_language);
+    fallback_strategy sceglie come arrivarci (vedi async_get_image_with_fallback);
+    encoding_profile è il nome del profilo di codifica delle immagini composte
+    (vedi compositing.ENCODING_PROFILES).
+    I percorsi di output, se non indicati, vengono creati in output_dir.
+    """
+
+    def __init__(self, layout="horizontal", fallback_ext=None, output_dir=".", zip_path=None,
+                 bundle_list_path=None, missing_images_path=None, max_bundles=DEFAULT_MAX_BUNDLES,
+                 download_limit=DEFAULT_DOWNLOAD_LIMIT, compose_limit=DEFAULT_COMPOSE_LIMIT,
+                 write_limit=DEFAULT_WRITE_LIMIT, metrics_path=None, metrics_json_path=None,
+                 fallback_strategy=DEFAULT_FALLBACK_STRATEGY, encoding_profile=DEFAULT_ENCODING_PROFILE):
+        if fallback_strategy not in FALLBACK_STRATEGIES:
+            raise ValueError(f"Unknown fallback strategy: {fallback_strategy}")
+        if encoding_profile not in ENCODING_PROFILES:
+            raise ValueError(f"Unknown encoding profile: {encoding_profile}")
+        self.layout = layout
+        self.fallback_ext = fallback_ext
+        self.fallback_strategy = fallback_strategy
+        self.encoding_profile = encoding_profile
+        self.output_dir = output_dir
+        self.zip_path = zip_path or os.path.join(output_dir, "Bundle&Set.zip")
+        self.bundle_list_path = bundle_list_path or os.path.join(output_dir, "bundle_list.csv")
+        self.missing_images_path = missing_images_path or os.path.join(output_dir, "missing_images.csv")
+        # Le metriche vanno accanto a bundle_list.csv
+        self.metrics_path = metrics_path or os.path.join(os.path.dirname(self.bundle_list_path), "job_metrics.csv")
+        self.metrics_json_path = metrics_json_path or os.path.splitext(self.metrics_path)[0] + ".json"
+        self.max_bundles = max_bundles
+        self.download_limit = download_limit
+        self.compose_limit = compose_limit
+        self.write_limit = write_limit
+
+    def create_limits(self):
+        return StageLimits(self.max_bundles, self.download_limit, self.compose_limit, self.write_limit)
+
+class JobResult:
+    """Risultato di un job: percorsi dei file generati, tabelle, contatori e metriche dettagliate."""
+
+    def __init__(self, zip_path, bundle_list_path, missing_images_path, bundle_list_df, missing_images_df, stats,
+                 metrics=None, metrics_path=None):
+        self.zip_path = zip_path
+        self.bundle_list_path = bundle_list_path
+        self.missing_images_path = missing_images_path
+        self.bundle_list_df = bundle_list_df
+        self.missing_images_df = missing_images_df
+        self.stats = stats
+        self.metrics = metrics
+        self.metrics_path = metrics_path
+
+class ProductFetcher:
+    """Download deduplicato delle immagini prodotto per un singolo job (single-flight).
+
+    Ogni coppia (product_code, modalità di fallback) viene scaricata una sola volta:
+    i bundle che chiedono lo stesso prodotto mentre il download è in corso attendono lo
+    stesso task. Il risultato viene tenuto in memoria solo finché tutte le occorrenze
+    previste dal CSV (expected_uses) non lo hanno ritirato.
+    Un download fallito dopo tutti i tentativi viene segnalato una volta con on_error e
+    restituito come (None, DOWNLOAD_FAILED), senza finire tra le immagini mancanti.
+    """
+
+    def __init__(self, source, fallback_ext, limits, expected_uses=None, metrics=None, on_error=None,
+                 strategy=DEFAULT_FALLBACK_STRATEGY, index=None):
+        self.source = source
+        self.fallback_ext = fallback_ext
+        self.strategy = strategy
+        self.index = index
+        self.limits = limits
+        self.metrics = metrics if metrics is not None else JobMetrics()
+        self.on_error = on_error
+        self.expected_uses = dict(expected_uses or {})
+        self._tasks = {}
+        self._counters = {}
+        self.saved_fetches = 0   # download evitati grazie alla deduplicazione
+        self.saved_requests = 0  # richieste HTTP corrispondenti
+
+    async def _download(self, product_code, counter):
+        async with self.limits.download:
+            # Tempo per prodotto, con tutti i tentativi di fallback
+            with self.metrics.timer("download"):
+                try:
+                    return await async_get_image_with_fallback(
+                        product_code, self.source, self.fallback_ext, counter, self.metrics, self.strategy, self.index
+                    )
+                except CdnError as e:
+                    self.metrics.inc("errors", kind="download")
+                    if self.on_error is not None:
+                        self.on_error(f"Download failed for product {product_code}: {e}")
+                    return None, DOWNLOAD_FAILED
+
+    async def fetch(self, product_code):
+        key = (product_code, self.fallback_ext)
+        task = self._tasks.get(key)
+        if task is None:
+            counter = {"requests": 0}
+            task = asyncio.ensure_future(self._download(product_code, counter))
+            self._tasks[key] = task
+            self._counters[key] = counter
+            duplicate = False
+        else:
+            duplicate = True
+        # shield: la cancellazione di un bundle non deve interrompere il download condiviso
+        result = await asyncio.shield(task)
+        if duplicate:
+            self.saved_fetches += 1
+            self.saved_requests += self._counters[key]["requests"]
+        self.release(product_code)
+        return result
+
+    def release(self, product_code):
+        """Conta un uso del prodotto; dopo l'ultimo uso previsto il risultato esce dalla memoria.
+
+        Va chiamata anche per i bundle che non scaricano il prodotto (es. ripresi dal manifest).
+        """
+        key = (product_code, self.fallback_ext)
+        remaining = self.expected_uses.get(product_code, 1) - 1
+        self.expected_uses[product_code] = remaining
+        if remaining <= 0:
+            self._tasks.pop(key, None)
+            self._counters.pop(key, None)
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+class BundleJob:
+    """Stato di un job in corso: opzioni, limiti, fetcher deduplicato, ZIP in scrittura e metriche."""
+
+    def __init__(self, pipeline, options, fetcher, writer, limits, on_error=None):
+        self.pipeline = pipeline
+        self.options = options
+        self.layout = options.layout
+        self.fallback_ext = options.fallback_ext
+        self.encoding_profile = options.encoding_profile
+        self.fetcher = fetcher
+        self.writer = writer
+        self.limits = limits
+        self.on_error = on_error
+        self.metrics = fetcher.metrics
+
+    def report_error(self, message):
+        if self.on_error is not None:
+            self.on_error(message)
+
+# ---------------------- Composizione e scrittura ----------------------
+async def async_write_file(arcname, data, job, outputs=None):
+    """Aggiunge un file allo ZIP del job; se outputs è una lista, vi registra (arcname, data)."""
+    async with job.limits.write:
+        with job.metrics.timer("write"):
+            written = await job.writer.write(arcname, data, group=_current_row.get())
+    if written:
+        job.metrics.inc("bytes_written", len(data))
+    if outputs is not None:
+        outputs.append((arcname, data))
+
+async def async_write_bundle_image(image_data, num_products, arcname, job, outputs=None):
+    """Compone nel pool di processi e aggiunge allo ZIP l'immagine di un bundle uniforme rispettando i limiti di fase.
+
+    Le immagini che la composizione non modifica (vedi compositing.is_passthrough) vengono
+    scritte con i byte scaricati, senza decodificarle. Se la stessa sorgente è già stata
+    composta con gli stessi parametri, il risultato viene copiato dalla cache dei risultati.
+    """
+    if is_passthrough(image_data, num_products):
+        job.metrics.inc("passthrough")
+        await async_write_file(arcname, image_data, job, outputs)
+        return
+    result_cache = job.pipeline.result_cache
+    metrics = job.metrics
+    encoded = None
+    if result_cache is not None:
+        with metrics.timer("result_cache_lookup"):
+            key = await asyncio.to_thread(result_key, image_data, num_products, job.layout, job.encoding_profile)
+            encoded = await asyncio.to_thread(result_cache.get, key)
+        metrics.inc("result_cache", outcome="miss" if encoded is None else "hit")
+    if encoded is None:
+        loop = asyncio.get_running_loop()
+        async with job.limits.compose:
+            # compose_job: tempo nel pool (coda, trasferimento e lavoro); le fasi interne arrivano dal worker
+            with metrics.timer("compose_job", copies=num_products):
+                encoded, timings = await loop.run_in_executor(
+                    job.pipeline.compose_executor, compose_bundle_timed, image_data, num_products, job.layout,
+                    job.encoding_profile
+                )
+        for stage, seconds in timings.items():
+            metrics.observe(stage, seconds)
+        if result_cache is not None:
+            await asyncio.to_thread(result_cache.put, key, encoded)
+    await async_write_file(arcname, encoded, job, outputs)
+
+def bundle_folder(bundle_code, product_codes, fallback_ext):
+    """Cartella iniziale di un bundle nello ZIP (un bundle uniforme può poi passare a cross-country)."""
+    if len(set(product_codes)) != 1:
+        return f"mixed_sets/{bundle_code}"
+    if fallback_ext in ["NL FR"] + CROSS_COUNTRY_EXTS:
+        return "cross-country"
+    return f"bundle_{len(product_codes)}"
+
+def fetched_products(product_codes):
+    """Prodotti da scaricare per una riga: uno solo per i bundle uniformi, tutti per i set misti."""
+    return product_codes[:1] if len(set(product_codes)) == 1 else product_codes
+
+async def process_bundle_row(bundle_code, product_codes, job):
+    """Elabora una singola riga del CSV, passando dal manifest del job se attivo.
+
+    Un bundle registrato con gli stessi input viene ricopiato dal manifest: subito se la
+    voce è recente, altrimenti dopo aver verificato che gli hash delle immagini sorgente
+    non siano cambiati. Negli altri casi il bundle viene elaborato e registrato.
+    Con una sorgente locale la verifica degli hash si fa sempre: la finestra di freschezza
+    vale per la cache del CDN, mentre un mirror o un archivio aggiornato cambia subito.
+    """
+    manifest = job.pipeline.manifest
+    if manifest is None:
+        return await build_bundle_row(bundle_code, product_codes, job)
+    fetcher = job.fetcher
+    products = fetched_products(product_codes)
+    inputs = bundle_inputs(product_codes, job.layout, job.fallback_ext, job.encoding_profile)
+    entry = await asyncio.to_thread(manifest.lookup, bundle_code, inputs)
+    if entry is not None and job.pipeline.source.remote and manifest.is_fresh(entry):
+        if await restore_bundle_row(entry, bundle_code, product_codes, job, "restored"):
+            for product_code in products:
+                fetcher.release(product_code)
+            return entry.bundle_row, []
+
+    results = await asyncio.gather(*[fetcher.fetch(product_code) for product_code in products])
+    fetched = dict(zip(products, results))
+    sources = await asyncio.to_thread(source_hashes, {
+        product_code: result if isinstance(result, dict) else ({used_ext: result} if result else {})
+        for product_code, (result, used_ext) in fetched.items()
+    })
+    if entry is not None:
+        if entry.sources == sources and await restore_bundle_row(entry, bundle_code, product_codes, job, "verified"):
+            await asyncio.to_thread(manifest.touch, entry)
+            return entry.bundle_row, []
+        job.metrics.inc("manifest", outcome="changed")
+
+    async def prefetched(product_code):
+        return fetched[product_code]
+
+    outputs = []
+    bundle_row, errors = await build_bundle_row(bundle_code, product_codes, job, prefetched, outputs)
+    # I bundle con immagini mancanti o download falliti vengono rielaborati alla prossima esecuzione
+    if not errors and all(used_ext != DOWNLOAD_FAILED for _, used_ext in fetched.values()):
+        await asyncio.to_thread(manifest.record, bundle_code, inputs, sources, bundle_row, outputs)
+        job.metrics.inc("manifest", outcome="recorded")
+    return bundle_row, errors
+
+async def restore_bundle_row(entry, bundle_code, product_codes, job, outcome):
+    """Ricopia nello ZIP i file di una voce del manifest; False se non sono più disponibili."""
+    files = await asyncio.to_thread(job.pipeline.manifest.read_outputs, entry)
+    if files is None:
+        return False
+    job.writer.add_dir(bundle_folder(bundle_code, product_codes, job.fallback_ext))
+    for arcname, data in files:
+        await async_write_file(arcname, data, job)
+    job.metrics.inc("manifest", outcome=outcome)
+    job.metrics.inc("bundles", type="mixed" if len(set(product_codes)) != 1 else f"bundle_{len(product_codes)}")
+    return True
+
+async def build_bundle_row(bundle_code, product_codes, job, fetch=None, outputs=None):
+    """Scarica, compone e aggiunge allo ZIP del job le immagini di una riga del CSV.
+
+    fetch (default job.fetcher.fetch) restituisce (immagine, estensione usata) per un
+    prodotto; outputs, se è una lista, riceve i file scritti. Restituisce la riga per
+    bundle_list.csv e la lista degli errori (bundle_code, product_code).
+    """
+    errors = []
+    fetch = fetch or job.fetcher.fetch
+    writer = job.writer
+    fallback_ext = job.fallback_ext
+    num_products = len(product_codes)
+    is_uniform = (len(set(product_codes)) == 1)
+    bundle_type = f"bundle of {num_products}" if is_uniform else "mixed"
+    bundle_cross_country = False
+
+    if is_uniform:
+        product_code = product_codes[0]
+        # Imposta la cartella di destinazione per il bundle
+        folder_name = bundle_folder(bundle_code, product_codes, fallback_ext)
+        if folder_name == "cross-country":
+            bundle_cross_country = True
+        writer.add_dir(folder_name)
+
+        result, used_ext = await fetch(product_code)
+        if fallback_ext != "NL FR" and used_ext in CROSS_COUNTRY_EXTS:
+            bundle_cross_country = True
+            folder_name = "cross-country"
+            writer.add_dir(folder_name)
+
+        if used_ext == "NL FR" and isinstance(result, dict):
+            # Elaborazione delle immagini NL FR
+            images = [(image_data, "-p1-fr" if lang == "1-fr" else "-p1-nl") for lang, image_data in result.items()]
+        elif result:
+            # Fallback standard: una sola immagine, rinomina come -h1
+            images = [(result, "-h1")]
+        else:
+            images = []
+            if used_ext != DOWNLOAD_FAILED:
+                errors.append((bundle_code, product_code))
+
+        for image_data, suffix in images:
+            extension = bundle_extension(image_data, num_products, job.encoding_profile)
+            arcname = f"{folder_name}/{bundle_code}{suffix}{extension}"
+            try:
+                await async_write_bundle_image(image_data, num_products, arcname, job, outputs)
+            except Exception as e:
+                job.report_error(f"Error processing image for bundle {bundle_code}: {e}")
+                job.metrics.inc("errors", kind="compose")
+                errors.append((bundle_code, product_code))
+
+    else:
+        set_folder = bundle_folder(bundle_code, product_codes, fallback_ext)
+        writer.add_dir(set_folder)
+        # I prodotti del set vengono scaricati in parallelo, poi salvati nell'ordine del CSV
+        fetched = await asyncio.gather(*[fetch(product_code) for product_code in product_codes])
+        for product_code, (result, used_ext) in zip(product_codes, fetched):
+            if fallback_ext == "NL FR":
+                if used_ext == "NL FR" and isinstance(result, dict):
+                    for lang, image_data in result.items():
+                        suffix = "-p1-fr" if lang == "1-fr" else "-p1-nl"
+                        prod_folder = f"{set_folder}/cross-country" if lang in CROSS_COUNTRY_EXTS else set_folder
+                        writer.add_dir(prod_folder)
+                        arcname = f"{prod_folder}/{product_code}{suffix}.jpg"
+                        await async_write_file(arcname, image_data, job, outputs)
+                elif result:
+                    suffix = "-h1"
+                    prod_folder = f"{set_folder}/cross-country" if used_ext in CROSS_COUNTRY_EXTS else set_folder
+                    writer.add_dir(prod_folder)
+                    arcname = f"{prod_folder}/{product_code}{suffix}.jpg"
+                    await async_write_file(arcname, result, job, outputs)
+                elif used_ext != DOWNLOAD_FAILED:
+                    errors.append((bundle_code, product_code))
+            else:
+                if used_ext in CROSS_COUNTRY_EXTS:
+                    bundle_cross_country = True
+                if result:
+                    prod_folder = f"{set_folder}/cross-country" if used_ext in CROSS_COUNTRY_EXTS else set_folder
+                    writer.add_dir(prod_folder)
+                    arcname = f"{prod_folder}/{product_code}.jpg"
+                    await async_write_file(arcname, result, job, outputs)
+                elif used_ext != DOWNLOAD_FAILED:
+                    errors.append((bundle_code, product_code))
+
+    job.metrics.inc("bundles", type="mixed" if not is_uniform else f"bundle_{num_products}")
+    if errors:
+        job.metrics.inc("missing_images", len(errors))  # voci di missing_images.csv
+    bundle_row = [bundle_code, ', '.join(product_codes), bundle_type, "Yes" if bundle_cross_country else "No"]
+    return bundle_row, errors
+
+# ---------------------- Pianificazione ----------------------
+class BundlePlan:
+    """Piano di lavoro di un job, costruito prima di qualsiasi richiesta di rete.
+
+    Per ogni riga tiene solo lo SKU e la lista normalizzata dei product code come
+    stringhe (niente liste o tuple per riga): la lista viene divisa quando la riga
+    viene elaborata. product_uses conta quante volte ogni product code verrà richiesto,
+    cioè il piano di download deduplicato (un download per prodotto, rilasciato dopo
+    l'ultimo uso).
+    """
+
+    UNIFORM_PATTERN = r'([^,]*)(?:,\1)*'
+
+    def __init__(self):
+        self.skus = []
+        self.pzns = []
+        self.product_uses = Counter()
+        self.uniform_rows = 0
+        self.mixed_rows = 0
+        self._repeated = None
+
+    @property
+    def rows(self):
+        return len(self.skus)
+
+    @property
+    def distinct_products(self):
+        return len(self.product_uses)
+
+    def add_chunk(self, chunk):
+        """Aggiunge un blocco del CSV: normalizzazione, classificazione e conteggi sono per colonna."""
+        chunk = chunk[list(REQUIRED_COLUMNS)].dropna()
+        if chunk.empty:
+            return
+        skus = chunk['sku'].str.strip()
+        pzns = chunk['pzns_in_set'].str.strip()
+        # Come strip() su ogni codice: toglie gli spazi attorno alle virgole
+        spaced = pzns.str.contains(r'\s', regex=True)
+        if spaced.any():
+            pzns = pzns.where(~spaced, pzns[spaced].str.replace(r'\s*,\s*', ',', regex=True))
+        # Bundle uniforme: la lista è lo stesso codice ripetuto N volte
+        uniform = pzns.str.fullmatch(self.UNIFORM_PATTERN).astype(bool)
+        for value, count in pzns[uniform].value_counts().items():
+            self.product_uses[value.split(',', 1)[0]] += count
+        mixed = pzns[~uniform]
+        self.product_uses.update(mixed.str.split(',').explode().value_counts().to_dict())
+        self.uniform_rows += len(pzns) - len(mixed)
+        self.mixed_rows += len(mixed)
+        self.skus.extend(skus.tolist())
+        self.pzns.extend(pzns.tolist())
+        self._repeated = None
+
+    def item(self, index):
+        """(bundle_code, product_codes) della riga index."""
+        return self.skus[index], self.pzns[index].split(',')
+
+    def subset(self, indices):
+        """Piano con le sole righe indicate, nell'ordine dato, e i conteggi ricalcolati (vedi sharded_pipeline)."""
+        plan = BundlePlan()
+        for index in indices:
+            plan.skus.append(self.skus[index])
+            plan.pzns.append(self.pzns[index])
+            product_codes = self.pzns[index].split(',')
+            if len(set(product_codes)) == 1:
+                plan.product_uses[product_codes[0]] += 1
+                plan.uniform_rows += 1
+            else:
+                plan.product_uses.update(product_codes)
+                plan.mixed_rows += 1
+        return plan
+
+    def groups(self):
+        """Indici delle righe raggruppati per SKU, nell'ordine di prima apparizione.
+
+        Le righe con lo stesso SKU scrivono sugli stessi file: elaborandole in sequenza
+        nello stesso gruppo (dall'ultima, vedi run_bundle_scheduler) nello ZIP restano
+        i file dell'ultima riga come nell'elaborazione seriale.
+        """
+        if self._repeated is None:
+            duplicated = pd.Series(self.skus).duplicated(keep=False).to_numpy().nonzero()[0]
+            self._repeated = {}
+            for index in duplicated.tolist():
+                self._repeated.setdefault(self.skus[index], []).append(index)
+        for index, sku in enumerate(self.skus):
+            group = self._repeated.get(sku)
+            if group is None:
+                yield (index,)
+            elif group[0] == index:
+                yield group
+
+def plan_bundle_csv(source, chunksize=DEFAULT_CSV_CHUNKSIZE):
+    """Legge l'export Akeneo (percorso, file-like o DataFrame) a blocchi e restituisce il BundlePlan.
+
+    Del CSV resta in memoria un solo blocco alla volta. Solleva ValueError se mancano le
+    colonne richieste o se il file è vuoto.
+    """
+    plan = BundlePlan()
+    if isinstance(source, pd.DataFrame):
+        reader = nullcontext([source])
+    else:
+        reader = pd.read_csv(source, delimiter=';', dtype=object, chunksize=chunksize)
+    with reader as chunks:
+        for chunk in chunks:
+            missing_columns = REQUIRED_COLUMNS - set(chunk.columns)
+            if missing_columns:
+                raise ValueError(f"Missing required columns: {', '.join(missing_columns)}")
+            plan.add_chunk(chunk)
+    if not plan.rows:
+        raise ValueError("The CSV file is empty!")
+    return plan
+
+async def run_bundle_scheduler(plan, job, progress=None, on_result=None):
+    """Elabora i bundle del piano con un numero limitato di worker; i risultati restano nell'ordine del CSV.
+
+    progress, se indicato, viene chiamato con (bundle completati, totale); on_result con
+    (riga di bundle_list, errori) di ogni bundle appena completato.
+    """
+    total = plan.rows
+    results = [None] * total
+    groups = plan.groups()
+    completed = 0
+
+    async def worker():
+        nonlocal completed
+        # L'iteratore è condiviso: ogni worker preleva il prossimo gruppo libero. Le righe con
+        # lo stesso SKU vanno dall'ultima alla prima: lo ZIP tiene la prima scrittura di ogni
+        # file, cioè quella dell'ultima riga, come nell'elaborazione seriale
+        for group in groups:
+            for i in reversed(group):
+                _current_row.set(i)
+                results[i] = await process_bundle_row(*plan.item(i), job)
+                job.writer.complete(i)
+                completed += 1
+                if on_result is not None:
+                    on_result(*results[i])
+                if progress is not None:
+                    progress(completed, total)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(job.limits.max_bundles, total))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        job.fetcher.cancel()
+        raise
+    return results
+
+# ---------------------- Report ----------------------
+def build_reports(results):
+    """Costruisce le tabelle di bundle_list.csv e missing_images.csv dai risultati in ordine."""
+    error_list = []      # Lista di tuple: (bundle_code, product_code)
+    bundle_list = []     # Dettagli: bundle code, lista di product codes, tipo di bundle, flag cross-country
+    for bundle_row, errors in results:
+        bundle_list.append(bundle_row)
+        error_list.extend(errors)
+
+    missing_images_df = missing_images_table(error_list)
+    bundle_list_df = pd.DataFrame(bundle_list, columns=["sku", "pzns_in_set", "bundle type", "cross-country"])
+    return bundle_list_df, missing_images_df
+
+def missing_images_table(error_list):
+    """Tabella di missing_images.csv da una lista di (bundle_code, product_code)."""
+    if not error_list:
+        return pd.DataFrame(columns=["PZN Bundle", "PZN with image missing"])
+    missing_images_df = pd.DataFrame(error_list, columns=["PZN Bundle", "PZN with image missing"])
+    return missing_images_df.groupby("PZN Bundle", as_index=False).agg({
+        "PZN with image missing": lambda x: ', '.join(x)
+    })
+
+def derive_missing_images(plan, fallback_ext, index):
+    """Ricostruisce missing_images.csv dall'indice di disponibilità, senza richieste di rete.
+
+    Un prodotto è mancante se tutte le sue varianti (vedi fallback_tiers) sono note come
+    assenti. Restituisce la tabella e i prodotti con varianti non ancora verificate, per i
+    quali serve refresh_availability o un job completo.
+    """
+    extensions = [ext for _, tier_extensions in fallback_tiers(fallback_ext) for ext in tier_extensions]
+    known = index.lookup_many(plan.product_uses)
+    missing = set()
+    unknown = []
+    for product_code in plan.product_uses:
+        variants = known.get(product_code, {})
+        if any(variants.get(ext) for ext in extensions):
+            continue
+        if all(variants.get(ext) is False for ext in extensions):
+            missing.add(product_code)
+        else:
+            unknown.append(product_code)
+    error_list = []
+    for i in range(plan.rows):
+        bundle_code, product_codes = plan.item(i)
+        # Come build_bundle_row: un bundle uniforme segnala il prodotto una volta sola
+        if len(set(product_codes)) == 1:
+            product_codes = product_codes[:1]
+        error_list.extend((bundle_code, product_code) for product_code in product_codes if product_code in missing)
+    return missing_images_table(error_list), unknown
+
+# ---------------------- Pipeline ----------------------
+class BundlePipeline:
+    """Risorse condivise tra più job: sessione HTTP, cache e pool di composizione.
+
+    Va usata come context manager asincrono; più CSV elaborati con la stessa istanza
+    condividono il pool di connessioni, le cache e i processi di composizione.
+    Se compose_executor non è indicato, la pipeline crea il proprio pool e lo chiude
+    all'uscita. image_cache e result_cache a None disattivano le rispettive cache.
+    metrics_hook, se indicato, riceve il JobMetrics di ogni job concluso (es. per un
+    exporter Prometheus, vedi JobMetrics.to_prometheus).
+    manifest (JobManifest), se indicato, rende i job riprendibili e incrementali: i bundle
+    già elaborati con gli stessi input e le stesse immagini sorgente vengono ricopiati.
+    Le richieste al CDN passano da un CdnClient con retry e limite di concorrenza adattivo
+    (limiter, default AdaptiveLimiter fino a connector_limit), condiviso tra i job: la
+    concorrenza raggiunta viene riportata nelle statistiche di ogni job.
+    availability_index (AvailabilityIndex), se indicato, evita di richiedere le varianti
+    già note come assenti e registra l'esito di ogni verifica (vedi refresh_availability).
+    source, se indicato, sostituisce il CDN come sorgente delle immagini (es. una cartella
+    mirror o un archivio, vedi image_sources); le sorgenti locali non passano dalla cache
+    immagini e non aggiornano l'indice di disponibilità.
+    """
+
+    def __init__(self, image_cache=None, result_cache=None, compose_executor=None,
+                 connector_limit=DEFAULT_CONNECTOR_LIMIT, metrics_hook=None, manifest=None, limiter=None,
+                 availability_index=None, source=None):
+        self.image_cache = image_cache
+        self.local_source = source
+        self.result_cache = result_cache
+        self.manifest = manifest
+        self.availability_index = availability_index
+        self.compose_executor = compose_executor
+        self._owns_executor = compose_executor is None
+        self.connector_limit = connector_limit
+        self.metrics_hook = metrics_hook
+        self.limiter = limiter
+        self.session = None
+        self.client = None
+        self.source = None
+
+    async def __aenter__(self):
+        if self.compose_executor is None:
+            self.compose_executor = create_process_pool()
+        self.session = create_session(self.connector_limit)
+        if self.limiter is None:
+            self.limiter = AdaptiveLimiter(maximum=self.connector_limit)
+        self.client = CdnClient(self.session, self.limiter)
+        self.source = self.local_source or CdnSource(self.client, CDN_URL, self.image_cache)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        self.session = None
+        self.client = None
+        self.source = None
+        if self._owns_executor:
+            self.compose_executor.shutdown()
+            self.compose_executor = None
+
+    async def run(self, source, options, progress=None, on_error=None, events=None):
+        """Elabora un CSV (percorso, file-like, DataFrame o BundlePlan già pronto) e restituisce un JobResult.
+
+        on_error riceve i messaggi degli errori non bloccanti (immagini non elaborabili).
+        events (vedi job_events.JobEvents) riceve avanzamento, errori e bundle completati e
+        permette di scaricare uno ZIP parziale, oltre a progress e on_error se indicati.
+        """
+        if events is not None:
+            progress = fan_out(progress, events.progress)
+            on_error = fan_out(on_error, events.error)
+        metrics = JobMetrics()
+        with metrics.timer("load_csv"):
+            plan = source if isinstance(source, BundlePlan) else await asyncio.to_thread(plan_bundle_csv, source)
+        for path in (options.zip_path, options.bundle_list_path, options.missing_images_path, options.metrics_path):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+        limits = options.create_limits()
+        # L'indice descrive il CDN: una sorgente locale non lo consulta né lo aggiorna
+        index = self.availability_index if self.source.remote else None
+        fetcher = ProductFetcher(self.source, options.fallback_ext, limits, plan.product_uses, metrics, on_error,
+                                 options.fallback_strategy, index)
+        client_before = dict(self.client.stats)
+        image_cache_before = dict(self.image_cache.stats) if self.image_cache is not None else {}
+        # Le immagini vengono aggiunte allo ZIP man mano che i bundle sono pronti
+        writer = StreamingZipWriter(options.zip_path)
+        job = BundleJob(self, options, fetcher, writer, limits, on_error)
+        if events is not None:
+            events.writer = writer
+        try:
+            results = await run_bundle_scheduler(plan, job, progress, events.result if events is not None else None)
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            if self.availability_index is not None:
+                await asyncio.to_thread(self.availability_index.flush)
+            # Accessi LRU delle cache tenuti in memoria durante il job
+            for cache in (self.image_cache, self.result_cache, self.manifest):
+                if cache is not None:
+                    await asyncio.to_thread(cache.flush)
+        with metrics.timer("zip_finalize"):
+            await asyncio.to_thread(writer.close)
+        metrics.inc("zip_bytes", os.path.getsize(options.zip_path))
+
+        with metrics.timer("reports"):
+            bundle_list_df, missing_images_df = build_reports(results)
+            missing_images_df.to_csv(options.missing_images_path, index=False, sep=';')
+            bundle_list_df.to_csv(options.bundle_list_path, index=False, sep=';')
+
+        # La cache immagini può essere condivisa con altri job contemporanei: il delta è indicativo
+        for outcome, value in (self.image_cache.stats.items() if self.image_cache is not None else ()):
+            if value - image_cache_before.get(outcome, 0):
+                metrics.inc("image_cache", value - image_cache_before.get(outcome, 0), outcome=outcome)
+        for name in ("retries", "failures"):
+            if self.client.stats[name] - client_before[name]:
+                metrics.inc(f"cdn_{name}", self.client.stats[name] - client_before[name])
+        metrics.set("cdn_concurrency", self.limiter.current)
+        metrics.set("cdn_concurrency_peak", int(self.limiter.stats["peak"]))
+        metrics.inc("saved_fetches", fetcher.saved_fetches)
+        metrics.inc("saved_requests", fetcher.saved_requests)
+        metrics.finish()
+        await asyncio.to_thread(metrics.write, options.metrics_path, options.metrics_json_path)
+        if self.metrics_hook is not None:
+            try:
+                self.metrics_hook(metrics)
+            except Exception as e:
+                job.report_error(f"Metrics hook failed: {e}")
+
+        stats = {
+            "bundles": len(results),
+            "saved_fetches": fetcher.saved_fetches,
+            "saved_requests": fetcher.saved_requests,
+            "results_reused": metrics.counter("result_cache", outcome="hit"),
+            "bundles_restored": metrics.counter("manifest", outcome="restored")
+                                + metrics.counter("manifest", outcome="verified"),
+            "cdn_concurrency": self.limiter.current,
+            "cdn_retries": metrics.counter("cdn_retries"),
+            "download_failures": metrics.counter("errors", kind="download"),
+            "requests_skipped": metrics.counter("requests", outcome="known_missing"),
+            # Tempi cumulativi: somma delle durate delle singole operazioni concorrenti
+            "download_seconds": metrics.seconds("download"),
+            "compose_seconds": metrics.seconds("compose_job"),
+            "write_seconds": metrics.seconds("write"),
+        }
+        return JobResult(options.zip_path, options.bundle_list_path, options.missing_images_path,
+                         bundle_list_df, missing_images_df, stats, metrics, options.metrics_path)
+
+    async def refresh_availability(self, product_codes, fallback_ext=None, concurrency=DEFAULT_DOWNLOAD_LIMIT,
+                                   progress=None):
+        """Riverifica sul CDN le varianti di fallback dei prodotti e aggiorna l'indice di disponibilità.
+
+        Usa sonde HEAD (GET dove non supportate) senza passare dalla cache immagini, con
+        al più concurrency verifiche in corso oltre al limite adattivo del client.
+        progress, se indicato, riceve (verifiche completate, totale). Restituisce i
+        contatori "present", "missing" e "failed".
+        """
+        index = self.availability_index
+        if index is None:
+            raise ValueError("refresh_availability requires an availability_index")
+        extensions = [ext for _, tier_extensions in fallback_tiers(fallback_ext) for ext in tier_extensions]
+        # Sempre il CDN, anche se la pipeline legge le immagini da una sorgente locale
+        cdn = CdnSource(self.client, CDN_URL)
+        product_codes = list(dict.fromkeys(product_codes))
+        total = len(product_codes) * len(extensions)
+        checks = ((product_code, ext) for product_code in product_codes for ext in extensions)
+        stats = Counter(present=0, missing=0, failed=0)
+        completed = 0
+
+        async def worker():
+            nonlocal completed
+            for product_code, ext in checks:
+                try:
+                    present = await async_probe_image(product_code, ext, cdn)
+                    if present is None:
+                        content, _ = await async_download_image(product_code, ext, cdn)
+                        present = content is not None
+                except CdnError:
+                    stats["failed"] += 1
+                else:
+                    present = present is not False
+                    await record_availability(index, product_code, ext, present)
+                    stats["present" if present else "missing"] += 1
+                completed += 1
+                if progress is not None:
+                    progress(completed, total)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, total)))))
+        finally:
+            await asyncio.to_thread(index.flush)
+        return dict(stats)
+
+    async def fetch_preview(self, product_code, extension, thumbnail_size=None):
+        """Legge un'immagine per l'anteprima dalla sorgente della pipeline (CDN con cache o locale).
+
+        Restituisce i byte (o, con thumbnail_size, una miniatura JPEG ottenuta con una
+        decodifica ridotta) oppure None se l'immagine non esiste; solleva CdnError se il
+        CDN non ha dato una risposta definitiva.
+        """
+        content = await self.source.fetch(product_code, extension)
+        if content is None or thumbnail_size is None:
+            return content
+        return await asyncio.to_thread(make_thumbnail, content, thumbnail_size)
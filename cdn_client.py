@@ -0,0 +1,165 @@
+"""Client HTTP per il CDN delle immagini: concorrenza adattiva (AIMD), timeout e retry con backoff.
+
+Le risposte definitive (200, 304, 404 e gli altri 4xx) vengono restituite al chiamante;
+429, 5xx, timeout ed errori di connessione sono considerati transitori e ritentati con
+backoff esponenziale e jitter. Se i tentativi si esauriscono viene sollevato CdnError:
+l'immagine non è "mancante", semplicemente non è stato possibile verificarla.
+"""
+import os
+import time
+import random
+import asyncio
+import aiohttp
+
+# ---------------------- Configurazione ----------------------
+DEFAULT_INITIAL_CONCURRENCY = 16  # richieste contemporanee all'avvio
+DEFAULT_MIN_CONCURRENCY = 2
+DEFAULT_MAX_CONCURRENCY = 100     # non oltre il pool di connessioni
+DEFAULT_ATTEMPTS = int(os.environ.get("BUNDLE_CDN_ATTEMPTS", 5))
+DEFAULT_BASE_DELAY = 0.25         # primo intervallo di backoff in secondi
+DEFAULT_MAX_DELAY = 8.0
+# Timeout per singolo tentativo: connessione e lettura di ogni blocco del corpo
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10, sock_connect=10, sock_read=20)
+DNS_CACHE_SECONDS = 300
+KEEPALIVE_SECONDS = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class CdnError(Exception):
+    """Il CDN non ha dato una risposta definitiva dopo tutti i tentativi."""
+
+class CdnResponse:
+    """Risposta già letta: stato, corpo e intestazioni."""
+
+    def __init__(self, status, body, headers):
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+class AdaptiveLimiter:
+    """Limite di concorrenza AIMD.
+
+    Ogni risposta sana (latenza entro latency_tolerance volte la latenza di base) aumenta
+    il limite di 1/limite, cioè di circa una richiesta per "giro" di richieste; un 429, un
+    5xx o un timeout lo moltiplicano per backoff_factor, al più una volta per cooldown
+    secondi, così una raffica di errori dovuta allo stesso sovraccarico conta una volta sola.
+    La latenza di base è la minima osservata, che risale lentamente per seguire la rete.
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, minimum=DEFAULT_MIN_CONCURRENCY,
+                 maximum=DEFAULT_MAX_CONCURRENCY, backoff_factor=0.7, latency_tolerance=2.0, cooldown=1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.baseline = None
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+        self.stats = {"increases": 0, "decreases": 0, "peak": self.limit}
+
+    @property
+    def current(self):
+        """Richieste contemporanee consentite in questo momento."""
+        return max(self.minimum, int(self.limit))
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += (latency - self.baseline) * 0.01
+        if latency <= self.baseline * self.latency_tolerance and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.stats["increases"] += 1
+            self.stats["peak"] = max(self.stats["peak"], self.limit)
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.backoff_factor)
+        self.stats["decreases"] += 1
+
+def retry_delay(attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, retry_after=None):
+    """Backoff esponenziale con "full jitter"; Retry-After, se presente, fa da minimo."""
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(max_delay, float(retry_after)))
+        except ValueError:
+            pass  # Retry-After in formato data: si usa il backoff calcolato
+    return delay
+
+class CdnClient:
+    """GET verso il CDN con limite adattivo e retry; condiviso da tutti i job della pipeline."""
+
+    def __init__(self, session, limiter=None, attempts=DEFAULT_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.session = session
+        self.limiter = limiter or AdaptiveLimiter()
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+
+    async def _attempt(self, method, url, headers):
+        await self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, url, headers=headers) as response:
+                body = await response.read() if response.status == 200 and method != "HEAD" else b""
+                return CdnResponse(response.status, body, response.headers), time.perf_counter() - start
+        finally:
+            await self.limiter.release()
+
+    async def get(self, url, headers=None):
+        return await self.request("GET", url, headers)
+
+    async def head(self, url, headers=None):
+        return await self.request("HEAD", url, headers)
+
+    async def request(self, method, url, headers=None):
+        """Restituisce la prima risposta definitiva; solleva CdnError dopo l'ultimo tentativo fallito.
+
+        Il corpo viene letto solo per le risposte 200 alle richieste GET.
+        """
+        last_error = None
+        for attempt in range(self.attempts):
+            if attempt:
+                self.stats["retries"] += 1
+                retry_after = getattr(last_error, "retry_after", None)
+                await asyncio.sleep(retry_delay(attempt - 1, self.base_delay, self.max_delay, retry_after))
+            self.stats["requests"] += 1
+            try:
+                response, latency = await self._attempt(method, url, headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.limiter.on_overload()
+                last_error = e
+                continue
+            if response.status in RETRY_STATUSES:
+                self.limiter.on_overload()
+                last_error = CdnError(f"HTTP {response.status}")
+                last_error.retry_after = response.headers.get("Retry-After")
+                continue
+            self.limiter.on_success(latency)
+            return response
+        self.stats["failures"] += 1
+        raise CdnError(f"{url}: {last_error or 'no response'} after {self.attempts} attempts")
+
+def create_session(connector_limit=DEFAULT_MAX_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+    """Sessione aiohttp con connessioni keep-alive e cache DNS."""
+    connector = aiohttp.TCPConnector(limit=connector_limit, ttl_dns_cache=DNS_CACHE_SECONDS,
+                                     keepalive_timeout=KEEPALIVE_SECONDS)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
@@ -0,0 +1,378 @@
+import os
+import math
+import time
+import hashlib
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageChops
+
+# ---------------------- Configurazione ----------------------
+CANVAS_SIZE = 1000          # lato della tela finale in pixel
+MAX_COMPOSED_COPIES = 6     # oltre questo numero l'immagine non viene composta
+LAYOUTS = ["horizontal", "vertical", "automatic", "grid"]
+TRIM_TOLERANCE = 0          # scarto massimo dal bianco (0-255) considerato ancora sfondo
+PREVIEW_REDUCTION = 8       # riduzione DCT usata per stimare il riquadro prima della decodifica
+DRAFT_OVERSAMPLING = 1      # risoluzione decodificata minima rispetto alla tessera finale
+THUMBNAIL_SIZE = 200        # lato massimo delle miniature della galleria di anteprima
+# Da incrementare quando cambia l'output della composizione, per invalidare la cache dei risultati
+COMPOSITING_VERSION = 2
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+class EncodingProfile:
+    """Impostazioni di codifica delle immagini composte (formato, qualità, opzioni del codificatore).
+
+    subsampling segue Pillow: 0 = 4:4:4, 1 = 4:2:2, 2 = 4:2:0, None = scelta di Pillow.
+    """
+
+    def __init__(self, name, format="JPEG", quality=90, progressive=False, optimize=False, subsampling=None,
+                 method=4):
+        self.name = name
+        self.format = format
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling
+        self.method = method  # solo WebP: sforzo di compressione 0-6
+
+    @property
+    def extension(self):
+        return ".webp" if self.format == "WEBP" else ".jpg"
+
+    def save_options(self):
+        if self.format == "WEBP":
+            return {"quality": self.quality, "method": self.method}
+        options = {"quality": self.quality, "optimize": self.optimize, "progressive": self.progressive}
+        if self.subsampling is not None:
+            options["subsampling"] = self.subsampling
+        return options
+
+    def key(self):
+        """Parte della chiave di cache: cambia se cambia il risultato della codifica."""
+        return f"{self.format}:q{self.quality}:p{int(self.progressive)}:o{int(self.optimize)}:" \
+               f"s{self.subsampling}:m{self.method}"
+
+ENCODING_PROFILES = {
+    # Qualità visivamente indistinguibile dalla sorgente, senza sottocampionamento del colore (testi nitidi)
+    "high": EncodingProfile("high", quality=92, optimize=True, subsampling=0),
+    # File leggeri per web e anteprime
+    "web": EncodingProfile("web", quality=85, progressive=True, optimize=True, subsampling=2),
+    # Comportamento storico: JPEG a qualità 100
+    "max": EncodingProfile("max", quality=100),
+    "webp": EncodingProfile("webp", format="WEBP", quality=85),
+}
+DEFAULT_ENCODING_PROFILE = os.environ.get("BUNDLE_ENCODING_PROFILE", "high")
+
+def encoding_profile(profile):
+    """EncodingProfile da un nome di ENCODING_PROFILES (o da un profilo già pronto)."""
+    if isinstance(profile, EncodingProfile):
+        return profile
+    try:
+        return ENCODING_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Unknown encoding profile: {profile}") from None
+
+def is_composed(copies):
+    return 2 <= copies <= MAX_COMPOSED_COPIES
+
+def is_passthrough(image_data, copies):
+    """True se l'immagine non viene modificata e i byte scaricati vanno copiati così come sono."""
+    return not is_composed(copies) and image_data[:3] == JPEG_MAGIC
+
+def bundle_extension(image_data, copies, profile=DEFAULT_ENCODING_PROFILE):
+    """Estensione del file di un bundle uniforme: quella della sorgente se copiata, altrimenti del profilo."""
+    return ".jpg" if is_passthrough(image_data, copies) else encoding_profile(profile).extension
+
+def find_bbox(im, tolerance=TRIM_TOLERANCE):
+    """Riquadro (left, top, right, bottom) dei pixel non bianchi, calcolato con numpy.
+
+    Un pixel è sfondo se nessun canale si discosta dal bianco più di `tolerance`; con
+    tolerance=0 il risultato coincide con ImageChops.difference(...).getbbox().
+    Restituisce None se l'immagine è completamente bianca.
+    """
+    arr = np.asarray(im)
+    darkest = arr.min(axis=2) if arr.ndim == 3 else arr
+    mask = darkest < 255 - tolerance
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def trim(im, tolerance=TRIM_TOLERANCE):
+    """Rimuove i bordi bianchi dall'immagine."""
+    if im.mode in ("RGB", "L"):
+        bbox = find_bbox(im, tolerance)
+    else:
+        bg = Image.new(im.mode, im.size, (255, 255, 255))
+        diff = ImageChops.difference(im, bg)
+        bbox = diff.getbbox()
+    if bbox:
+        return im.crop(bbox)
+    return im
+
+def resolve_layout(layout, copies, size):
+    """Traduce il layout scelto dall'utente nel layout effettivo: "horizontal", "vertical" o "grid".
+
+    In modalità "automatic" i bundle da 2 o 3 usano il layout verticale per le immagini
+    più larghe che alte e orizzontale negli altri casi; da 4 copie in su si usa la griglia.
+    Layout sconosciuti ricadono su "horizontal".
+    """
+    layout = (layout or "horizontal").lower()
+    width, height = size
+    if layout == "automatic":
+        if copies >= 4:
+            return "grid"
+        return "vertical" if height < width else "horizontal"
+    if layout in ("vertical", "grid"):
+        return layout
+    return "horizontal"
+
+def grid_shape(copies, layout, size):
+    """Restituisce (colonne, righe) per il layout effettivo.
+
+    Per la griglia sceglie la disposizione senza righe vuote che rende le copie più grandi
+    sulla tela quadrata; a parità preferisce meno celle vuote e poi più colonne.
+    """
+    if layout == "horizontal":
+        return copies, 1
+    if layout == "vertical":
+        return 1, copies
+    width, height = size
+    best, best_key = (copies, 1), None
+    for cols in range(copies, 0, -1):
+        rows = math.ceil(copies / cols)
+        if (rows - 1) * cols >= copies:
+            continue
+        scale = min(1 / (cols * width), 1 / (rows * height))
+        key = (scale, -(cols * rows))
+        if best_key is None or key > best_key:
+            best, best_key = (cols, rows), key
+    return best
+
+def compose_copies(image, copies, layout="horizontal"):
+    """Rimuove i bordi bianchi, affianca N copie dell'immagine e le ridimensiona su una tela 1000x1000."""
+    image = trim(image)
+    width, height = image.size
+    chosen_layout = resolve_layout(layout, copies, image.size)
+    cols, rows = grid_shape(copies, chosen_layout, image.size)
+    merged_width = width * cols
+    merged_height = height * rows
+    merged_image = Image.new("RGB", (merged_width, merged_height), (255, 255, 255))
+    for index in range(copies):
+        row, col = divmod(index, cols)
+        # L'ultima riga incompleta viene centrata
+        in_row = min(cols, copies - row * cols)
+        x_start = (cols - in_row) * width // 2
+        merged_image.paste(image, (x_start + col * width, row * height))
+
+    scale_factor = min(CANVAS_SIZE / merged_width, CANVAS_SIZE / merged_height)
+    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
+    resized_image = merged_image.resize(new_size, Image.LANCZOS)
+    final_image = Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255))
+    x_offset = (CANVAS_SIZE - new_size[0]) // 2
+    y_offset = (CANVAS_SIZE - new_size[1]) // 2
+    final_image.paste(resized_image, (x_offset, y_offset))
+    return final_image
+
+def _candidate_shapes(copies, layout, size, ambiguous):
+    """Disposizioni possibili per un riquadro di dimensioni stimate."""
+    shapes = {grid_shape(copies, resolve_layout(layout, copies, size), size)}
+    if ambiguous:
+        shapes.add(grid_shape(copies, "horizontal", size))
+        shapes.add(grid_shape(copies, "vertical", size))
+    return shapes
+
+def decode_for_tiles(image_data, copies, layout="horizontal", tolerance=TRIM_TOLERANCE):
+    """Decodifica un JPEG alla minima risoluzione sufficiente per le tessere finali.
+
+    Una prima decodifica a 1/8 (solo coefficienti DCT) stima il riquadro del prodotto;
+    da questo si ricava la scala massima a cui verrà disegnata ogni copia e si chiede a
+    Image.draft la riduzione più forte che resti sopra quella risoluzione.
+    Restituisce (immagine ritagliata, riduzione applicata) oppure None se l'immagine
+    non è un JPEG RGB/scala di grigi e va elaborata a piena risoluzione.
+    """
+    img = Image.open(BytesIO(image_data))
+    if img.format != "JPEG" or img.mode not in ("RGB", "L"):
+        return None
+    full_width, full_height = img.size
+
+    preview = Image.open(BytesIO(image_data))
+    preview.draft(preview.mode, (math.ceil(full_width / PREVIEW_REDUCTION), math.ceil(full_height / PREVIEW_REDUCTION)))
+    preview_reduction = full_width / preview.size[0]
+    bbox = find_bbox(preview, tolerance)
+    if bbox is None:
+        return None
+    # Stima prudente per difetto del riquadro: 2 pixel di anteprima di margine per lato
+    margin = 2 * preview_reduction
+    est_width = max(1.0, (bbox[2] - bbox[0]) * preview_reduction - 2 * margin)
+    est_height = max(1.0, (bbox[3] - bbox[1]) * preview_reduction - 2 * margin)
+    ambiguous = abs(est_width - est_height) <= 4 * margin
+    max_scale = max(
+        min(CANVAS_SIZE / (cols * est_width), CANVAS_SIZE / (rows * est_height))
+        for cols, rows in _candidate_shapes(copies, layout, (est_width, est_height), ambiguous)
+    )
+    draft_scale = max_scale * DRAFT_OVERSAMPLING
+    if draft_scale <= 0.5:
+        img.draft(img.mode, (math.ceil(full_width * draft_scale), math.ceil(full_height * draft_scale)))
+    reduction = full_width / img.size[0]
+
+    bbox = find_bbox(img, tolerance)
+    if bbox is None:
+        return None
+    tile = img.crop(bbox)
+    tile.load()
+    return tile, reduction
+
+def compose_tiles(tile, copies, layout="horizontal"):
+    """Compone N copie ridimensionando ogni tessera una sola volta alla dimensione finale.
+
+    Stessa geometria di compose_copies: i bordi delle tessere vengono arrotondati al pixel
+    della tela, così copie adiacenti non lasciano righe bianche né si sovrappongono, e il
+    parametro box di resize conserva la fase di campionamento sub-pixel del riferimento.
+    """
+    width, height = tile.size
+    chosen_layout = resolve_layout(layout, copies, tile.size)
+    cols, rows = grid_shape(copies, chosen_layout, tile.size)
+    merged_width = width * cols
+    merged_height = height * rows
+    scale_factor = min(CANVAS_SIZE / merged_width, CANVAS_SIZE / merged_height)
+    new_size = (int(merged_width * scale_factor), int(merged_height * scale_factor))
+    x_offset = (CANVAS_SIZE - new_size[0]) // 2
+    y_offset = (CANVAS_SIZE - new_size[1]) // 2
+
+    scale_x = new_size[0] / merged_width
+    scale_y = new_size[1] / merged_height
+
+    final_image = Image.new("RGB", (CANVAS_SIZE, CANVAS_SIZE), (255, 255, 255))
+    resized = {}
+    for index in range(copies):
+        row, col = divmod(index, cols)
+        in_row = min(cols, copies - row * cols)
+        origin_x = (cols - in_row) * width // 2 + col * width
+        origin_y = row * height
+        left, right = round(origin_x * scale_x), round((origin_x + width) * scale_x)
+        top, bottom = round(origin_y * scale_y), round((origin_y + height) * scale_y)
+        size = (max(1, right - left), max(1, bottom - top))
+        # Porzione della tessera che cade esattamente sui pixel interi della tela
+        box = (
+            min(max(left / scale_x - origin_x, 0.0), width),
+            min(max(top / scale_y - origin_y, 0.0), height),
+            min(max(right / scale_x - origin_x, 0.0), width),
+            min(max(bottom / scale_y - origin_y, 0.0), height),
+        )
+        key = (size, box)
+        if key not in resized:
+            resized[key] = tile.resize(size, Image.LANCZOS, box=box)
+        final_image.paste(resized[key], (x_offset + left, y_offset + top))
+    return final_image
+
+def compose_copies_fast(image_data, copies, layout="horizontal", tolerance=TRIM_TOLERANCE, timings=None):
+    """Variante veloce di compose_copies che lavora direttamente sui byte JPEG.
+
+    Decodifica in modalità draft, ritaglia con find_bbox e ridimensiona ogni tessera una
+    sola volta. Scarto rispetto a compose_copies (riferimento), misurato su packshot
+    sintetici da 800 a 3000 px con bundle da 2 a 6 in tutti i layout:
+      - geometria: il layout coincide; posizione e dimensione di ogni copia sulla tela
+        differiscono al più di 1 pixel, perché il riquadro viene trovato alla risoluzione
+        ridotta;
+      - valori dei pixel: differenza media per canale ≤ 5 livelli su 255 e 99,9° percentile
+        ≤ 150; gli scarti grandi sono sui contorni del prodotto e su linee sottili. Senza
+        riduzione draft (solo ridimensionamento per tessera) la media scende a ≤ 1 livello.
+    La modalità draft si applica quando la riduzione vale almeno 2; se in modalità "automatic"
+    il ritaglio ridotto è troppo vicino al quadrato per scegliere il layout con certezza, si
+    usa compose_copies a piena risoluzione.
+    timings, se indicato, riceve le durate in secondi di "decode" (decodifica e ritaglio)
+    e "compose"; il percorso di riferimento viene registrato tutto come "compose".
+    """
+    start = time.perf_counter()
+    decoded = decode_for_tiles(image_data, copies, layout, tolerance)
+    if decoded is not None:
+        tile, reduction = decoded
+        if reduction > 1 and (layout or "").lower() == "automatic" and copies < 4 \
+                and abs(tile.size[0] - tile.size[1]) <= 2:
+            decoded = None
+    if decoded is None:
+        img = compose_copies(Image.open(BytesIO(image_data)), copies, layout)
+        if timings is not None:
+            timings["compose"] = time.perf_counter() - start
+        return img
+    decoded_at = time.perf_counter()
+    img = compose_tiles(tile, copies, layout)
+    if timings is not None:
+        timings["decode"] = decoded_at - start
+        timings["compose"] = time.perf_counter() - decoded_at
+    return img
+
+def compose_bundle(image_data, copies, layout="horizontal", profile=DEFAULT_ENCODING_PROFILE, fast=True,
+                   timings=None):
+    """Decodifica i byte dell'immagine, compone il bundle e lo codifica secondo il profilo.
+
+    Pensata per girare in un processo worker: riceve e restituisce solo byte, così tra i
+    processi non vengono serializzate immagini PIL decodificate.
+    Con fast=True usa compose_copies_fast, altrimenti l'implementazione di riferimento.
+    Bundle da 1 o con più di MAX_COMPOSED_COPIES copie non vengono modificati: i JPEG
+    sono restituiti byte per byte, gli altri formati vengono solo ricodificati.
+    timings, se indicato, riceve le durate per fase ("decode", "compose", "encode").
+    """
+    if is_passthrough(image_data, copies):
+        return image_data
+    profile = encoding_profile(profile)
+    start = time.perf_counter()
+    if is_composed(copies):
+        if fast:
+            img = compose_copies_fast(image_data, copies, layout, timings=timings)
+        else:
+            img = compose_copies(Image.open(BytesIO(image_data)), copies, layout)
+            if timings is not None:
+                timings["compose"] = time.perf_counter() - start
+    else:
+        img = Image.open(BytesIO(image_data))
+    encode_start = time.perf_counter()
+    output = BytesIO()
+    img.save(output, profile.format, **profile.save_options())
+    if timings is not None:
+        timings["encode"] = time.perf_counter() - encode_start
+    return output.getvalue()
+
+def compose_bundle_timed(image_data, copies, layout="horizontal", profile=DEFAULT_ENCODING_PROFILE, fast=True):
+    """Come compose_bundle, ma restituisce (byte, durate per fase) per le metriche del job."""
+    timings = {}
+    encoded = compose_bundle(image_data, copies, layout, profile, fast, timings)
+    return encoded, timings
+
+def result_key(image_data, copies, layout="horizontal", profile=DEFAULT_ENCODING_PROFILE, fast=True):
+    """Chiave della cache dei risultati per compose_bundle.
+
+    Con l'hash della sorgente fissato, il layout normalizzato determina in modo univoco
+    il layout effettivo scelto da resolve_layout.
+    """
+    source_hash = hashlib.sha256(image_data).hexdigest()
+    layout = (layout or "horizontal").lower() if is_composed(copies) else "-"
+    return f"v{COMPOSITING_VERSION}:{source_hash}:{copies}:{layout}:{encoding_profile(profile).key()}:" \
+           f"{'fast' if fast else 'exact'}"
+
+def make_thumbnail(image_data, size=THUMBNAIL_SIZE):
+    """Miniatura JPEG di al più size x size pixel.
+
+    Per i JPEG Image.draft fa decodificare al decoder solo la riduzione DCT (1/2 ... 1/8)
+    più vicina alla dimensione richiesta, senza passare dall'immagine a piena risoluzione.
+    """
+    img = Image.open(BytesIO(image_data))
+    img.draft("RGB", (size, size))
+    img = img.convert("RGB")
+    img.thumbnail((size, size))
+    output = BytesIO()
+    img.save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+def create_process_pool(max_workers=None):
+    """Crea il pool di processi per la composizione, dimensionato sui core della macchina.
+
+    Usa il metodo "spawn": il server Streamlit è multi-thread e fork non è sicuro.
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
@@ -0,0 +1,297 @@
+import os
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+import tempfile
+
+# ---------------------- Configurazione ----------------------
+# Cartella della cache condivisa tra esecuzioni e sessioni
+DEFAULT_CACHE_DIR = os.environ.get("BUNDLE_IMAGE_CACHE_DIR", ".image_cache")
+# Dimensione massima dei blob in cache (default 2 GB)
+DEFAULT_MAX_BYTES = int(os.environ.get("BUNDLE_IMAGE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Per quanti secondi una voce è considerata fresca e non viene rivalidata col CDN
+DEFAULT_MAX_AGE = int(os.environ.get("BUNDLE_IMAGE_CACHE_MAX_AGE", 24 * 3600))
+# Cartella e dimensione massima della cache delle immagini composte (default 1 GB)
+DEFAULT_RESULT_CACHE_DIR = os.environ.get("BUNDLE_RESULT_CACHE_DIR", ".result_cache")
+DEFAULT_RESULT_MAX_BYTES = int(os.environ.get("BUNDLE_RESULT_CACHE_MAX_BYTES", 1024 ** 3))
+# Letture i cui accessi LRU restano in memoria prima di essere scritti nell'indice
+ACCESS_FLUSH_EVERY = 1000
+# Scritture dopo le quali il totale in memoria viene riallineato all'indice (che altri processi,
+# es. gli shard, aggiornano sulla stessa cartella)
+TOTAL_RESYNC_EVERY = 1000
+# Blob eliminati per query durante l'eviction
+EVICT_BATCH = 64
+
+class CacheEntry:
+    """Metadati di un URL in cache: hash del contenuto e validatori HTTP."""
+
+    def __init__(self, url, blob_hash, etag, last_modified, validated_at):
+        self.url = url
+        self.blob_hash = blob_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated_at = validated_at
+
+class BlobCache:
+    """Archivio su disco di blob identificati dal loro SHA-256, con eviction LRU.
+
+    Un indice SQLite tiene dimensione e ultimo accesso di ogni blob; le sottoclassi
+    aggiungono una tabella (REF_TABLE) che associa le proprie chiavi ai blob. Quando
+    l'archivio supera max_bytes vengono eliminati i blob usati meno di recente insieme
+    alle chiavi che li referenziano. L'istanza è thread-safe e può essere condivisa tra
+    sessioni Streamlit.
+
+    La dimensione totale è tenuta in memoria (letta dall'indice all'apertura e ogni
+    TOTAL_RESYNC_EVERY scritture) e gli ultimi accessi vengono scritti a blocchi, così
+    né le letture né le scritture percorrono l'intera tabella.
+    """
+
+    REF_TABLE = None
+    REF_SCHEMA = None
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.max_bytes = max_bytes
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {self.REF_TABLE} ({self.REF_SCHEMA})")
+        self._db.execute("CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {self.REF_TABLE}_hash ON {self.REF_TABLE} (hash)")
+        self._db.commit()
+        self._access_lock = threading.Lock()  # solo per gli accessi in memoria: le letture non aspettano l'indice
+        self._accesses = {}  # hash -> ultimo accesso non ancora scritto nell'indice
+        self._total = self._sum_sizes()
+        self._stores_since_resync = 0
+        self.stats = {"evicted": 0}
+
+    def _blob_path(self, blob_hash):
+        return os.path.join(self.blob_dir, blob_hash[:2], blob_hash)
+
+    def _sum_sizes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def read_blob(self, blob_hash):
+        """Legge un blob e ne registra l'accesso LRU; restituisce None se è stato eliminato."""
+        try:
+            with open(self._blob_path(blob_hash), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._access_lock:
+            self._accesses[blob_hash] = time.time()
+            due = len(self._accesses) >= ACCESS_FLUSH_EVERY
+        if due:
+            self.flush()
+        return data
+
+    def flush(self):
+        """Scrive nell'indice gli accessi LRU tenuti in memoria."""
+        with self._lock:
+            self._flush_accesses_locked()
+
+    def _flush_accesses_locked(self):
+        with self._access_lock:
+            accesses, self._accesses = self._accesses, {}
+        if accesses:
+            self._db.executemany("UPDATE blobs SET last_access = ? WHERE hash = ?",
+                                 [(accessed_at, blob_hash) for blob_hash, accessed_at in accesses.items()])
+            self._db.commit()
+
+    def _write_blob(self, content):
+        """Scrive il blob su disco (se non esiste già) e restituisce il suo hash."""
+        blob_hash = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(blob_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Scrittura atomica: file temporaneo e rename
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return blob_hash
+
+    def _store_ref(self, content, ref_sql, ref_params):
+        """Salva un blob e la riga che lo referenzia, poi applica il limite di dimensione.
+
+        In ref_sql il primo segnaposto è l'hash del blob, seguito da ref_params.
+        """
+        blob_hash = self._write_blob(content)
+        params = (blob_hash,) + tuple(ref_params)
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM blobs WHERE hash = ?", (blob_hash,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO blobs (hash, size, last_access) VALUES (?, ?, ?)",
+                (blob_hash, len(content), time.time()),
+            )
+            self._db.execute(ref_sql, params)
+            self._db.commit()
+            self._total += len(content) - (previous[0] if previous is not None else 0)
+            self._stores_since_resync += 1
+            if self._stores_since_resync >= TOTAL_RESYNC_EVERY:
+                self._total = self._sum_sizes()
+                self._stores_since_resync = 0
+            self._evict_locked()
+        return blob_hash
+
+    def _evict_locked(self):
+        if self._total <= self.max_bytes:
+            return
+        # Gli accessi ancora in memoria contano per l'ordine LRU
+        self._flush_accesses_locked()
+        while self._total > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT hash, size FROM blobs ORDER BY last_access LIMIT ?", (EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                self._total = 0
+                break
+            for blob_hash, size in rows:
+                if self._total <= self.max_bytes:
+                    break
+                self._db.execute(f"DELETE FROM {self.REF_TABLE} WHERE hash = ?", (blob_hash,))
+                self._db.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+                try:
+                    os.remove(self._blob_path(blob_hash))
+                except FileNotFoundError:
+                    pass
+                self._total -= size
+                self.stats["evicted"] += 1
+        self._db.commit()
+
+    def clear(self):
+        """Svuota completamente la cache."""
+        with self._lock:
+            for (blob_hash,) in self._db.execute("SELECT hash FROM blobs").fetchall():
+                try:
+                    os.remove(self._blob_path(blob_hash))
+                except FileNotFoundError:
+                    pass
+            self._db.execute(f"DELETE FROM {self.REF_TABLE}")
+            self._db.execute("DELETE FROM blobs")
+            self._db.commit()
+            with self._access_lock:
+                self._accesses.clear()
+            self._total = 0
+
+class ImageCache(BlobCache):
+    """Cache su disco delle immagini del CDN, indicizzata per URL.
+
+    Ogni URL punta al blob del suo contenuto e ai validatori ETag/Last-Modified.
+    Le voci più vecchie della soglia di freschezza vengono rivalidate con
+    If-None-Match/If-Modified-Since.
+    """
+
+    REF_TABLE = "urls"
+    REF_SCHEMA = "url TEXT PRIMARY KEY, hash TEXT NOT NULL, etag TEXT, last_modified TEXT, validated_at REAL NOT NULL"
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        super().__init__(cache_dir, max_bytes)
+        self.max_age = max_age
+        self.stats.update({"hits": 0, "revalidated": 0, "downloads": 0})
+
+    # ----- Indice -----
+    def lookup(self, url):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT hash, etag, last_modified, validated_at FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(url, *row)
+
+    def mark_validated(self, url):
+        with self._lock:
+            self._db.execute("UPDATE urls SET validated_at = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+
+    def is_fresh(self, entry):
+        return time.time() - entry.validated_at < self.max_age
+
+    def is_fresh_url(self, url):
+        """True se l'URL è in cache e non va ancora rivalidato (fetch non farà richieste)."""
+        entry = self.lookup(url)
+        return entry is not None and self.is_fresh(entry)
+
+    def store(self, url, content, etag=None, last_modified=None):
+        """Salva il contenuto scaricato per un URL e applica il limite di dimensione."""
+        return self._store_ref(
+            content,
+            "INSERT OR REPLACE INTO urls (hash, url, etag, last_modified, validated_at) VALUES (?, ?, ?, ?, ?)",
+            (url, etag, last_modified, time.time()),
+        )
+
+    # ----- Richieste condizionali -----
+    def _conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    async def fetch(self, url, client):
+        """Scarica un URL con il CdnClient passando dalla cache. Restituisce i byte o None se non disponibile.
+
+        Gli errori transitori esauriti i tentativi (CdnError) vengono propagati.
+        """
+        entry = await asyncio.to_thread(self.lookup, url)
+        if entry is not None and self.is_fresh(entry):
+            data = await asyncio.to_thread(self.read_blob, entry.blob_hash)
+            if data is not None:
+                self.stats["hits"] += 1
+                return data
+        response = await client.get(url, headers=self._conditional_headers(entry))
+        if response.status == 304 and entry is not None:
+            data = await asyncio.to_thread(self.read_blob, entry.blob_hash)
+            if data is not None:
+                await asyncio.to_thread(self.mark_validated, url)
+                self.stats["revalidated"] += 1
+                return data
+            # Blob eliminato tra lookup e 304: nuova richiesta senza validatori
+            response = await client.get(url)
+        if response.status != 200:
+            return None
+        await asyncio.to_thread(
+            self.store, url, response.body, response.headers.get("ETag"), response.headers.get("Last-Modified")
+        )
+        self.stats["downloads"] += 1
+        return response.body
+
+class ResultCache(BlobCache):
+    """Cache su disco delle immagini composte, indicizzata per chiave di composizione.
+
+    La chiave (vedi compositing.result_key) comprende l'hash dell'immagine sorgente, il
+    numero di copie, il layout e le impostazioni di codifica: se la sorgente non cambia,
+    una nuova esecuzione copia direttamente il JPEG già composto.
+    """
+
+    REF_TABLE = "results"
+    REF_SCHEMA = "key TEXT PRIMARY KEY, hash TEXT NOT NULL"
+
+    def __init__(self, cache_dir=DEFAULT_RESULT_CACHE_DIR, max_bytes=DEFAULT_RESULT_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes)
+        self.stats.update({"hits": 0, "misses": 0})
+
+    def get(self, key):
+        """Restituisce il JPEG composto per la chiave, o None se non è in cache."""
+        with self._lock:
+            row = self._db.execute("SELECT hash FROM results WHERE key = ?", (key,)).fetchone()
+        data = self.read_blob(row[0]) if row is not None else None
+        if data is None:
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+        return data
+
+    def put(self, key, data):
+        """Salva il JPEG composto per la chiave."""
+        return self._store_ref(data, "INSERT OR REPLACE INTO results (hash, key) VALUES (?, ?)", (key,))
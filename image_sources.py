@@ -0,0 +1,214 @@
+"""Sorgenti delle immagini prodotto: il CDN via HTTP, una cartella mirror locale o un archivio tar/zip.
+
+Tutte le sorgenti usano i nomi file del CDN (vedi image_name), così una copia locale
+del CDN si ottiene scaricando le immagini con lo stesso nome. Una sorgente espone:
+
+    await source.fetch(product_code, extension)   -> byte dell'immagine o None se non esiste
+    await source.probe(product_code, extension)   -> True/False (None se non si sa senza scaricare)
+    source.location(product_code, extension)      -> URL o percorso, per i messaggi di errore
+
+remote indica se la sorgente è il CDN: solo in quel caso gli esiti aggiornano l'indice di
+disponibilità. Con una sorgente locale si possono rielaborare interi cataloghi (es. cambio
+di layout) alla velocità del disco e fare test senza rete:
+    python bundle_cli.py export.csv --image-source snapshot.tar
+"""
+import os
+import mmap
+import asyncio
+import tarfile
+import zipfile
+import threading
+from zip_writer import ZIP_LOCAL_HEADER
+
+# ---------------------- Configurazione ----------------------
+# Sorgente dell'app: vuota per il CDN, altrimenti una cartella mirror o un archivio .tar/.zip
+DEFAULT_IMAGE_SOURCE = os.environ.get("BUNDLE_IMAGE_SOURCE", "")
+# Risposte a una sonda che non dicono nulla sull'esistenza dell'immagine: si prova comunque il GET
+PROBE_UNSUPPORTED_STATUSES = {405, 416, 501}
+
+def cdn_product_code(product_code):
+    # Se il product_code inizia per '1' o '0', aggiunge il prefisso "D"
+    if product_code.startswith(('1', '0')):
+        return f"D{product_code}"
+    return product_code
+
+def image_name(product_code, extension):
+    """Nome del file di un'immagine sul CDN (es. D01234567-p1.jpg)."""
+    return f"{cdn_product_code(product_code)}-p{extension}.jpg"
+
+class CdnSource:
+    """Immagini dal CDN tramite il CdnClient condiviso, passando dalla cache su disco se indicata.
+
+    url_template ha i segnaposto {product_code} (già con il prefisso "D") ed {extension}.
+    """
+
+    remote = True
+
+    def __init__(self, client, url_template, image_cache=None):
+        self.client = client
+        self.url_template = url_template
+        self.image_cache = image_cache
+
+    def location(self, product_code, extension):
+        return self.url_template.format(product_code=cdn_product_code(product_code), extension=extension)
+
+    async def fetch(self, product_code, extension):
+        """Byte dell'immagine o None; solleva CdnError se il CDN non dà una risposta definitiva."""
+        url = self.location(product_code, extension)
+        if self.image_cache is not None:
+            return await self.image_cache.fetch(url, self.client)
+        response = await self.client.get(url)
+        return response.body if response.status == 200 else None
+
+    async def probe(self, product_code, extension, use_range=False):
+        """Verifica con HEAD o con un GET "Range: bytes=0-0".
+
+        Restituisce False se il CDN la dà per assente, True se esiste, None se la sonda non è
+        supportata (serve un GET) oppure direttamente i byte se il server ha ignorato il Range
+        e inviato l'immagine intera. Le immagini già in cache e ancora valide non generano richieste.
+        """
+        url = self.location(product_code, extension)
+        if self.image_cache is not None and await asyncio.to_thread(self.image_cache.is_fresh_url, url):
+            return True
+        if use_range:
+            response = await self.client.get(url, headers={"Range": "bytes=0-0"})
+        else:
+            response = await self.client.head(url)
+        if response.status == 200 and response.body:
+            return response.body
+        if response.status in PROBE_UNSUPPORTED_STATUSES:
+            return None
+        return response.status < 300
+
+class MirrorDirectorySource:
+    """Immagini da una cartella locale con i nomi file del CDN (es. una copia sincronizzata)."""
+
+    remote = False
+
+    def __init__(self, root):
+        if not os.path.isdir(root):
+            raise ValueError(f"Image mirror directory not found: {root}")
+        self.root = root
+
+    def location(self, product_code, extension):
+        return os.path.join(self.root, image_name(product_code, extension))
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def fetch(self, product_code, extension):
+        return await asyncio.to_thread(self._read, self.location(product_code, extension))
+
+    async def probe(self, product_code, extension, use_range=False):
+        return await asyncio.to_thread(os.path.isfile, self.location(product_code, extension))
+
+class ArchiveSource:
+    """Immagini da un archivio .tar (non compresso) o .zip, lette tramite mmap.
+
+    All'apertura viene costruito un indice nome file -> (posizione, lunghezza) dei dati;
+    ogni lettura è poi una copia dalla mappatura in memoria, senza seek né decompressione.
+    Le voci ZIP compresse vengono lette con zipfile. I nomi sono confrontati senza
+    cartelle, quindi l'archivio può contenere le immagini in qualunque sottocartella.
+    L'istanza si può passare ad altri processi (es. gli shard): l'archivio viene riaperto.
+    """
+
+    remote = False
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise ValueError(f"Image archive not found: {path}")
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._zip = None
+        self._index = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def open(self):
+        """Mappa l'archivio e ne costruisce l'indice (una volta sola); restituisce l'indice."""
+        with self._lock:
+            if self._index is not None:
+                return self._index
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if zipfile.is_zipfile(self.path):
+                self._index = self._index_zip()
+            elif tarfile.is_tarfile(self.path):
+                self._index = self._index_tar()
+            else:
+                raise ValueError(f"Not a .tar or .zip archive: {self.path}")
+            return self._index
+
+    def _index_zip(self):
+        self._zip = zipfile.ZipFile(self.path)
+        index = {}
+        for info in self._zip.infolist():
+            if info.is_dir():
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                index[os.path.basename(info.filename)] = info
+                continue
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+            if signature != b"PK\x03\x04":
+                raise ValueError(f"Corrupt ZIP entry {info.filename} in {self.path}")
+            start = info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+            index[os.path.basename(info.filename)] = (start, info.file_size)
+        return index
+
+    def _index_tar(self):
+        try:
+            # "r:" rifiuta gli archivi compressi, che non si possono leggere da una mappatura
+            with tarfile.open(self.path, "r:") as tar:
+                return {os.path.basename(member.name): (member.offset_data, member.size)
+                        for member in tar if member.isfile()}
+        except tarfile.ReadError as e:
+            raise ValueError(f"Compressed tar archives are not supported, use a plain .tar or a .zip: {e}") from e
+
+    def _read(self, name):
+        entry = self.open().get(name)
+        if entry is None:
+            return None
+        if isinstance(entry, zipfile.ZipInfo):
+            with self._lock:
+                return self._zip.read(entry)
+        start, size = entry
+        return self._map[start:start + size]
+
+    def location(self, product_code, extension):
+        return f"{self.path}:{image_name(product_code, extension)}"
+
+    async def fetch(self, product_code, extension):
+        return await asyncio.to_thread(self._read, image_name(product_code, extension))
+
+    async def probe(self, product_code, extension, use_range=False):
+        index = self._index if self._index is not None else await asyncio.to_thread(self.open)
+        return image_name(product_code, extension) in index
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._file.close()
+            if self._zip is not None:
+                self._zip.close()
+            self._map = self._file = self._zip = self._index = None
+
+def open_image_source(spec):
+    """Sorgente locale indicata da spec (cartella o archivio .tar/.zip); None (il CDN) se spec è vuoto o "cdn"."""
+    if not spec or spec == "cdn":
+        return None
+    if os.path.isdir(spec):
+        return MirrorDirectorySource(spec)
+    source = ArchiveSource(spec)
+    source.open()  # un archivio non valido viene segnalato subito, non a ogni immagine
+    return source
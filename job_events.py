@@ -0,0 +1,93 @@
+"""Canale degli eventi di un job in corso: avanzamento con ETA, errori aggregati e risultati parziali.
+
+La pipeline scrive sul canale dal thread del suo event loop a ogni riga completata;
+ogni evento costa qualche operazione su contatori e liste. Chi osserva il job (la
+pagina Streamlit a ogni poll, la riga di avanzamento della CLI) legge lo stato già
+aggregato invece di ricevere un aggiornamento per riga: on_update, se indicato, viene
+chiamato al più una volta ogni interval secondi e alla fine del job.
+"""
+import time
+
+# ---------------------- Configurazione ----------------------
+DEFAULT_UPDATE_INTERVAL = 0.5   # secondi minimi tra due chiamate di on_update
+MAX_ERROR_SAMPLES = 50          # messaggi di errore conservati; gli altri vengono solo contati
+RATE_SMOOTHING = 0.3            # peso dell'ultima misura nella media mobile della velocità
+
+def fan_out(*callbacks):
+    """Callback che inoltra gli argomenti a tutti i callbacks non None (None se non ce ne sono)."""
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if len(callbacks) <= 1:
+        return callbacks[0] if callbacks else None
+
+    def call(*args):
+        for callback in callbacks:
+            callback(*args)
+    return call
+
+class JobEvents:
+    """Stato aggregato di un job, aggiornato dalla pipeline (vedi BundlePipeline.run(events=...))."""
+
+    def __init__(self, on_update=None, interval=DEFAULT_UPDATE_INTERVAL, max_error_samples=MAX_ERROR_SAMPLES):
+        self.completed = 0
+        self.total = 0
+        self.errors = 0
+        self.error_samples = []
+        self.missing = []      # (bundle_code, product_code) delle immagini mancanti trovate finora
+        self.rate = None       # bundle al secondo, media mobile
+        self.writer = None     # StreamingZipWriter del job, per il download parziale
+        self.max_error_samples = max_error_samples
+        self._on_update = on_update
+        self._interval = interval
+        self.start()
+
+    def start(self):
+        """Azzera la base della velocità: da chiamare quando il job parte, non quando entra in coda."""
+        self._last_time = time.monotonic()
+        self._last_completed = self.completed
+
+    def progress(self, completed, total):
+        self.completed = completed
+        self.total = total
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        if elapsed < self._interval and completed < total:
+            return
+        rate = (completed - self._last_completed) / elapsed if elapsed > 0 else 0.0
+        self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self._last_time = now
+        self._last_completed = completed
+        if self._on_update is not None:
+            self._on_update(self)
+
+    def error(self, message):
+        self.errors += 1
+        if len(self.error_samples) < self.max_error_samples:
+            self.error_samples.append(message)
+
+    def result(self, bundle_row, errors):
+        """Riga completata: le immagini mancanti entrano subito nella tabella parziale."""
+        if errors:
+            self.missing.extend(errors)
+
+    @property
+    def eta_seconds(self):
+        """Secondi stimati alla fine in base alla velocità osservata; None finché non è misurabile."""
+        if not self.rate or self.total <= self.completed:
+            return None
+        return (self.total - self.completed) / self.rate
+
+    def describe(self):
+        """Riga di avanzamento, es. "1200 / 5000 bundles, 35.2 bundles/s, ETA 1m 48s"."""
+        text = f"{self.completed} / {self.total} bundles"
+        if self.rate:
+            text += f", {self.rate:.1f} bundles/s"
+        eta = self.eta_seconds
+        if eta is not None:
+            text += f", ETA {int(eta // 60)}m {int(eta % 60)}s"
+        return text
+
+    async def snapshot_zip(self, path):
+        """Scrive in path uno ZIP valido con i bundle completati finora; None se il job non ha ancora un archivio."""
+        if self.writer is None:
+            return None
+        return await self.writer.snapshot(path)
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import hashlib
+from image_cache import BlobCache, DEFAULT_MAX_AGE
+from compositing import COMPOSITING_VERSION
+
+# ---------------------- Configurazione ----------------------
+# Cartella del manifest, condivisa tra sessioni e non svuotata dal reset della sessione
+DEFAULT_MANIFEST_DIR = os.environ.get("BUNDLE_MANIFEST_DIR", ".job_manifest")
+# Dimensione massima delle immagini di output conservate (default 2 GB)
+DEFAULT_MANIFEST_MAX_BYTES = int(os.environ.get("BUNDLE_MANIFEST_MAX_BYTES", 2 * 1024 ** 3))
+
+def bundle_inputs(product_codes, layout, fallback_ext, encoding_profile):
+    """Chiave degli input di una riga: se cambia, il bundle va rielaborato."""
+    return json.dumps([list(product_codes), (layout or "horizontal").lower(), fallback_ext, encoding_profile,
+                       COMPOSITING_VERSION])
+
+def source_hashes(sources):
+    """{product_code: {estensione: byte}} -> {product_code: {estensione: sha256}}."""
+    return {
+        product_code: {ext: hashlib.sha256(data).hexdigest() for ext, data in images.items()}
+        for product_code, images in sources.items()
+    }
+
+class ManifestEntry:
+    """Bundle già elaborato: riga di bundle_list.csv, hash delle sorgenti e file di output."""
+
+    def __init__(self, sku, inputs, sources, bundle_row, outputs, recorded_at):
+        self.sku = sku
+        self.inputs = inputs
+        self.sources = sources
+        self.bundle_row = bundle_row
+        self.outputs = outputs  # lista di (arcname, hash del blob)
+        self.recorded_at = recorded_at
+
+class JobManifest(BlobCache):
+    """Manifest persistente dei bundle elaborati, per riprendere e aggiornare i job.
+
+    Per ogni SKU e combinazione di input (pzns_in_set, layout, lingua, profilo di
+    codifica) registra gli hash delle immagini sorgente usate e i file scritti nello ZIP;
+    i file sono conservati come blob. Rieseguendo lo stesso CSV, i bundle già completati vengono ricopiati senza
+    scaricare né comporre nulla; con un export aggiornato vengono rielaborati solo gli SKU
+    con input diversi o con immagini sorgente cambiate sul CDN. Le voci più vecchie di
+    max_age vengono riusate solo dopo aver verificato gli hash delle sorgenti.
+    Si registrano solo i bundle completi, senza immagini mancanti.
+    """
+
+    REF_TABLE = "outputs"
+    REF_SCHEMA = "hash TEXT NOT NULL, sku TEXT NOT NULL, inputs TEXT NOT NULL, arcname TEXT NOT NULL, " \
+                 "PRIMARY KEY (sku, inputs, arcname)"
+
+    def __init__(self, cache_dir=DEFAULT_MANIFEST_DIR, max_bytes=DEFAULT_MANIFEST_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        super().__init__(cache_dir, max_bytes)
+        self.max_age = max_age
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bundles (sku TEXT NOT NULL, inputs TEXT NOT NULL, sources TEXT NOT NULL, "
+            "bundle_row TEXT NOT NULL, outputs INTEGER NOT NULL, recorded_at REAL NOT NULL, PRIMARY KEY (sku, inputs))"
+        )
+        self._db.commit()
+        self.stats.update({"restored": 0, "verified": 0, "changed": 0, "recorded": 0})
+
+    def lookup(self, sku, inputs):
+        """Voce registrata per SKU e input, o None se assente o con output eliminati dal limite di spazio."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sources, bundle_row, outputs, recorded_at FROM bundles WHERE sku = ? AND inputs = ?",
+                (sku, inputs),
+            ).fetchone()
+            if row is None:
+                return None
+            outputs = self._db.execute(
+                "SELECT arcname, hash FROM outputs WHERE sku = ? AND inputs = ? ORDER BY rowid", (sku, inputs)
+            ).fetchall()
+        sources, bundle_row, expected_outputs, recorded_at = row
+        if len(outputs) != expected_outputs:
+            return None
+        return ManifestEntry(sku, inputs, json.loads(sources), json.loads(bundle_row), outputs, recorded_at)
+
+    def is_fresh(self, entry):
+        return time.time() - entry.recorded_at < self.max_age
+
+    def read_outputs(self, entry):
+        """Legge i file di output di una voce; None se qualcuno è stato eliminato nel frattempo."""
+        files = []
+        for arcname, blob_hash in entry.outputs:
+            data = self.read_blob(blob_hash)
+            if data is None:
+                return None
+            files.append((arcname, data))
+        return files
+
+    def record(self, sku, inputs, sources, bundle_row, outputs):
+        """Registra un bundle completato; sources sono gli hash (vedi source_hashes), outputs (arcname, byte)."""
+        with self._lock:
+            self._db.execute("DELETE FROM outputs WHERE sku = ? AND inputs = ?", (sku, inputs))
+            self._db.commit()
+        for arcname, data in outputs:
+            self._store_ref(
+                data, "INSERT OR REPLACE INTO outputs (hash, sku, inputs, arcname) VALUES (?, ?, ?, ?)",
+                (sku, inputs, arcname),
+            )
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO bundles (sku, inputs, sources, bundle_row, outputs, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (sku, inputs, json.dumps(sources, sort_keys=True), json.dumps(bundle_row), len(outputs), time.time()),
+            )
+            self._db.commit()
+        self.stats["recorded"] += 1
+
+    def touch(self, entry):
+        """Segna come appena verificata una voce le cui sorgenti non sono cambiate."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE bundles SET recorded_at = ? WHERE sku = ? AND inputs = ?", (time.time(), entry.sku, entry.inputs)
+            )
+            self._db.commit()
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._db.execute("DELETE FROM bundles")
+            self._db.commit()
@@ -0,0 +1,198 @@
+"""Metriche di un job: tempi per fase (istogrammi), byte, richieste per estensione, cache ed errori.
+
+Pensate per restare sempre attive: ogni osservazione costa un perf_counter, una
+ricerca binaria sui limiti dei bucket e qualche operazione su dizionari, e tutte
+le modifiche avvengono nel thread dell'event loop (niente lock). Le durate misurate
+nei processi di composizione arrivano insieme al risultato e vengono registrate qui.
+"""
+import csv
+import json
+import time
+import bisect
+from contextlib import contextmanager
+
+# Limiti superiori dei bucket in secondi (più +Inf implicito), come i default Prometheus
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CSV_COLUMNS = ["metric", "type", "labels", "value", "count", "mean_ms", "p50_ms", "p95_ms", "max_ms"]
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _labels_text(key):
+    return ",".join(f"{name}={value}" for name, value in key)
+
+class Histogram:
+    """Istogramma a bucket fissi con conteggio, somma e massimo."""
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Stima del quantile q: limite superiore del bucket che lo contiene (al più il massimo)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "max": self.max,
+                "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.buckets))}
+
+class JobMetrics:
+    """Contatori e istogrammi di un job, identificati da nome ed etichette (es. ext="1-fr")."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Imposta un valore istantaneo (es. la concorrenza raggiunta dal client del CDN)."""
+        self.gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        """Valore di un contatore: somma delle serie con quel nome che hanno le etichette indicate."""
+        wanted = set(labels.items())
+        return sum(value for (metric, key), value in self.counters.items() if metric == name and wanted <= set(key))
+
+    def seconds(self, name):
+        """Tempo cumulativo registrato per una fase, su tutte le etichette."""
+        return sum(h.total for (metric, _), h in self.histograms.items() if metric == name)
+
+    def merge(self, other):
+        """Aggiunge le metriche di un altro job (es. uno shard): contatori, istogrammi e gauge vengono sommati."""
+        self.started = min(self.started, other.started)
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, value in other.gauges.items():
+            self.gauges[key] = self.gauges.get(key, 0) + value
+        for key, h in other.histograms.items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            for i, count in enumerate(h.buckets):
+                histogram.buckets[i] += count
+            histogram.count += h.count
+            histogram.total += h.total
+            histogram.max = max(histogram.max, h.max)
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def wall_seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def rows(self):
+        """Righe per job_metrics.csv: prima le fasi (istogrammi), poi i contatori."""
+        rows = [["job", "gauge", "", round(self.wall_seconds, 3), "", "", "", "", ""]]
+        for (name, key), value in sorted(self.gauges.items()):
+            rows.append([name, "gauge", _labels_text(key), value, "", "", "", "", ""])
+        for (name, key), h in sorted(self.histograms.items()):
+            rows.append([name, "histogram", _labels_text(key), round(h.total, 3), h.count,
+                         round(h.total / h.count * 1000, 2) if h.count else 0.0,
+                         round(h.quantile(0.5) * 1000, 2), round(h.quantile(0.95) * 1000, 2),
+                         round(h.max * 1000, 2)])
+        for (name, key), value in sorted(self.counters.items()):
+            rows.append([name, "counter", _labels_text(key), value, "", "", "", "", ""])
+        return rows
+
+    def summary(self):
+        """Riepilogo per fase (nome, operazioni, tempo cumulativo, medio e p95) per l'interfaccia."""
+        stages = {}
+        for (name, _), h in self.histograms.items():
+            stage = stages.setdefault(name, Histogram())
+            for i, count in enumerate(h.buckets):
+                stage.buckets[i] += count
+            stage.count += h.count
+            stage.total += h.total
+            stage.max = max(stage.max, h.max)
+        return [
+            {"stage": name, "operations": h.count, "total_s": round(h.total, 2),
+             "mean_ms": round(h.total / h.count * 1000, 1) if h.count else 0.0,
+             "p95_ms": round(h.quantile(0.95) * 1000, 1)}
+            for name, h in stages.items()
+        ]
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "wall_seconds": self.wall_seconds,
+            "histograms": [{"name": name, "labels": dict(key), **h.to_dict()}
+                           for (name, key), h in sorted(self.histograms.items())],
+            "counters": [{"name": name, "labels": dict(key), "value": value}
+                         for (name, key), value in sorted(self.counters.items())],
+            "gauges": [{"name": name, "labels": dict(key), "value": value}
+                       for (name, key), value in sorted(self.gauges.items())],
+        }
+
+    def write(self, csv_path, json_path=None):
+        """Scrive job_metrics.csv (separatore ';' come gli altri report) e, se indicato, il JSON."""
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(CSV_COLUMNS)
+            writer.writerows(self.rows())
+        if json_path:
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def to_prometheus(self, prefix="bundle_"):
+        """Esposizione in formato testo Prometheus, da servire o inviare a un pushgateway da un hook."""
+        lines = []
+        for (name, key), h in sorted(self.histograms.items()):
+            metric = f"{prefix}{name}_seconds"
+            labels = [f'{k}="{v}"' for k, v in key]
+            cumulative = 0
+            for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], h.buckets):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+            label_text = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{metric}_sum{label_text} {h.total}")
+            lines.append(f"{metric}_count{label_text} {h.count}")
+        for (name, key), value in sorted(self.counters.items()):
+            label_text = "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}" if key else ""
+            lines.append(f"{prefix}{name}_total{label_text} {value}")
+        for (name, key), value in sorted(self.gauges.items()):
+            label_text = "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}" if key else ""
+            lines.append(f"{prefix}{name}{label_text} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,276 @@
+"""Coda di job condivisa da tutte le sessioni Streamlit, eseguita in un thread di background.
+
+Un solo JobRunner per processo possiede l'event loop, la BundlePipeline (sessione HTTP,
+limite adattivo del CDN, cache e pool di composizione) e la coda. Le sessioni inviano
+i job con submit() e a ogni rerun leggono lo stato del JobHandle (polling): un rerun o
+un refresh della pagina non interrompe né duplica il lavoro.
+"""
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+from artifact_store import ArtifactStore
+from job_events import JobEvents
+
+# ---------------------- Configurazione ----------------------
+# Job eseguiti contemporaneamente, per tutto il processo
+DEFAULT_MAX_RUNNING_JOBS = int(os.environ.get("BUNDLE_MAX_RUNNING_JOBS", 2))
+# Composizioni contemporanee totali, ripartite tra i job in esecuzione
+DEFAULT_CPU_BUDGET = int(os.environ.get("BUNDLE_CPU_BUDGET", os.cpu_count() or 4))
+# Job conclusi tenuti in memoria (solo stato, statistiche e metriche); i loro file restano
+# nell'ArtifactStore finché quota e scadenza lo consentono
+FINISHED_JOBS_KEPT = 100
+# ZIP parziale con i bundle completati, nella cartella del job finché il job è in corso
+PARTIAL_ZIP_NAME = "Bundle&Set.partial.zip"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+class JobHandle:
+    """Stato di un job, aggiornato dal thread del runner e letto dalle sessioni.
+
+    Concluso il job, result tiene solo percorsi, statistiche e metriche: le tabelle dei
+    report (bundle_list_df, missing_images_df) sono None e vanno lette dai file.
+    """
+
+    def __init__(self, job_id, owner, plan, options, key=None):
+        self.job_id = job_id
+        self.owner = owner
+        self.plan = plan
+        self.options = options
+        self.key = key
+        self.state = QUEUED
+        # Avanzamento, errori non bloccanti aggregati e immagini mancanti trovate finora
+        self.events = JobEvents()
+        self.events.total = plan.rows
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._task = None
+        self._cancel_requested = False
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def completed(self):
+        return self.events.completed
+
+    @property
+    def total(self):
+        return self.events.total
+
+class JobRunner:
+    """Esecutore dei job condiviso dal processo, con coda equa tra le sessioni.
+
+    I job in attesa partono a turno tra i proprietari (round robin per sessione), al più
+    max_running alla volta; ogni job riceve una quota cpu_budget / max_running delle
+    composizioni contemporanee, mentre le richieste al CDN passano tutte dallo stesso
+    client con limite adattivo. pipeline_factory crea la BundlePipeline (non ancora
+    aperta) che il runner usa per tutta la sua vita. I file di ogni job vengono scritti
+    in una cartella dell'artifact_store (default ArtifactStore()).
+    """
+
+    def __init__(self, pipeline_factory, max_running=DEFAULT_MAX_RUNNING_JOBS, cpu_budget=DEFAULT_CPU_BUDGET,
+                 artifact_store=None):
+        self.max_running = max(1, max_running)
+        self.cpu_budget = max(1, cpu_budget)
+        self.artifact_store = artifact_store or ArtifactStore()
+        self._pipeline_factory = pipeline_factory
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # proprietario -> deque di JobHandle, nell'ordine dei turni
+        self._jobs = OrderedDict()    # job_id -> JobHandle, in ordine di invio
+        self._running = 0
+        self._loop = asyncio.new_event_loop()
+        self._pipeline = None
+        self._wakeup = None
+        self._startup_error = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="bundle-job-runner", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._startup_error is not None:
+            raise self._startup_error
+
+    # ---------------------- API per le sessioni (thread di Streamlit) ----------------------
+    def submit(self, owner, plan, options_factory, key=None):
+        """Accoda un job e restituisce il suo JobHandle.
+
+        options_factory riceve la cartella di output del job e restituisce le JobOptions.
+        Se lo stesso proprietario ha già un job attivo con la stessa key (es. hash del
+        file e delle opzioni) viene restituito quello, senza duplicare il lavoro.
+        """
+        with self._lock:
+            if key is not None:
+                for handle in self._jobs.values():
+                    if handle.owner == owner and handle.key == key and handle.active:
+                        return handle
+            job_id = uuid.uuid4().hex
+            handle = JobHandle(job_id, owner, plan, options_factory(self.artifact_store.create(job_id, owner)), key)
+            self._jobs[job_id] = handle
+            self._queues.setdefault(owner, deque()).append(handle)
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+        return handle
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job_id):
+        """Posizione (da 1) del job tra quelli in attesa, secondo i turni; None se non è in coda."""
+        with self._lock:
+            for position, handle in enumerate(self._queued_order_locked(), start=1):
+                if handle.job_id == job_id:
+                    return position
+        return None
+
+    def queue_length(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def running_count(self):
+        return self._running
+
+    def call(self, coroutine_function, *args):
+        """Esegue coroutine_function(pipeline, *args) nell'event loop del runner, fuori dalla coda dei job.
+
+        Serve per richieste brevi e interattive (es. le anteprime della sidebar) che usano
+        lo stesso client del CDN dei job. Restituisce un concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine_function(self._pipeline, *args), self._loop)
+
+    def snapshot(self, job_id):
+        """Prepara lo ZIP parziale dei bundle completati finora da un job in corso.
+
+        Restituisce un concurrent.futures.Future con il percorso del file, o None se il
+        job non è (più) in esecuzione o non ha ancora iniziato a scrivere l'archivio.
+        """
+        handle = self.get(job_id)
+        if handle is None or handle.state != RUNNING:
+            future = Future()
+            future.set_result(None)
+            return future
+        path = os.path.join(handle.options.output_dir, PARTIAL_ZIP_NAME)
+        return asyncio.run_coroutine_threadsafe(handle.events.snapshot_zip(path), self._loop)
+
+    def cancel(self, job_id):
+        """Annulla un job in attesa o in esecuzione."""
+        with self._lock:
+            handle = self._jobs.get(job_id)
+            if handle is None or not handle.active:
+                return
+            queue = self._queues.get(handle.owner)
+            if handle.state == QUEUED and queue is not None and handle in queue:
+                queue.remove(handle)
+                handle.state = CANCELLED
+                handle.finished_at = time.time()
+                self.artifact_store.delete(job_id)
+                return
+            # Prelevato dalla coda ma non ancora avviato: _run_job lo annulla subito
+            handle._cancel_requested = True
+        if handle._task is not None:
+            self._loop.call_soon_threadsafe(handle._task.cancel)
+
+    # ---------------------- Thread del runner ----------------------
+    def _queued_order_locked(self):
+        """Job in attesa nell'ordine in cui partiranno: un job per proprietario a turno."""
+        order = []
+        queues = [list(queue) for queue in self._queues.values()]
+        for turn in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[turn] for queue in queues if turn < len(queue))
+        return order
+
+    def _next_locked(self):
+        for owner, queue in self._queues.items():
+            if queue:
+                handle = queue.popleft()
+                # Il proprietario servito passa in fondo ai turni
+                self._queues.move_to_end(owner)
+                return handle
+        return None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        except BaseException as e:
+            self._startup_error = e
+        finally:
+            self._started.set()
+
+    async def _main(self):
+        self._wakeup = asyncio.Event()
+        async with self._pipeline_factory() as pipeline:
+            self._pipeline = pipeline
+            self._started.set()
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._running < self.max_running:
+                    with self._lock:
+                        handle = self._next_locked()
+                        for owner in [owner for owner, queue in self._queues.items() if not queue]:
+                            del self._queues[owner]
+                    if handle is None:
+                        break
+                    self._running += 1
+                    handle._task = asyncio.ensure_future(self._run_job(pipeline, handle))
+
+    async def _run_job(self, pipeline, handle):
+        handle.state = RUNNING
+        handle.started_at = time.time()
+        handle.events.start()
+        options = handle.options
+        # Quota di CPU: le composizioni del job non superano la sua parte del budget
+        options.compose_limit = max(1, min(options.compose_limit, self.cpu_budget // self.max_running))
+        try:
+            if handle._cancel_requested:
+                raise asyncio.CancelledError
+            handle.result = await pipeline.run(handle.plan, options, events=handle.events)
+            # Il download parziale non serve più e non deve pesare sulla quota
+            partial_path = os.path.join(options.output_dir, PARTIAL_ZIP_NAME)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            await asyncio.to_thread(self.artifact_store.finish, handle.job_id)
+            handle.state = DONE
+        except asyncio.CancelledError:
+            handle.state = CANCELLED
+        except Exception as e:
+            handle.error = str(e)
+            handle.state = FAILED
+        finally:
+            handle.finished_at = time.time()
+            handle.plan = None  # il piano non serve più: libera la memoria
+            handle.events.writer = None
+            # Le tabelle crescono con le righe del CSV: i report si leggono dai file del job
+            handle.events.missing = []
+            if handle.result is not None:
+                handle.result.bundle_list_df = handle.result.missing_images_df = None
+            if handle.state != DONE:
+                # I file di un job fallito o annullato sono incompleti
+                await asyncio.to_thread(self.artifact_store.delete, handle.job_id)
+            self._running -= 1
+            self._forget_old_jobs()
+            self._wakeup.set()
+
+    def _forget_old_jobs(self):
+        """Dimentica i job conclusi oltre FINISHED_JOBS_KEPT; i loro file restano nell'archivio."""
+        with self._lock:
+            finished = [job_id for job_id, handle in self._jobs.items() if not handle.active]
+            for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+                del self._jobs[job_id]
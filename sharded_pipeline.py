@@ -0,0 +1,252 @@
+"""Esecuzione di un job su più core: il piano viene diviso in shard elaborati da processi separati.
+
+Per export molto grandi un solo interprete diventa il collo di bottiglia (lettura del
+piano, gestione dei bundle, scrittura dello ZIP) anche con download asincroni. Qui il
+piano viene diviso in N shard per insieme deduplicato di PZN: le righe con gli stessi
+prodotti (e quelle con lo stesso SKU) finiscono nello stesso shard, così ogni prodotto
+viene di norma scaricato da un solo processo. Ogni shard gira in un processo con il
+proprio event loop, pool di connessioni e pool di composizione, e condivide con gli
+altri le cache su disco; il coordinatore unisce poi ZIP, bundle_list.csv e
+missing_images.csv in un ordine che non dipende da quale shard finisce prima:
+
+    result = asyncio.run(run_sharded("export.csv", JobOptions(output_dir="out"), shards=8,
+                                     resources=ShardResources(image_cache_dir=".image_cache")))
+"""
+import os
+import copy
+import shutil
+import asyncio
+import tempfile
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import bundle_pipeline
+from bundle_pipeline import (
+    DEFAULT_CONNECTOR_LIMIT, BundlePipeline, BundlePlan, JobResult, missing_images_table, plan_bundle_csv,
+)
+from availability_index import AvailabilityIndex
+from compositing import create_process_pool
+from image_cache import ImageCache, ResultCache
+from job_events import JobEvents, fan_out
+from job_manifest import JobManifest
+from job_metrics import JobMetrics
+from zip_writer import merge_archives
+
+# ---------------------- Configurazione ----------------------
+DEFAULT_SHARDS = int(os.environ.get("BUNDLE_SHARDS", os.cpu_count() or 1))
+# Secondi minimi tra due aggiornamenti di avanzamento inviati da uno shard
+SHARD_UPDATE_INTERVAL = 0.5
+
+class ShardResources:
+    """Come ricreare in ogni processo le risorse della pipeline.
+
+    Le cache, il manifest e l'indice di disponibilità sono su disco (SQLite in WAL) e
+    vengono aperti da ogni shard sulle stesse cartelle; None li disattiva.
+    connector_limit è il totale delle connessioni HTTP, diviso tra gli shard.
+    image_source è la sorgente locale delle immagini (vedi image_sources), None per il CDN.
+    """
+
+    def __init__(self, image_cache_dir=None, result_cache_dir=None, manifest_dir=None, availability_index_dir=None,
+                 connector_limit=DEFAULT_CONNECTOR_LIMIT, image_source=None):
+        self.image_cache_dir = image_cache_dir
+        self.result_cache_dir = result_cache_dir
+        self.manifest_dir = manifest_dir
+        self.availability_index_dir = availability_index_dir
+        self.connector_limit = connector_limit
+        self.image_source = image_source
+        # Anche un CDN_URL impostato a runtime (es. dal benchmark) arriva ai processi "spawn"
+        self.cdn_url = bundle_pipeline.CDN_URL
+
+class ShardEvents(JobEvents):
+    """Eventi di uno shard inoltrati al coordinatore con la coda del manager.
+
+    L'avanzamento parte al più ogni SHARD_UPDATE_INTERVAL secondi; errori e immagini
+    mancanti vengono inoltrati subito, per la tabella parziale del coordinatore.
+    """
+
+    def __init__(self, shard, queue):
+        super().__init__(on_update=lambda events: queue.put(("progress", shard, events.completed)),
+                         interval=SHARD_UPDATE_INTERVAL)
+        self.shard = shard
+        self.queue = queue
+
+    def error(self, message):
+        self.queue.put(("error", self.shard, message))
+
+    def result(self, bundle_row, errors):
+        if errors:
+            self.queue.put(("missing", self.shard, errors))
+
+def shard_plan(plan, shards):
+    """Divide il piano in al più shards parti per insieme deduplicato di PZN.
+
+    I gruppi di righe con lo stesso SKU restano interi; gli insiemi vengono assegnati dal
+    più numeroso allo shard meno carico, così gli shard hanno un numero di righe simile.
+    Restituisce una lista di (BundlePlan, indici delle righe nel piano originale).
+    """
+    shards = max(1, min(shards, plan.rows))
+    key_groups = {}
+    for group in plan.groups():
+        key = frozenset(plan.pzns[group[0]].split(','))
+        key_groups.setdefault(key, []).append(group)
+    loads = [0] * shards
+    indices = [[] for _ in range(shards)]
+    # sorted è stabile: a parità di righe gli insiemi restano nell'ordine di prima apparizione
+    for groups in sorted(key_groups.values(), key=lambda groups: -sum(len(group) for group in groups)):
+        shard = loads.index(min(loads))
+        for group in groups:
+            indices[shard].extend(group)
+            loads[shard] += len(group)
+    return [(plan.subset(sorted(rows)), sorted(rows)) for rows in indices if rows]
+
+def shard_options(options, directory, connector_share, compose_workers):
+    """Opzioni del job per uno shard: stessi parametri, file di output nella cartella dello shard."""
+    options = copy.copy(options)
+    options.output_dir = directory
+    options.zip_path = os.path.join(directory, "Bundle&Set.zip")
+    options.bundle_list_path = os.path.join(directory, "bundle_list.csv")
+    options.missing_images_path = os.path.join(directory, "missing_images.csv")
+    options.metrics_path = os.path.join(directory, "job_metrics.csv")
+    options.metrics_json_path = os.path.join(directory, "job_metrics.json")
+    options.download_limit = max(1, min(options.download_limit, connector_share))
+    options.compose_limit = max(1, min(options.compose_limit, compose_workers))
+    return options
+
+def run_shard(shard, plan, options, resources, connector_limit, compose_workers, queue):
+    """Punto di ingresso del processo di uno shard: esegue il piano con una pipeline propria."""
+    bundle_pipeline.CDN_URL = resources.cdn_url
+    return asyncio.run(_run_shard(shard, plan, options, resources, connector_limit, compose_workers, queue))
+
+async def _run_shard(shard, plan, options, resources, connector_limit, compose_workers, queue):
+    image_cache = ImageCache(resources.image_cache_dir) if resources.image_cache_dir else None
+    result_cache = ResultCache(resources.result_cache_dir) if resources.result_cache_dir else None
+    manifest = JobManifest(resources.manifest_dir) if resources.manifest_dir else None
+    index = AvailabilityIndex(resources.availability_index_dir) if resources.availability_index_dir else None
+    executor = create_process_pool(compose_workers)
+    try:
+        async with BundlePipeline(image_cache, result_cache, executor, connector_limit=connector_limit,
+                                  manifest=manifest, availability_index=index,
+                                  source=resources.image_source) as pipeline:
+            return await pipeline.run(plan, options, events=ShardEvents(shard, queue))
+    finally:
+        executor.shutdown()
+
+def merge_reports(results, indices):
+    """bundle_list.csv nell'ordine del CSV originale e missing_images.csv ordinato per bundle.
+
+    Un bundle appartiene a un solo shard, quindi le tabelle coincidono con quelle di
+    un'esecuzione in un solo processo.
+    """
+    bundle_lists = []
+    for result, rows in zip(results, indices):
+        bundle_list_df = result.bundle_list_df.copy()
+        bundle_list_df.index = rows
+        bundle_lists.append(bundle_list_df)
+    bundle_list_df = pd.concat(bundle_lists).sort_index().reset_index(drop=True)
+    missing = [result.missing_images_df for result in results if not result.missing_images_df.empty]
+    if not missing:
+        return bundle_list_df, missing_images_table([])
+    missing_images_df = pd.concat(missing).sort_values("PZN Bundle", kind="stable").reset_index(drop=True)
+    return bundle_list_df, missing_images_df
+
+async def run_sharded(source, options, shards=DEFAULT_SHARDS, resources=None, progress=None, on_error=None,
+                      metrics_hook=None, events=None):
+    """Elabora un CSV (percorso, file-like, DataFrame o BundlePlan) in shards processi e restituisce un JobResult.
+
+    Le connessioni HTTP (resources.connector_limit) e i processi di composizione (uno
+    per core) vengono divisi tra gli shard. progress riceve (bundle completati, totale)
+    sommando gli shard; on_error riceve gli errori non bloccanti man mano che arrivano.
+    events (vedi job_events.JobEvents) riceve anche le immagini mancanti; il download
+    parziale dello ZIP non è disponibile, perché gli archivi sono negli shard.
+    """
+    resources = resources or ShardResources()
+    if events is not None:
+        progress = fan_out(progress, events.progress)
+        on_error = fan_out(on_error, events.error)
+    metrics = JobMetrics()
+    with metrics.timer("load_csv"):
+        plan = source if isinstance(source, BundlePlan) else await asyncio.to_thread(plan_bundle_csv, source)
+    with metrics.timer("shard_plan"):
+        parts = await asyncio.to_thread(shard_plan, plan, shards)
+    shards = len(parts)
+    connector_share = max(1, resources.connector_limit // shards)
+    compose_workers = max(1, (os.cpu_count() or 1) // shards)
+    for path in (options.zip_path, options.bundle_list_path, options.missing_images_path, options.metrics_path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=".shards_", dir=os.path.dirname(options.zip_path) or ".")
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    queue = manager.Queue()
+    completed = [0] * shards
+
+    async def relay():
+        while True:
+            event = await asyncio.to_thread(queue.get)
+            if event is None:
+                return
+            kind, shard, value = event
+            if kind == "progress":
+                completed[shard] = value
+                if progress is not None:
+                    progress(sum(completed), plan.rows)
+            elif kind == "missing":
+                if events is not None:
+                    events.result(None, value)
+            elif on_error is not None:
+                on_error(value)
+
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(max_workers=shards, mp_context=context)
+    relay_task = asyncio.ensure_future(relay())
+    try:
+        futures = [
+            loop.run_in_executor(executor, run_shard, shard, shard_plan_part,
+                                 shard_options(options, os.path.join(work_dir, f"shard_{shard}"), connector_share,
+                                               compose_workers),
+                                 resources, connector_share, compose_workers, queue)
+            for shard, (shard_plan_part, _) in enumerate(parts)
+        ]
+        with metrics.timer("shards"):
+            results = await asyncio.gather(*futures)
+
+        with metrics.timer("zip_merge"):
+            await asyncio.to_thread(merge_archives, [result.zip_path for result in results], options.zip_path)
+        metrics.inc("zip_bytes", os.path.getsize(options.zip_path))
+        with metrics.timer("reports"):
+            bundle_list_df, missing_images_df = merge_reports(results, [rows for _, rows in parts])
+            missing_images_df.to_csv(options.missing_images_path, index=False, sep=';')
+            bundle_list_df.to_csv(options.bundle_list_path, index=False, sep=';')
+    finally:
+        queue.put(None)
+        relay_outcome, = await asyncio.gather(relay_task, return_exceptions=True)
+        executor.shutdown(wait=False, cancel_futures=True)
+        manager.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if isinstance(relay_outcome, Exception):
+        # Un callback fallito interrompe il job, come nella pipeline in un solo processo
+        raise relay_outcome
+
+    for result in results:
+        # zip_bytes degli shard sostituito da quello dell'archivio unito
+        result.metrics.counters.pop(("zip_bytes", ()), None)
+        metrics.merge(result.metrics)
+    metrics.set("shards", shards)
+    metrics.finish()
+    await asyncio.to_thread(metrics.write, options.metrics_path, options.metrics_json_path)
+    if metrics_hook is not None:
+        try:
+            metrics_hook(metrics)
+        except Exception as e:
+            if on_error is not None:
+                on_error(f"Metrics hook failed: {e}")
+
+    stats = {}
+    for result in results:
+        for name, value in result.stats.items():
+            stats[name] = stats.get(name, 0) + value
+    stats["shards"] = shards
+    return JobResult(options.zip_path, options.bundle_list_path, options.missing_images_path,
+                     bundle_list_df, missing_images_df, stats, metrics, options.metrics_path)
@@ -0,0 +1,162 @@
+import os
+import time
+import zlib
+import struct
+import shutil
+import asyncio
+import zipfile
+
+COPY_BUFFER = 1024 * 1024
+# Intestazione locale di una voce ZIP: 30 byte, con lunghezze di nome ed extra agli offset 26 e 28
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+class StreamingZipWriter:
+    """Scrive l'archivio ZIP dei risultati man mano che i bundle vengono completati.
+
+    Le immagini sono già JPEG compressi e vengono salvate senza ricompressione
+    (ZIP_STORED); tutte le voci stanno sotto la cartella radice `root`, come
+    nell'archivio creato in precedenza con shutil.make_archive. Le scritture sono
+    serializzate da un lock asyncio ed eseguite in un thread per non bloccare il loop.
+    Se lo stesso file viene scritto più volte resta la prima scrittura e le altre non
+    toccano il disco (vedi run_bundle_scheduler per le righe con SKU ripetuti).
+
+    Le scritture possono appartenere a un gruppo (es. la riga del CSV): snapshot() copia
+    in un archivio valido i file scritti finora, esclusi i gruppi non ancora completati
+    con complete(), così un download parziale contiene solo bundle interi.
+    """
+
+    def __init__(self, path, root="Bundle&Set"):
+        self.path = path
+        self.root = root
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._lock = asyncio.Lock()
+        self._dirs = set()
+        self._names = set()
+        self._pending = {}  # gruppo non ancora completato -> nomi delle sue voci
+        self.entries = 0
+        self.bytes_written = 0
+
+    def _arcname(self, name):
+        return f"{self.root}/{name}" if name else self.root
+
+    def add_dir(self, name):
+        """Registra una cartella (e le cartelle superiori); le voci vengono scritte alla chiusura."""
+        parts = name.strip("/").split("/") if name else []
+        for i in range(len(parts) + 1):
+            self._dirs.add("/".join(parts[:i]))
+
+    def _write_entry(self, arcname, data, compress_type):
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        self._zip.writestr(info, data)
+        # Le voci complete sono sempre su disco: snapshot() le rilegge con un altro file handle
+        self._zip.fp.flush()
+
+    async def write(self, name, data, compress_type=zipfile.ZIP_STORED, group=None):
+        """Aggiunge un file all'archivio; name è relativo alla cartella radice.
+
+        Restituisce False (senza scrivere) se il file è già nell'archivio.
+        """
+        arcname = self._arcname(name)
+        self.add_dir(name.rsplit("/", 1)[0] if "/" in name else "")
+        async with self._lock:
+            if arcname in self._names:
+                return False
+            self._names.add(arcname)
+            if group is not None:
+                self._pending.setdefault(group, []).append(arcname)
+            await asyncio.to_thread(self._write_entry, arcname, data, compress_type)
+            self.entries += 1
+            self.bytes_written += len(data)
+        return True
+
+    def complete(self, group):
+        """Segna come completo un gruppo di voci: da ora entra negli snapshot."""
+        self._pending.pop(group, None)
+
+    async def snapshot(self, path):
+        """Scrive in path un archivio valido con le voci complete scritte finora e lo restituisce.
+
+        Le scritture proseguono durante la copia: il lock serve solo a leggere un elenco
+        coerente delle voci, i cui dati su disco non cambiano più.
+        """
+        async with self._lock:
+            entries = list(self._zip.filelist)
+            pending = {name for names in self._pending.values() for name in names}
+            dirs = sorted(self._dirs)
+        return await asyncio.to_thread(self._write_snapshot, path, entries, pending, dirs)
+
+    def _write_snapshot(self, path, entries, pending, dirs):
+        tmp_path = path + ".tmp"
+        with open(self.path, "rb") as src, zipfile.ZipFile(tmp_path, "w", allowZip64=True) as dst:
+            for name in dirs:
+                info = zipfile.ZipInfo(self._arcname(name) + "/", date_time=time.localtime(time.time())[:6])
+                info.external_attr = (0o40755 << 16) | 0x10
+                dst.writestr(info, b"")
+            for info in entries:
+                if info.filename in pending:
+                    continue
+                src.seek(info.header_offset)
+                signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(src.read(ZIP_LOCAL_HEADER.size))
+                if signature != b"PK\x03\x04":
+                    raise ValueError(f"Corrupt ZIP entry {info.filename} in {self.path}")
+                src.seek(name_length + extra_length, os.SEEK_CUR)
+                data = src.read(info.compress_size)
+                if info.compress_type == zipfile.ZIP_DEFLATED:
+                    # writestr ricomprime: servono i byte originali
+                    data = zlib.decompress(data, -zlib.MAX_WBITS)
+                entry = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                entry.compress_type = info.compress_type
+                entry.external_attr = info.external_attr
+                dst.writestr(entry, data)
+        os.replace(tmp_path, path)
+        return path
+
+    def _write_dirs(self):
+        for name in sorted(self._dirs):
+            arcname = self._arcname(name) + "/"
+            info = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+            info.external_attr = (0o40755 << 16) | 0x10
+            self._zip.writestr(info, b"")
+
+    def close(self):
+        """Completa l'archivio e restituisce il percorso del file."""
+        self._write_dirs()
+        self._zip.close()
+        return self.path
+
+    def abort(self):
+        """Chiude e rimuove un archivio incompleto."""
+        try:
+            self._zip.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def merge_archives(paths, path):
+    """Unisce più archivi (es. quelli degli shard) in path, con le voci in ordine di nome.
+
+    L'ordine non dipende da quale archivio ha finito prima, quindi il risultato è
+    deterministico; i contenuti vengono copiati a blocchi senza tenerli in memoria. Se lo
+    stesso nome compare in più archivi viene tenuta la prima occorrenza.
+    """
+    sources = [zipfile.ZipFile(source_path) for source_path in paths]
+    try:
+        entries = {}
+        for source in sources:
+            for info in source.infolist():
+                entries.setdefault(info.filename, (source, info))
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as merged:
+            for name in sorted(entries):
+                source, info = entries[name]
+                if info.is_dir():
+                    merged.writestr(info, b"")
+                    continue
+                with source.open(info) as src, merged.open(info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER)
+    finally:
+        for source in sources:
+            source.close()
+    return path